@@ -1,24 +1,44 @@
 import streamlit as st
 import datetime
+import time
 from config import (
     APP_TITLE,
     MODELS,
     RATE_LIMITS,
-    DEFAULT_TEMPERATURE
+    DEFAULT_TEMPERATURE,
+    VERSION_TABLE_PAGE_SIZE,
+    VARIANT_TEMPERATURES,
+    COMPLETION_CACHE_ENABLED,
+    JOB_POLL_INTERVAL,
+    JOB_PANEL_SIZE,
+    SCRIPT_LIST_PAGE_SIZE
 )
 from utils import (
     SYSTEM_PROMPT, 
-    count_tokens, 
+    count_context_tokens, 
     estimate_cost, 
-    generate_script,
-    load_scripts, 
-    save_scripts,
-    load_script_versions,
-    save_script_versions,
+    list_script_versions,
+    get_version_content,
+    with_version_content,
+    save_next_version,
+    build_version,
+    new_script_id,
+    generate_variants,
     create_message_from_context,
     get_context_parts,
-    estimate_output_tokens
+    layout_text,
+    pack_context,
+    packing_budget,
+    predict_output,
+    prewarm_encodings,
+    format_seconds
 )
+from rate_limiter import get_rate_limiter, RateLimitExceeded
+from completion_cache import get_completion_cache
+from jobs import get_job_manager, ACTIVE_STATUSES
+from metrics import get_metrics
+from ledger import get_ledger
+from script_index import ScriptIndex
 
 # Включаем wide mode для Streamlit
 st.set_page_config(
@@ -28,10 +48,10 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize session state
-if "scripts_data" not in st.session_state:
-    st.session_state.scripts_data = load_scripts()
+# Start of this run of the page, for the rerun duration metric
+rerun_started = time.perf_counter()
 
+# Initialize session state
 if "current_script" not in st.session_state:
     st.session_state.current_script = None
 
@@ -41,6 +61,163 @@ if "script_versions" not in st.session_state:
 if "active_tab" not in st.session_state:
     st.session_state.active_tab = 0
 
+if "selected_version_numbers" not in st.session_state:
+    st.session_state.selected_version_numbers = set()
+
+if "script_page" not in st.session_state:
+    st.session_state.script_page = 1
+
+# Порядок списка сценариев: подпись -> порядок индекса сценариев
+SCRIPT_SORT_OPTIONS = {
+    "Сначала измененные": "updated",
+    "Сначала новые": "created",
+    "По названию": "title",
+}
+
+JOB_STATUS_LABELS = {
+    "queued": "⏳ В очереди",
+    "running": "✍️ Создается",
+    "done": "✅ Готово",
+    "failed": "❌ Ошибка",
+    "cancelled": "🚫 Отменено"
+}
+
+def render_job_status(placeholder, job):
+    """Show the status of a background generation job in a placeholder"""
+    summary = (
+        f"**{JOB_STATUS_LABELS[job['status']]}** · {job['created_at']} · "
+        f"{job['model']}, температура {job['temperature']} · «{job['prompt'][:80]}»"
+    )
+    with placeholder.container():
+        st.markdown(summary)
+        if job["status"] == "running":
+            partial = get_job_manager().partial_content(job["id"])
+            st.caption(f"Получено символов: {len(partial):,}")
+            if partial:
+                st.text(partial[-1500:])
+        elif job["version_number"] is not None:
+            cost = job["cost"] if job["cost"] is not None else job["estimated_cost"]
+            st.caption(f"Версия {job['version_number']}, ${cost or 0:.4f}")
+        if job["error"]:
+            st.caption(f"Ошибка: {job['error']}")
+
+def toggle_context_version(version_number):
+    """Add or remove a version from the context selection when its checkbox changes"""
+    if version_number in st.session_state.selected_version_numbers:
+        st.session_state.selected_version_numbers.discard(version_number)
+    else:
+        st.session_state.selected_version_numbers.add(version_number)
+
+@st.cache_resource
+def get_script_index():
+    """Index of all scripts, shared by the sessions of this process instead of a copy per session"""
+    return ScriptIndex()
+
+@st.cache_resource
+def start_encoding_prewarm():
+    """Load the tiktoken encodings once per process while the first page renders"""
+    return prewarm_encodings()
+
+start_encoding_prewarm()
+
+def reset_script_page():
+    """Go back to the first page of the script list when the search or the order changes"""
+    st.session_state.script_page = 1
+
+def step_script_page(step):
+    """Show the previous or next page of the script list"""
+    st.session_state.script_page = max(st.session_state.script_page + step, 1)
+
+def new_script():
+    """Start editing a new, not yet saved script"""
+    st.session_state.current_script = {
+        # The index also holds the scripts other sessions and processes have saved
+        "id": new_script_id(get_script_index().ids()),
+        "title": "Новый сценарий",
+        "brief": "",
+        "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "updated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    st.session_state.script_versions = []
+    st.session_state.selected_version_numbers = set()
+
+def open_script(script):
+    """Open a saved script, loading only its lightweight version records"""
+    # A copy, since the scripts of the index are shared with other sessions
+    st.session_state.current_script = dict(script)
+    st.session_state.script_versions = list_script_versions(script['id'])
+    st.session_state.selected_version_numbers = set()
+    st.session_state.active_tab = max(len(st.session_state.script_versions) - 1, 0)
+    
+    # Присваиваем номера версиям, если у них еще нет номеров
+    for i, version in enumerate(st.session_state.script_versions):
+        if 'version_number' not in version:
+            version['version_number'] = i + 1
+
+DEBUG_PHASE_LABELS = {
+    "prompt_assembly": "Сборка промпта",
+    "token_counting": "Подсчет токенов",
+    "rate_limit_wait": "Ожидание лимита запросов",
+    "api_first_token": "Ожидание первого токена",
+    "api_streaming": "Получение ответа",
+    "json_parsing": "Разбор JSON",
+    "build_version": "Подготовка версии"
+}
+
+def format_milliseconds(seconds):
+    return f"{seconds * 1000:,.1f} мс" if seconds is not None else "—"
+
+def finish_rerun(page, version=None):
+    """Record how long this run of the page took and fill in the debug panel if it is shown"""
+    rerun_seconds = time.perf_counter() - rerun_started
+    metrics = get_metrics()
+    metrics.observe("rerun_seconds", rerun_seconds, page=page)
+    if not show_debug_panel:
+        return
+    
+    with debug_panel.container():
+        st.caption(f"Перерисовка страницы: {format_milliseconds(rerun_seconds)}")
+        if version is not None and version.get("timings"):
+            st.markdown(f"**Этапы создания версии {version['version_number']}**")
+            st.markdown("\n".join(
+                f"- {DEBUG_PHASE_LABELS.get(phase, phase)}: {format_milliseconds(seconds)}"
+                for phase, seconds in version["timings"].items()
+            ))
+        st.markdown("**Метрики процесса** (число, среднее, p95 не более)")
+        st.markdown("\n".join(
+            f"- `{name}` {', '.join(f'{key}={value}' for key, value in labels.items())}: "
+            f"{histogram.count}, {format_milliseconds(histogram.sum / histogram.count)}, "
+            f"{format_milliseconds(histogram.quantile(0.95))}"
+            for name, labels, histogram in metrics.snapshot()
+        ))
+
+def format_version_tokens(version):
+    """Describe the tokens of a version: actual usage if known, otherwise the input estimate"""
+    if version.get("prompt_tokens") is None:
+        return f"{version.get('input_tokens', 0):,} (оценка ввода)"
+    cached = ""
+    if version.get("cached_tokens"):
+        cached = (f", из кэша API {version['cached_tokens']:,} "
+                  f"({version['cached_tokens'] / max(version['prompt_tokens'], 1):.0%})")
+    estimated = " (оценка, ответ прерван)" if version.get("usage_estimated") else ""
+    return f"ввод {version['prompt_tokens']:,}{cached}, вывод {version['completion_tokens']:,}{estimated}"
+
+def format_cache_share(total):
+    """Describe which share of the input tokens of ledger totals the API served from its prompt cache"""
+    if not total["prompt_tokens"]:
+        return "—"
+    return f"{total['cached_tokens'] / total['prompt_tokens']:.0%}"
+
+def format_version_cost(version):
+    """Describe the cost of a version: actual cost next to the estimate made before the request"""
+    if version.get("cost") is None:
+        return f"${version.get('estimated_cost', 0):.4f} (оценка)"
+    return f"${version['cost']:.4f} (оценка до запроса ${version.get('estimated_cost', 0):.4f})"
+
+def step_active_version(step, version_count):
+    """Show the previous or next version in the version browser"""
+    st.session_state.active_tab = min(max(st.session_state.active_tab + step, 0), version_count - 1)
+
 # App title and description
 st.title(APP_TITLE)
 #st.subheader(APP_DESCRIPTION)
@@ -65,57 +242,109 @@ with st.sidebar:
             height=200,
             help="Установите системный промпт для AI, который определяет его роль и стиль генерации"
         )
+        
+        # Кэш ответов: повторный идентичный запрос возвращается мгновенно и бесплатно
+        use_completion_cache = st.checkbox(
+            "Кэшировать ответы",
+            value=COMPLETION_CACHE_ENABLED,
+            help="Идентичный запрос (та же модель, сообщения и температура) возвращается из кэша на диске без обращения к API"
+        )
+        cache_stats = get_completion_cache().stats()
+        st.caption(
+            f"Кэш ответов: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"в обход кэша {cache_stats['bypassed']}"
+        )
     
     st.header("Сценарии")
     
-    # Create new script button
-    if st.button("Создать новый сценарий"):
-        st.session_state.current_script = {
-            "id": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
-            "title": "Новый сценарий",
-            "brief": "",
-            "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "updated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        st.session_state.script_versions = []
-        st.experimental_rerun()
+    # Create new script button. Callbacks run before the page is drawn, so no extra rerun is needed
+    st.button("Создать новый сценарий", on_click=new_script)
         
-    # List of existing scripts
-    if st.session_state.scripts_data["scripts"]:
+    # List of existing scripts: only one page is rendered, so the sidebar does not grow with the catalogue
+    script_index = get_script_index()
+    if len(script_index):
         st.subheader("Ваши сценарии")
-        for script in st.session_state.scripts_data["scripts"]:
+        script_query = st.text_input("Поиск", key="script_query", placeholder="Название или описание",
+                                     on_change=reset_script_page)
+        script_sort = st.selectbox("Сортировка", list(SCRIPT_SORT_OPTIONS), key="script_sort",
+                                   on_change=reset_script_page)
+        page_scripts, matching_count = script_index.page(script_query, SCRIPT_SORT_OPTIONS[script_sort],
+                                                         st.session_state.script_page, SCRIPT_LIST_PAGE_SIZE)
+        script_page_count = max((matching_count - 1) // SCRIPT_LIST_PAGE_SIZE + 1, 1)
+        if st.session_state.script_page > script_page_count:
+            # Сценарии удалены в другой сессии, и текущей страницы больше нет
+            st.session_state.script_page = script_page_count
+            page_scripts, matching_count = script_index.page(script_query, SCRIPT_SORT_OPTIONS[script_sort],
+                                                             script_page_count, SCRIPT_LIST_PAGE_SIZE)
+        if script_query:
+            st.caption(f"Найдено сценариев: {matching_count}")
+        if not page_scripts:
+            st.caption("Ничего не найдено")
+        for script in page_scripts:
             # Используем колонки для размещения кнопки сценария и кнопки удаления
             col1, col2 = st.columns([5, 1])
             with col1:
-                if st.button(f"{script['title']} ({script['created_at']})", key=f"btn_{script['id']}"):
-                    st.session_state.current_script = script
-                    
-                    # Load script versions
-                    st.session_state.script_versions = load_script_versions(script['id'])
-                    
-                    # Присваиваем номера версиям, если у них еще нет номеров
-                    for i, version in enumerate(st.session_state.script_versions):
-                        if 'version_number' not in version:
-                            version['version_number'] = i + 1
-                    
-                    st.experimental_rerun()
+                st.button(f"{script['title']} ({script['created_at']})", key=f"btn_{script['id']}",
+                          on_click=open_script, args=(script,))
             with col2:
                 if st.button("🗑️", key=f"del_{script['id']}", help="Удалить сценарий"):
-                    # Удаляем сценарий из списка
-                    st.session_state.scripts_data["scripts"].remove(script)
+                    # Удаляем сценарий из сохраненного списка, не трогая сценарии других сессий
+                    script_index.delete(script["id"])
                     # Если это текущий сценарий, сбрасываем текущий сценарий
                     if st.session_state.current_script and st.session_state.current_script["id"] == script["id"]:
                         st.session_state.current_script = None
-                    # Сохраняем обновленный список сценариев
-                    save_scripts(st.session_state.scripts_data)
                     st.experimental_rerun()
+        if script_page_count > 1:
+            col1, col2, col3 = st.columns([1, 3, 1])
+            with col1:
+                st.button("◀", key="prev_script_page", help="Предыдущая страница", on_click=step_script_page,
+                          args=(-1,), disabled=st.session_state.script_page == 1)
+            with col2:
+                st.caption(f"Страница {st.session_state.script_page} из {script_page_count}")
+            with col3:
+                st.button("▶", key="next_script_page", help="Следующая страница", on_click=step_script_page,
+                          args=(1,), disabled=st.session_state.script_page == script_page_count)
+    
+    # Фактические расходы по журналу; итоги хранятся отдельно, так что журнал не перечитывается
+    with st.expander("Расходы"):
+        ledger_totals = get_ledger().totals()
+        today_total = get_ledger().day_total()
+        st.markdown(
+            f"- **Сегодня:** ${today_total['cost']:.4f}, запросов {today_total['requests']}, "
+            f"из кэша API {format_cache_share(today_total)} ввода\n"
+            f"- **Всего:** ${ledger_totals['total']['cost']:.4f}, запросов {ledger_totals['total']['requests']}, "
+            f"из кэша API {format_cache_share(ledger_totals['total'])} ввода"
+        )
+        if ledger_totals["models"]:
+            st.markdown("**По моделям:**\n" + "\n".join(
+                f"- {model}: ${total['cost']:.4f} ({total['prompt_tokens']:,} ввод, из них "
+                f"{format_cache_share(total)} из кэша API, {total['completion_tokens']:,} вывод)"
+                for model, total in sorted(ledger_totals["models"].items())
+            ))
+    
+    # Время этапов создания версий, перерисовки страницы и операций хранилища
+    show_debug_panel = st.checkbox("Панель отладки", help="Показать, сколько времени занимают этапы создания "
+                                   "версии, перерисовка страницы и чтение и запись данных")
+    debug_panel = st.empty()
 
 # Main content area
 if st.session_state.current_script:
     script = st.session_state.current_script
     
+    # Подхватываем версии, сохраненные фоновыми заданиями после последней загрузки списка
+    known_version_numbers = {v["version_number"] for v in st.session_state.script_versions}
+    if any(job["version_number"] is not None and job["version_number"] not in known_version_numbers
+           for job in get_job_manager().list_jobs(script["id"], JOB_PANEL_SIZE)):
+        st.session_state.script_versions = list_script_versions(script["id"])
+        st.session_state.active_tab = len(st.session_state.script_versions) - 1
+    
     # Script details section
     st.header("Детали сценария")
+    script_total = get_ledger().script_total(script["id"])
+    if script_total["requests"]:
+        # Доля ввода из кэша промптов API показывает, насколько повторные доработки дешевле первой
+        st.caption(f"Расходы на сценарий: ${script_total['cost']:.4f}, запросов {script_total['requests']}, "
+                   f"из кэша API {format_cache_share(script_total)} входных токенов")
     
     # Title and brief summary inputs
     col1, col2 = st.columns([1, 3])
@@ -133,19 +362,8 @@ if st.session_state.current_script:
         script["brief"] = new_brief
         script["updated_at"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # Save to session state
-        found = False
-        for i, s in enumerate(st.session_state.scripts_data["scripts"]):
-            if s["id"] == script["id"]:
-                st.session_state.scripts_data["scripts"][i] = script
-                found = True
-                break
-        
-        if not found:
-            st.session_state.scripts_data["scripts"].append(script)
-            
-        # Save to disk
-        save_scripts(st.session_state.scripts_data)
+        # Save only this script to disk, so changes of other sessions are not overwritten
+        get_script_index().upsert(script)
     
     # Generate script section
     st.header("Создать версию сценария")
@@ -197,15 +415,46 @@ if st.session_state.current_script:
             - **Токенов в день (TPD)**: {tpd}
             - **Запросов в день (RPD)**: {rpd}
             """)
+            
+            # Токены модели за сегодня по журналу расходов
+            if isinstance(limits.get('TPD'), int):
+                model_today = get_ledger().day_total(model=selected_model)
+                st.markdown(f"**Использовано сегодня:** "
+                            f"{model_today['prompt_tokens'] + model_today['completion_tokens']:,} "
+                            f"из {limits['TPD']:,} токенов")
+            
+            # Текущее состояние лимитов с учетом запросов всех пользователей
+            limit_state = get_rate_limiter().snapshot(selected_model)
+            if limit_state:
+                st.markdown("**Доступно сейчас:** " + " | ".join(
+                    f"{name}: {format(state['available'], ',')} из {format(state['capacity'], ',')}"
+                    for name, state in limit_state.items()
+                ))
     
     # Context selection for regeneration
     include_brief = True  # Always include brief
     
     # Include previous versions if they exist
     selected_versions = []
+    context_mode = "full"
+    auto_pack = False
+    cost_limit = None
     if st.session_state.script_versions:
         with st.expander("Включить предыдущие версии в контекст"):
-            if st.session_state.script_versions:
+            # Автоподбор работает по метаданным версий, поэтому его можно пересчитывать при каждой перерисовке
+            auto_pack = st.checkbox(
+                "Подбирать версии автоматически",
+                key=f"auto_pack_{script['id']}",
+                help="Самые новые и близкие к запросу версии включаются, пока помещаются в бюджет токенов; "
+                     "версия, которая не помещается целиком, обрезается по границе сцены"
+            )
+            if auto_pack:
+                budget_mode = st.radio("Бюджет", ["Окно контекста", "Лимит стоимости"], horizontal=True,
+                                       key=f"pack_budget_{script['id']}")
+                if budget_mode == "Лимит стоимости":
+                    cost_limit = st.number_input("Лимит стоимости запроса, $", min_value=0.0, value=0.05,
+                                                 step=0.01, format="%.3f", key=f"pack_cost_{script['id']}")
+            if not auto_pack:
                 # Стиль для таблицы
                 st.markdown("""
                 <style>
@@ -270,11 +519,25 @@ if st.session_state.current_script:
                 # Divider - делаем тонкую линию
                 st.markdown('<hr style="margin: 0; padding: 0; height: 1px; border: none; background-color: #e1e4e8;">', unsafe_allow_html=True)
                 
-                # Data rows
-                for i, version in enumerate(st.session_state.script_versions):
+                # Data rows: only one page of versions is rendered, the selection is kept
+                # in session state so it survives switching pages
+                versions_by_number = {v["version_number"]: v for v in st.session_state.script_versions}
+                page_count = (len(st.session_state.script_versions) - 1) // VERSION_TABLE_PAGE_SIZE + 1
+                page = 1
+                if page_count > 1:
+                    page = st.selectbox(
+                        "Страница",
+                        list(range(1, page_count + 1)),
+                        index=page_count - 1,  # по умолчанию показываем самые новые версии
+                        key=f"context_page_{script['id']}"
+                    )
+                first_row = (page - 1) * VERSION_TABLE_PAGE_SIZE
+                page_versions = st.session_state.script_versions[first_row:first_row + VERSION_TABLE_PAGE_SIZE]
+                
+                for i, version in enumerate(page_versions, start=first_row):
                     timestamp = version.get('timestamp', 'No date')
                     model = version.get('model', 'Unknown')
-                    content_length = len(version.get('content', ''))
+                    content_length = version.get('content_length', 0)
                     tokens = version.get('input_tokens', 0)
                     cost = version.get('estimated_cost', 0)
                     
@@ -285,7 +548,7 @@ if st.session_state.current_script:
                     col1, col2, col3, col4, col5, col6 = st.columns([0.5, 1.5, 1, 1, 1, 1])
                     
                     with col1:
-                        st.markdown(f"<small>**{i+1}**</small>", unsafe_allow_html=True)
+                        st.markdown(f"<small>**{version['version_number']}**</small>", unsafe_allow_html=True)
                     with col2:
                         st.markdown(f"<small>{timestamp}</small>", unsafe_allow_html=True)
                     with col3:
@@ -295,13 +558,34 @@ if st.session_state.current_script:
                     with col5:
                         st.markdown(f"<small>{format(tokens, ',')}</small>", unsafe_allow_html=True)
                     with col6:
-                        if st.checkbox("", key=f"v_{i}"):
-                            # Добавляем номер версии в объект версии перед добавлением в список выбранных
-                            version_with_number = version.copy()
-                            version_with_number['version_number'] = i+1  # Сохраняем фактический номер версии
-                            selected_versions.append(version_with_number)
+                        st.checkbox(
+                            f"Версия {version['version_number']} в контексте",
+                            label_visibility="collapsed",
+                            value=version["version_number"] in st.session_state.selected_version_numbers,
+                            key=f"v_{script['id']}_{version['version_number']}",
+                            on_change=toggle_context_version,
+                            args=(version["version_number"],)
+                        )
                     
                     st.markdown('</div>', unsafe_allow_html=True)
+                
+                # Загружаем текст версии только когда она выбрана в контекст;
+                # подсчитанные токены сохраняются в записи метаданных версии
+                for version_number in sorted(st.session_state.selected_version_numbers):
+                    if version_number in versions_by_number:
+                        selected_versions.append(with_version_content(script['id'], versions_by_number[version_number]))
+                
+                if selected_versions:
+                    st.caption("Выбраны версии: " + ", ".join(str(v["version_number"]) for v in selected_versions))
+                
+                if len(selected_versions) > 1:
+                    send_diffs = st.checkbox(
+                        "Передавать последующие версии как изменения (diff)",
+                        key=f"context_diff_{script['id']}",
+                        help="Самая ранняя выбранная версия передается целиком, остальные - только отличиями от предыдущей выбранной"
+                    )
+                    if send_diffs:
+                        context_mode = "diff"
     
     # User prompt input
     user_prompt = st.text_area("Опишите, что вы хотите в этой версии сценария", height=100, 
@@ -309,35 +593,45 @@ if st.session_state.current_script:
     
     # Token counting and cost estimation
     if user_prompt:
+        # Автоподбор: версии выбираются заново при каждом изменении запроса, модели или бюджета.
+        # Под ответ резервируется его потолок max_tokens, предсказанный для контекста без версий
+        packing = None
+        if auto_pack:
+            base_tokens, _ = count_context_tokens(system_prompt, get_context_parts(script['brief'], [], user_prompt),
+                                                  selected_model)
+            base_prediction = predict_output(selected_model, base_tokens, 0, len(script["brief"]))
+            packing = pack_context(
+                st.session_state.script_versions,
+                packing_budget(selected_model, base_prediction["max_tokens"] or base_prediction["high"], cost_limit),
+                base_tokens,
+                user_prompt,
+                selected_model,
+                load_content=lambda version: with_version_content(script['id'], version)
+            )
+            selected_versions = packing["versions"]
+        
         # Create messages and context parts for display
-        messages = create_message_from_context(system_prompt, script['brief'], selected_versions, user_prompt)
-        context_parts = get_context_parts(script['brief'], selected_versions, user_prompt)
+        context_parts = get_context_parts(script['brief'], selected_versions, user_prompt, context_mode)
+        messages = create_message_from_context(system_prompt, script['brief'], selected_versions, user_prompt, context_mode)
         
-        # Count tokens and estimate cost
-        # Create a better formatted full prompt for display with clear section dividers
-        full_prompt = f"===== SYSTEM PROMPT =====\n{system_prompt}\n\n"
-        
-        brief_text = f"===== BRIEF SUMMARY =====\nBrief summary of the story: {script['brief']}"
-        full_prompt += f"{brief_text}\n\n"
-        
-        # Add previous versions if selected
-        for version in selected_versions:
-            version_number = version.get('version_number', 0)
-            version_text = (
-                f"===== PREVIOUS VERSION {version_number} =====\n"
-                f"Prompt: {version.get('prompt', 'No prompt')}\n\n"
-                f"Content: {version.get('content', 'No content')}"
-            )
-            full_prompt += f"{version_text}\n\n"
+        # Count tokens part by part: unchanged parts come from the cache or the version records,
+        # so a rerun only tokenizes what actually changed
+        input_tokens, part_tokens = count_context_tokens(system_prompt, context_parts, selected_model)
         
-        # Add current user prompt
-        full_prompt += f"===== CURRENT REQUEST =====\n{user_prompt}\n\n"
+        # Для сравнения считаем, сколько стоил бы тот же контекст с полными копиями версий
+        diff_saved_tokens = 0
+        if context_mode == "diff":
+            full_context_parts = get_context_parts(script['brief'], selected_versions, user_prompt)
+            full_input_tokens, _ = count_context_tokens(system_prompt, full_context_parts, selected_model)
+            diff_saved_tokens = full_input_tokens - input_tokens
         
-        # The original messages list remains unchanged for the API call
-        input_tokens = count_tokens(full_prompt, selected_model)
+        # Create a better formatted full prompt for display with clear section dividers
+        full_prompt = f"===== SYSTEM PROMPT =====\n{layout_text(system_prompt)}\n\n"
+        full_prompt += "".join(f"{part['content']}\n\n" for part in context_parts)
         
-        # Estimate output tokens based on brief length
-        estimated_output_tokens = estimate_output_tokens(len(script["brief"]))
+        # Длина ответа предсказывается по сохраненным версиям, пока их мало - по длине брифа
+        prediction = predict_output(selected_model, input_tokens, len(selected_versions), len(script["brief"]))
+        estimated_output_tokens = prediction["tokens"]
         
         # Calculate cost
         estimated_cost = estimate_cost(input_tokens, estimated_output_tokens, selected_model)
@@ -349,10 +643,47 @@ if st.session_state.current_script:
             st.metric("Входные токены", format(input_tokens, ','), f"Осталось {format(MODELS[selected_model]['context_window'] - input_tokens, ',')}")
         
         with col2:
-            st.metric("Оценка выходных токенов", format(estimated_output_tokens, ','))
+            st.metric("Оценка выходных токенов", format(estimated_output_tokens, ','),
+                      f"{prediction['low']:,}–{prediction['high']:,}", delta_color="off")
         
         with col3:
-            st.metric("Оценка стоимости", f"${estimated_cost:.4f}")
+            st.metric("Оценка стоимости", f"${estimated_cost:.4f}",
+                      f"${estimate_cost(input_tokens, prediction['low'], selected_model):.4f}–"
+                      f"${estimate_cost(input_tokens, prediction['high'], selected_model):.4f}", delta_color="off")
+        
+        if prediction["fitted"]:
+            source = f"по {prediction['samples']:,} версиям" + (" всех моделей" if prediction["pooled"] else f" {selected_model}")
+            details = [f"Прогноз длины ответа {source}"]
+            if prediction["seconds_low"] is not None:
+                details.append(f"время генерации {format_seconds(prediction['seconds_low'])}–{format_seconds(prediction['seconds_high'])}")
+            if prediction["max_tokens"]:
+                details.append(f"ответ ограничен {prediction['max_tokens']:,} токенами")
+            st.caption(", ".join(details))
+        else:
+            st.caption("Прогноз длины ответа по длине брифа: сохраненных версий пока мало для обучения")
+        
+        if context_mode == "diff":
+            st.caption(f"Передача изменений вместо полных копий версий экономит {format(diff_saved_tokens, ',')} входных токенов "
+                       f"(${estimate_cost(diff_saved_tokens, 0, selected_model):.4f})")
+        
+        if packing is not None:
+            packed = [f"{number} ({tokens:,})" for number, tokens in packing["included"]]
+            packed += [f"{number} — обрезана до {kept:,} из {full:,} токенов, сцен {kept_scenes} из {scenes}"
+                       for number, kept, full, kept_scenes, scenes in packing["truncated"]]
+            st.caption("Автоподбор: " + ("в контексте версии " + "; ".join(packed) if packed
+                                         else "ни одна версия не помещается в бюджет"))
+            if packing["dropped"]:
+                with st.expander(f"Не вошли в контекст: {len(packing['dropped'])}"):
+                    st.markdown(", ".join(f"{number} ({tokens:,} ток.)" for number, tokens in packing["dropped"]))
+        
+        # Warn if the rate limits would delay or reject this request
+        try:
+            get_rate_limiter().check(selected_model, input_tokens + estimated_output_tokens)
+            rate_limit_wait = get_rate_limiter().estimate_wait(selected_model, input_tokens + estimated_output_tokens)
+            if rate_limit_wait >= 1:
+                st.info(f"⏳ Из-за лимитов API запрос будет ждать в очереди примерно {rate_limit_wait:.0f} с.")
+        except RateLimitExceeded as e:
+            st.error(f"⚠️ Запрос не помещается в лимиты API: {str(e)}")
         
         # Warning if exceeding context window
         if input_tokens > MODELS[selected_model]["context_window"]:
@@ -360,10 +691,10 @@ if st.session_state.current_script:
         
         # Show context parts
         with st.expander("Просмотр компонентов контекста"):
-            for part in context_parts:
+            for part, tokens in zip(context_parts, part_tokens):
                 st.subheader(part["type"])
                 st.text_area(f"Содержимое {part['type']}", part["content"][:500] + ("..." if len(part["content"]) > 500 else ""), height=100, disabled=True)
-                st.text(f"Токенов: {format(count_tokens(part['content'], selected_model), ',')}")
+                st.text(f"Токенов: {format(tokens, ',')}")
                 st.divider()
         
         # Show full prompt
@@ -371,42 +702,132 @@ if st.session_state.current_script:
             st.text_area("Содержимое промпта", full_prompt, height=300, disabled=True)
             st.text(f"Общее количество токенов: {format(input_tokens, ',')}")
         
-        # Generate button
-        if st.button("Создать сценарий", type="primary", disabled=input_tokens > MODELS[selected_model]["context_window"]):
-            if input_tokens <= MODELS[selected_model]["context_window"]:
-                with st.spinner("Создание сценария... Это может занять минуту."):
-                    try:
-                        # Передаем значение температуры в функцию generate_script
-                        generated_script = generate_script(messages, selected_model, temperature)
-                        
-                        # Save the new version
-                        new_version = {
-                            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "model": selected_model,
-                            "temperature": temperature,
-                            "prompt": user_prompt,
-                            "content": generated_script,
-                            "input_tokens": input_tokens,
-                            "estimated_cost": estimated_cost,
-                            "context": [p["type"] for p in context_parts],
-                            "version_number": len(st.session_state.script_versions) + 1  # Присваиваем номер версии
-                        }
-                        
-                        st.session_state.script_versions.append(new_version)
-                        
-                        # Save versions to disk
-                        save_script_versions(script['id'], st.session_state.script_versions)
-                        
-                        # Устанавливаем активную вкладку на последнюю (новую) версию
-                        st.session_state.active_tab = len(st.session_state.script_versions) - 1
-                        #st.tabs.active_tab = len(st.session_state.script_versions) - 1
-
-                        st.success("Сценарий успешно создан!")
-                        st.experimental_rerun()
-                    except Exception as e:
-                        st.error(f"Ошибка при создании сценария: {str(e)}")
-            else:
-                st.error("Невозможно создать сценарий: ввод превышает лимит токенов.")
+        refresh_completion_cache = False
+        if use_completion_cache:
+            refresh_completion_cache = st.checkbox(
+                "Игнорировать кэш (запросить заново)",
+                help="Отправить запрос в API, даже если такой же ответ уже есть в кэше; новый ответ заменит сохраненный"
+            )
+        
+        # Generate button. Генерация идет в фоновом задании: сессия не блокируется, а результат
+        # сохраняется в версии сценария, даже если страницу закроют. Задание ставится из обработчика
+        # нажатия, чтобы перезапуск страницы не мог поставить его повторно
+        if st.button(
+            "Создать сценарий",
+            type="primary",
+            disabled=input_tokens > MODELS[selected_model]["context_window"],
+            on_click=get_job_manager().submit,
+            args=(
+                script,
+                user_prompt,
+                selected_model,
+                temperature,
+                [v["version_number"] for v in selected_versions],
+                system_prompt,
+                context_mode,
+                use_completion_cache,
+                refresh_completion_cache,
+                packing["token_limits"] if packing is not None else None
+            )
+        ):
+            st.success("Задание поставлено в очередь. Новая версия появится, когда оно завершится.")
+        
+        # Generate several variants of the same request at once
+        with st.expander("Создать несколько вариантов"):
+            col1, col2 = st.columns(2)
+            with col1:
+                variant_models = st.multiselect("Модели", list(MODELS.keys()), default=[selected_model])
+            with col2:
+                temperature_choices = sorted(set(VARIANT_TEMPERATURES + [round(temperature, 1)]))
+                variant_temperatures = st.multiselect("Температуры", temperature_choices, default=[round(temperature, 1)])
+            
+            variants = []
+            for variant_model in variant_models:
+                variant_input_tokens, _ = count_context_tokens(system_prompt, context_parts, variant_model)
+                if variant_input_tokens > MODELS[variant_model]["context_window"]:
+                    st.warning(f"Модель {variant_model} пропущена: ввод превышает размер ее контекста.")
+                    continue
+                variant_prediction = predict_output(variant_model, variant_input_tokens, len(selected_versions),
+                                                    len(script["brief"]))
+                for variant_temperature in variant_temperatures:
+                    variants.append({
+                        "model": variant_model,
+                        "temperature": variant_temperature,
+                        "input_tokens": variant_input_tokens,
+                        "estimated_output_tokens": variant_prediction["tokens"],
+                        "estimated_cost": estimate_cost(variant_input_tokens, variant_prediction["tokens"], variant_model),
+                        "max_tokens": variant_prediction["max_tokens"]
+                    })
+            
+            if variants:
+                st.caption(f"Оценка общей стоимости: ${sum(v['estimated_cost'] for v in variants):.4f}")
+            
+            if st.button(f"Создать вариантов: {len(variants)}", disabled=not variants):
+                # Одна строка статуса на вариант, заполняется по мере готовности
+                variant_placeholders = {}
+                for i, variant in enumerate(variants):
+                    variant["index"] = i
+                    variant_placeholders[i] = st.empty()
+                    variant_placeholders[i].info(f"⏳ {variant['model']}, температура {variant['temperature']}: создание...")
+                
+                for variant, result in generate_variants(messages, variants,
+                                                         use_cache=use_completion_cache,
+                                                         refresh_cache=refresh_completion_cache):
+                    placeholder = variant_placeholders[variant["index"]]
+                    label = f"{variant['model']}, температура {variant['temperature']}"
+                    if result["error"] is not None and not result["content"]:
+                        placeholder.error(f"❌ {label}: {str(result['error'])}")
+                        continue
+                    
+                    # Фоновые задания тоже добавляют версии: окончательный номер выдается при сохранении
+                    # под той же короткой блокировкой сценария, что и у заданий (save_next_version)
+                    new_version = build_version(
+                        max((v["version_number"] for v in st.session_state.script_versions), default=0) + 1,
+                        user_prompt,
+                        result["content"],
+                        variant["model"],
+                        variant["temperature"],
+                        variant["input_tokens"],
+                        variant["estimated_cost"],
+                        [p["type"] for p in context_parts],
+                        result["stats"],
+                        result["error"]
+                    )
+                    st.session_state.script_versions.append(save_next_version(script['id'], new_version))
+                    st.session_state.active_tab = len(st.session_state.script_versions) - 1
+                    
+                    summary = (
+                        f"{label}: версия {new_version['version_number']}, "
+                        f"первый токен {format_seconds(new_version['time_to_first_token'])}, "
+                        f"всего {format_seconds(new_version['generation_time'])}, "
+                        f"{format_version_cost(new_version)}"
+                    )
+                    with placeholder.container():
+                        if result["error"] is not None:
+                            st.warning(f"⚠️ {summary} (сохранено частично: {str(result['error'])})")
+                        else:
+                            st.success(f"✅ {summary}")
+                        # Expanders can't be nested, so the text goes into a read-only text area
+                        st.text_area(f"Текст версии {new_version['version_number']}", result["content"],
+                                     height=150, disabled=True)
+    
+    # Background generation jobs of this script
+    job_manager = get_job_manager()
+    script_jobs = job_manager.list_jobs(script["id"], JOB_PANEL_SIZE)
+    job_placeholders = {}
+    if script_jobs:
+        active_jobs = [job for job in script_jobs if job["status"] in ACTIVE_STATUSES]
+        with st.expander(f"Задания на создание (активных: {len(active_jobs)})", expanded=bool(active_jobs)):
+            for job in script_jobs:
+                col1, col2 = st.columns([6, 1])
+                with col1:
+                    job_placeholders[job["id"]] = st.empty()
+                    render_job_status(job_placeholders[job["id"]], job)
+                with col2:
+                    # Задания других процессов отменяет только их процесс
+                    if job_manager.can_cancel(job["id"]):
+                        st.button("Отменить", key=f"cancel_{job['id']}",
+                                  on_click=job_manager.cancel, args=(job["id"],))
     
     # View script versions
     if st.session_state.script_versions:
@@ -426,58 +847,104 @@ if st.session_state.current_script:
         </style>
         """, unsafe_allow_html=True)
         
-        tab_titles = [f"Версия {i+1}" for i in range(len(st.session_state.script_versions))]
-        tabs = st.tabs(tab_titles)
+        # Показываем одну выбранную версию вместо вкладок со всеми версиями,
+        # чтобы стоимость перерисовки не зависела от числа версий
+        version_count = len(st.session_state.script_versions)
+        st.session_state.active_tab = min(st.session_state.active_tab, version_count - 1)
         
-        # Используем значение active_tab из session_state для определения активной вкладки
-        # Streamlit автоматически отобразит активную вкладку, нам нужно только установить индекс
-        st.session_state.active_tab = min(st.session_state.active_tab, len(tabs) - 1)
+        col1, col2, col3 = st.columns([1, 6, 1])
+        with col1:
+            st.button("◀", key="prev_version", help="Предыдущая версия",
+                      on_click=step_active_version, args=(-1, version_count),
+                      disabled=st.session_state.active_tab == 0)
+        with col2:
+            st.selectbox(
+                "Версия",
+                list(range(version_count)),
+                format_func=lambda i: (
+                    f"Версия {st.session_state.script_versions[i]['version_number']} — "
+                    f"{st.session_state.script_versions[i].get('timestamp', 'Нет даты')} "
+                    f"({st.session_state.script_versions[i].get('model', 'Неизвестно')})"
+                ),
+                key="active_tab",
+                label_visibility="collapsed"
+            )
+        with col3:
+            st.button("▶", key="next_version", help="Следующая версия",
+                      on_click=step_active_version, args=(1, version_count),
+                      disabled=st.session_state.active_tab == version_count - 1)
         
-        for i, (tab, version) in enumerate(zip(tabs, st.session_state.script_versions)):
-            with tab:
-                col1, col2 = st.columns([3, 1])
-                
-                with col1:
-                    st.subheader("Информация о создании")
-                    # Добавляем информацию о температуре в вывод
-                    temp_info = f" (Температура: {version.get('temperature', DEFAULT_TEMPERATURE)})" if 'temperature' in version else ""
-                    st.markdown(f"""
-                    - **Дата:** {version.get('timestamp', 'Нет даты')}
-                    - **Модель:** {version.get('model', 'Неизвестно')}{temp_info}
-                    - **Токенов:** {format(version.get('input_tokens', 0), ',')}
-                    - **Стоимость:** ${version.get('estimated_cost', 0):.4f}
-                    - **Использованный контекст:** {', '.join(version.get('context', ['Краткое описание']))}
-                    """)
-                
-                with col2:
-                    # Download button
-                    timestamp = version.get("timestamp", "").replace(" ", "_").replace(":", "-")
-                    download_filename = f"{script['title'].replace(' ', '_')}_{timestamp}.txt"
-                    
-                    st.download_button(
-                        label="Скачать эту версию",
-                        data=version.get("content", ""),
-                        file_name=download_filename,
-                        mime="text/plain",
-                        key=f"download_{i}"
-                    )
-                
-                st.subheader("Запрос для создания")
-                st.info(version.get("prompt", "Запрос недоступен"))
-                
-                st.subheader("Созданный сценарий")
-                
-                # Получаем содержимое сценарий
-                content = version.get("content", "Содержимое недоступно")
-                
-                # Открываем HTML-контейнер
-                st.markdown('<div class="markdown-container">', unsafe_allow_html=True)
-                
-                # Отображаем содержимое как markdown (безопасно, с сохранением форматирования)
-                st.markdown(content)
-                
-                # Закрываем HTML-контейнер
-                st.markdown('</div>', unsafe_allow_html=True)
+        version = st.session_state.script_versions[st.session_state.active_tab]
+        
+        col1, col2 = st.columns([3, 1])
+        
+        with col1:
+            st.subheader("Информация о создании")
+            # Добавляем информацию о температуре в вывод
+            temp_info = f" (Температура: {version.get('temperature', DEFAULT_TEMPERATURE)})" if 'temperature' in version else ""
+            st.markdown(f"""
+            - **Дата:** {version.get('timestamp', 'Нет даты')}
+            - **Модель:** {version.get('model', 'Неизвестно')}{temp_info}
+            - **Токенов:** {format_version_tokens(version)}
+            - **Стоимость:** {format_version_cost(version)}
+            - **Время до первого токена:** {format_seconds(version.get('time_to_first_token'))}
+            - **Время генерации:** {format_seconds(version.get('generation_time'))}
+            - **Использованный контекст:** {', '.join(version.get('context', ['Краткое описание']))}
+            """)
+        
+        # Получаем содержимое сценария (из кэша или с диска)
+        content = get_version_content(script['id'], version["version_number"])
+        
+        with col2:
+            # Download button
+            timestamp = version.get("timestamp", "").replace(" ", "_").replace(":", "-")
+            download_filename = f"{script['title'].replace(' ', '_')}_{timestamp}.txt"
+            
+            st.download_button(
+                label="Скачать эту версию",
+                data=content,
+                file_name=download_filename,
+                mime="text/plain",
+                key="download_version"
+            )
+        
+        if version.get("partial"):
+            st.warning(f"Версия сохранена частично: {version.get('error', 'соединение прервано')}")
+        elif version.get("finish_reason") == "length":
+            st.warning("Ответ достиг ограничения длины (max_tokens) и может быть оборван. "
+                       "Повторите запрос или увеличьте MAX_TOKENS_MARGIN в config.py.")
+        
+        st.subheader("Запрос для создания")
+        st.info(version.get("prompt", "Запрос недоступен"))
+        
+        st.subheader("Созданный сценарий")
+        
+        # Открываем HTML-контейнер
+        st.markdown('<div class="markdown-container">', unsafe_allow_html=True)
+        
+        # Отображаем содержимое как markdown (безопасно, с сохранением форматирования)
+        st.markdown(content or "Содержимое недоступно")
+        
+        # Закрываем HTML-контейнер
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    finish_rerun("script", version if st.session_state.script_versions else None)
+    
+    # Пока есть активные задания, обновляем их статус на месте. Любое действие пользователя
+    # прерывает ожидание и перезапускает страницу, так что сессия не блокируется.
+    active_job_ids = [job["id"] for job in script_jobs if job["status"] in ACTIVE_STATUSES]
+    if active_job_ids:
+        while True:
+            time.sleep(JOB_POLL_INTERVAL)
+            polled_jobs = [job_manager.get(job_id) for job_id in active_job_ids]
+            if any(job is None for job in polled_jobs):
+                # Запись задания удалена или больше не видна этому процессу; перезапуск заново получит список заданий
+                break
+            for job in polled_jobs:
+                render_job_status(job_placeholders[job["id"]], job)
+            if not any(job["status"] in ACTIVE_STATUSES for job in polled_jobs):
+                break
+        st.experimental_rerun()
 
 # Initial greeting if no script is selected
 else:
@@ -511,4 +978,6 @@ else:
     
     with col3:
         st.markdown("### 💰 Оценка стоимости")
-        st.markdown("Оценивайте стоимость создания сценария перед отправкой запросов к API") 
\ No newline at end of file
+        st.markdown("Оценивайте стоимость создания сценария перед отправкой запросов к API")
+    
+    finish_rerun("home")
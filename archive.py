@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Streaming export and import of scripts and their versions.
+
+An archive is a gzip-compressed JSON lines file: a header, every script
+followed by its versions with their content, and a footer with the counts.
+Export reads one version at a time from the storage and import writes one
+script at a time, so memory is bounded by the largest script rather than by the
+size of the data directory. Archives named without ``.gz`` are plain JSON lines.
+
+    python archive.py export all.jsonl.gz
+    python archive.py export subset.jsonl.gz --query дождь --updated-since 2024-06-01 --latest
+    python archive.py import all.jsonl.gz
+    python archive.py import all.jsonl.gz --replace
+
+Import leaves scripts that already exist alone unless ``--replace`` is given,
+in which case their stored versions are replaced by the archived ones. Imported
+versions are not added to the cost ledger; run ``python output_predictor.py
+rebuild`` to train the output predictor on them.
+"""
+import os
+import sys
+import gzip
+import json
+import zlib
+import time
+import argparse
+import datetime
+
+import storage
+from config import STORAGE_BACKEND, DATA_DIR, SQLITE_DB_PATH, ARCHIVE_COMPRESSION_LEVEL, ARCHIVE_IMPORT_BATCH_SIZE
+
+ARCHIVE_FORMAT = "author-archive"
+ARCHIVE_VERSION = 1
+
+
+class ArchiveError(Exception):
+    """Raised for a file that is not a complete archive"""
+
+
+def _open(path, mode, compressed):
+    if compressed:
+        if mode == "w":
+            return gzip.open(path, "wt", encoding="utf-8", compresslevel=ARCHIVE_COMPRESSION_LEVEL)
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def _lines(f):
+    """Yield the lines of an archive, stopping where the file was cut short or is corrupt"""
+    try:
+        yield from f
+    except (EOFError, UnicodeDecodeError, gzip.BadGzipFile, zlib.error):
+        # A gzip stream or a character cut in the middle, or damaged data; the missing footer reports it
+        return
+
+def _write_line(f, record):
+    f.write(json.dumps(record, ensure_ascii=False))
+    f.write("\n")
+
+def select_scripts(scripts, script_ids=None, query=None, updated_since=None, updated_until=None):
+    """Return the scripts with one of the ids, whose title or brief contain ``query`` and updated in the range
+
+    The dates are compared as prefixes of ``updated_at``, so "2024-06" or
+    "2024-06-01" cover the whole month or day.
+    """
+    ids = set(script_ids) if script_ids else None
+    query = query.casefold() if query else None
+    selected = []
+    for script in scripts:
+        updated_at = script.get("updated_at") or ""
+        if ids is not None and script["id"] not in ids:
+            continue
+        if query and query not in f"{script.get('title', '')}\n{script.get('brief', '')}".casefold():
+            continue
+        if updated_since and updated_at[:len(updated_since)] < updated_since:
+            continue
+        if updated_until and updated_at[:len(updated_until)] > updated_until:
+            continue
+        selected.append(script)
+    return selected
+
+def _selected_versions(target, script_id, model=None, latest_only=False):
+    latest = None
+    for version in target.iter_versions(script_id):
+        if model and version.get("model") != model:
+            continue
+        if latest_only:
+            latest = version
+        else:
+            yield version
+    if latest is not None:
+        yield latest
+
+def export_archive(target, path, script_ids=None, query=None, updated_since=None, updated_until=None,
+                   model=None, latest_only=False):
+    """Write the selected scripts of a storage and their versions to an archive
+
+    ``model`` keeps only the versions generated by that model and
+    ``latest_only`` only the last of them. The archive is written to a
+    temporary file and renamed when complete. Returns (scripts, versions).
+    """
+    scripts = select_scripts(target.load_scripts()["scripts"], script_ids, query, updated_since, updated_until)
+    script_count = version_count = 0
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with _open(tmp_path, "w", path.endswith(".gz")) as f:
+            _write_line(f, {
+                "format": ARCHIVE_FORMAT,
+                "version": ARCHIVE_VERSION,
+                "exported_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "filters": {"script_ids": script_ids, "query": query, "updated_since": updated_since,
+                            "updated_until": updated_until, "model": model, "latest_only": latest_only}
+            })
+            for script in scripts:
+                _write_line(f, {"type": "script", "script": script})
+                script_count += 1
+                for version in _selected_versions(target, script["id"], model, latest_only):
+                    _write_line(f, {"type": "version", "script_id": script["id"], "version": version})
+                    version_count += 1
+            _write_line(f, {"type": "end", "scripts": script_count, "versions": version_count})
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return script_count, version_count
+
+def import_archive(target, path, replace=False):
+    """Read an archive into a storage and return (imported scripts, skipped scripts, imported versions)
+
+    The versions of a script are written when the next script starts, so
+    only one script is held in memory. The stored list of scripts is updated
+    in batches of config.ARCHIVE_IMPORT_BATCH_SIZE. If the archive ends
+    without its footer, or its data is damaged before it, the scripts read
+    completely are kept and ArchiveError is raised.
+    """
+    # Scripts that were deleted from the list keep their versions, which must not be overwritten either
+    existing = set()
+    if not replace:
+        existing = {script["id"] for script in target.load_scripts()["scripts"]}
+        existing.update(target.script_ids_with_versions())
+
+    imported = skipped = version_count = 0
+    pending_scripts = []
+    current_script = None
+    current_id = None
+    current_versions = None
+
+    def finish_script():
+        # The script is listed only once all of its versions are stored
+        nonlocal imported, version_count
+        if current_versions is None:
+            return
+        target.write_versions(current_id, current_versions)
+        version_count += len(current_versions)
+        imported += 1
+        pending_scripts.append(current_script)
+        if len(pending_scripts) >= ARCHIVE_IMPORT_BATCH_SIZE:
+            write_pending()
+
+    def write_pending():
+        if pending_scripts:
+            target.upsert_scripts(pending_scripts)
+            pending_scripts.clear()
+
+    with _open(path, "r", path.endswith(".gz")) as f:
+        try:
+            header = json.loads(f.readline())
+        except (EOFError, UnicodeDecodeError, gzip.BadGzipFile, zlib.error, ValueError):
+            # Not gzip or not UTF-8 text, a stream cut before the header ends, or not JSON
+            header = None
+        if not isinstance(header, dict) or header.get("format") != ARCHIVE_FORMAT:
+            raise ArchiveError(f"{path} is not a script archive")
+        if header.get("version", 0) > ARCHIVE_VERSION:
+            raise ArchiveError(f"{path} was written by a newer version (format {header['version']})")
+
+        for line_number, line in enumerate(_lines(f), start=2):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn line can only be the last one
+                break
+            kind = record.get("type")
+            if kind == "script":
+                finish_script()
+                current_script = record["script"]
+                current_id = current_script["id"]
+                if current_id in existing:
+                    skipped += 1
+                    current_versions = None
+                else:
+                    current_versions = []
+            elif kind == "version":
+                if record.get("script_id") != current_id:
+                    raise ArchiveError(f"Line {line_number}: version of {record.get('script_id')} "
+                                       f"outside the versions of its script")
+                if current_versions is not None:
+                    current_versions.append(record["version"])
+            elif kind == "end":
+                finish_script()
+                write_pending()
+                return imported, skipped, version_count
+
+    # No footer: the versions of the last script may be incomplete, so that script is left out
+    write_pending()
+    raise ArchiveError(f"{path} is truncated or corrupt: imported {imported} complete scripts "
+                       f"and {version_count} versions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write scripts and versions to an archive")
+    export_parser.add_argument("path", help="archive to write, e.g. scripts.jsonl.gz")
+    export_parser.add_argument("--ids", nargs="+", metavar="ID", help="only these scripts")
+    export_parser.add_argument("--query", help="only scripts whose title or brief contain this text")
+    export_parser.add_argument("--updated-since", metavar="DATE", help="only scripts updated on or after this date")
+    export_parser.add_argument("--updated-until", metavar="DATE", help="only scripts updated on or before this date")
+    export_parser.add_argument("--model", help="only versions generated by this model")
+    export_parser.add_argument("--latest", action="store_true", help="only the latest version of every script")
+
+    import_parser = subparsers.add_parser("import", help="read an archive into the storage")
+    import_parser.add_argument("path", help="archive to read")
+    import_parser.add_argument("--replace", action="store_true",
+                               help="replace existing scripts and their versions instead of skipping them")
+
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument("--backend", choices=["json", "sqlite"], default=STORAGE_BACKEND)
+        subparser.add_argument("--data-dir", default=DATA_DIR)
+        subparser.add_argument("--db", default=SQLITE_DB_PATH)
+    args = parser.parse_args()
+
+    target = storage.open_storage(args.backend, args.data_dir, args.db)
+    started = time.perf_counter()
+    if args.command == "export":
+        scripts, versions = export_archive(target, args.path, args.ids, args.query, args.updated_since,
+                                           args.updated_until, args.model, args.latest)
+        seconds = time.perf_counter() - started
+        print(f"Exported {scripts} scripts and {versions} versions to {args.path} "
+              f"({os.path.getsize(args.path) / 1024 / 1024:.1f} MB) in {seconds:.1f} s", file=sys.stderr)
+        return
+    try:
+        imported, skipped, versions = import_archive(target, args.path, args.replace)
+    except ArchiveError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    seconds = time.perf_counter() - started
+    print(f"Imported {imported} scripts and {versions} versions in {seconds:.1f} s"
+          + (f", skipped {skipped} existing scripts" if skipped else ""), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
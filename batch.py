@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Headless batch generation of script versions, without the Streamlit UI.
+
+Jobs are read from a JSONL file, one job per line:
+
+    {"id": "ep01", "title": "Эпизод 1", "brief": "...", "prompt": "...", "model": "gpt-4o-mini"}
+    {"id": "ep01-v2", "script_id": "20240101120000", "prompt": "...", "versions": "last"}
+
+A job either adds a version to an existing script (``script_id``) or creates a
+new script from ``brief`` and an optional ``title``. Optional fields are
+``model``, ``temperature``, ``versions`` (a list of version numbers, "all" or
+"last"; previous versions sent as context), ``context_mode`` ("full" or "diff")
+and ``system_prompt``. Jobs without an ``id`` are named after their line.
+
+Jobs run concurrently and their results are saved as new versions through the
+same functions as in the app. Progress is recorded next to the job file in
+``<jobs file>.progress.jsonl``; running the same job file again skips the jobs
+that finished and reuses the scripts created by earlier runs:
+
+    python batch.py jobs.jsonl --workers 4
+"""
+import sys
+import json
+import time
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from config import MODELS, DEFAULT_TEMPERATURE, BATCH_MAX_WORKERS
+from metrics import get_metrics, format_summary
+from utils import (
+    SYSTEM_PROMPT,
+    load_scripts,
+    upsert_scripts,
+    list_script_versions,
+    generate_version,
+    new_script_id
+)
+
+
+def load_jobs(jobs_file):
+    """Read and validate the jobs of a JSONL file"""
+    jobs = []
+    with open(jobs_file, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {line_number}: invalid JSON: {e}")
+            job.setdefault("id", f"line-{line_number}")
+            if not job.get("prompt"):
+                raise ValueError(f"Line {line_number}: a job needs a prompt")
+            if not job.get("script_id") and not job.get("brief"):
+                raise ValueError(f"Line {line_number}: a job needs a script_id or a brief")
+            if job.setdefault("model", "gpt-4o") not in MODELS:
+                raise ValueError(f"Line {line_number}: unknown model {job['model']}")
+            if job.setdefault("context_mode", "full") not in ("full", "diff"):
+                raise ValueError(f"Line {line_number}: context_mode must be \"full\" or \"diff\"")
+            jobs.append(job)
+
+    job_ids = [job["id"] for job in jobs]
+    duplicates = sorted({job_id for job_id in job_ids if job_ids.count(job_id) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate job ids: {', '.join(duplicates)}")
+    return jobs
+
+def load_progress(progress_file):
+    """Return the finished job ids and the scripts created by earlier runs"""
+    finished = set()
+    created = {}
+    try:
+        with open(progress_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A line torn by an interrupted run
+                    continue
+                if event["event"] == "created":
+                    created[event["job"]] = event["script_id"]
+                elif event["event"] == "done":
+                    finished.add(event["job"])
+    except FileNotFoundError:
+        pass
+    return finished, created
+
+
+class ProgressLog:
+    """Append-only record of what a batch run has done, safe to write from several threads"""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def write(self, job_id, event, **fields):
+        with self.lock:
+            self.file.write(json.dumps(dict(job=job_id, event=event, **fields), ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def create_scripts(jobs, created, progress):
+    """Create the scripts of jobs that start from a brief and return the scripts by id"""
+    scripts = {script["id"]: script for script in load_scripts()["scripts"]}
+    new_scripts = []
+    for job in jobs:
+        if job.get("script_id"):
+            continue
+        if created.get(job["id"]) in scripts:
+            job["script_id"] = created[job["id"]]
+            continue
+        now = datetime.datetime.now()
+        script_id = new_script_id(scripts)
+        script = {
+            "id": script_id,
+            "title": job.get("title", job["id"]),
+            "brief": job["brief"],
+            "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "updated_at": now.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        scripts[script_id] = script
+        new_scripts.append(job)
+        job["script_id"] = script_id
+
+    if new_scripts:
+        # Merged into the stored list, so scripts saved meanwhile by the app are kept
+        upsert_scripts([scripts[job["script_id"]] for job in new_scripts])
+        for job in new_scripts:
+            progress.write(job["id"], "created", script_id=job["script_id"])
+    return scripts
+
+def context_version_numbers(script_id, versions):
+    """Resolve the ``versions`` field of a job into version numbers"""
+    if not versions:
+        return []
+    numbers = [v["version_number"] for v in list_script_versions(script_id)]
+    if versions == "all":
+        return numbers
+    if versions == "last":
+        return numbers[-1:]
+    return [n for n in versions if n in numbers]
+
+def run_job(job, script):
+    """Generate the version of one job"""
+    return generate_version(
+        script,
+        job["prompt"],
+        job["model"],
+        job.get("temperature", DEFAULT_TEMPERATURE),
+        context_version_numbers(script["id"], job.get("versions")),
+        job.get("system_prompt", SYSTEM_PROMPT),
+        job["context_mode"]
+    )
+
+def run_batch(args):
+    jobs = load_jobs(args.jobs_file)
+    progress_file = args.progress_file or f"{args.jobs_file}.progress.jsonl"
+    finished, created = load_progress(progress_file)
+    pending = [job for job in jobs if job["id"] not in finished]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run "
+          f"with {args.workers} workers", file=sys.stderr)
+
+    progress = ProgressLog(progress_file)
+    totals = {"done": 0, "failed": 0, "output_tokens": 0, "cost": 0.0, "estimated_cost": 0.0}
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="batch")
+    try:
+        scripts = create_scripts(pending, created, progress)
+        missing = [job for job in pending if job["script_id"] not in scripts]
+        for job in missing:
+            print(f"{job['id']}: script {job['script_id']} not found", file=sys.stderr)
+            progress.write(job["id"], "failed", error="script not found")
+            totals["failed"] += 1
+
+        futures = {
+            executor.submit(run_job, job, scripts[job["script_id"]]): job
+            for job in pending if job["script_id"] in scripts
+        }
+        for count, future in enumerate(as_completed(futures), start=totals["failed"] + 1):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"version": None, "error": e, "stats": {}}
+
+            version = result["version"]
+            # The cost and tokens of the saved version, as in the ledger: nothing for a completion cache hit
+            cost = version["cost"] if version else 0.0
+            output_tokens = version["completion_tokens"] if version else 0
+            totals["cost"] += cost
+            totals["estimated_cost"] += result.get("estimated_cost", 0.0)
+            totals["output_tokens"] += output_tokens
+
+            if result["error"] is None and version is not None:
+                totals["done"] += 1
+                progress.write(job["id"], "done", script_id=job["script_id"],
+                               version_number=version["version_number"], cost=cost)
+                print(f"[{count}/{len(pending)}] {job['id']}: script {job['script_id']} "
+                      f"version {version['version_number']}, {output_tokens:,} tokens, "
+                      f"${cost:.4f}", file=sys.stderr)
+            else:
+                totals["failed"] += 1
+                kept = f" (partial version {version['version_number']} kept)" if version else ""
+                progress.write(job["id"], "failed", script_id=job["script_id"], error=str(result["error"]))
+                print(f"[{count}/{len(pending)}] {job['id']} failed: {result['error']}{kept}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrupted; jobs in progress finish, run the same command again to resume", file=sys.stderr)
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise SystemExit(130)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        progress.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\nDone: {totals['done']}, failed: {totals['failed']}, in {elapsed:.1f} s")
+    if elapsed > 0:
+        print(f"Throughput: {totals['done'] / elapsed * 60:.1f} jobs/min, "
+              f"{totals['output_tokens'] / elapsed:,.0f} output tokens/s")
+    print(f"Cost: ${totals['cost']:.4f} (estimated before the run: ${totals['estimated_cost']:.4f})")
+    if args.timings:
+        print(f"\nTimings (s):\n{format_summary(get_metrics())}")
+    return 1 if totals["failed"] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs_file", help="JSONL file with one job per line")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="jobs run at the same time")
+    parser.add_argument("--timings", action="store_true",
+                        help="print a summary of API latency and generation phase timings at the end")
+    parser.add_argument("--progress-file", help="where progress is recorded (default: <jobs file>.progress.jsonl)")
+    args = parser.parse_args()
+    try:
+        sys.exit(run_batch(args))
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the Audio Story Script Generator.
+
+Storage benchmark: builds a synthetic corpus for each storage backend in a
+temporary directory and times the operations the app performs:
+
+    python benchmark.py storage --scripts 10000 --versions 3
+
+Rerun benchmark: opens a script with many versions in app.py through
+Streamlit's AppTest and times full reruns of the page:
+
+    python benchmark.py rerun --versions 80
+
+Suite: times the functions that run on every rerun (token counting, prompt
+assembly, loading and saving scripts and versions) on synthetic corpora of
+several sizes and reports latency percentiles and peak memory. Results can be
+saved as a baseline and later runs compared against it:
+
+    python benchmark.py suite --save-baseline benchmarks/baseline.json
+    python benchmark.py suite --compare benchmarks/baseline.json
+
+The suite runs offline once the tiktoken encodings are in the local cache.
+A baseline is only meaningful on the host it was measured on: save it there
+from the commit to compare against, with the same preset and backends.
+
+Archive benchmark: exports a synthetic corpus of each storage backend with
+archive.py and imports it into an empty directory, reporting throughput and
+peak memory:
+
+    python benchmark.py archive --scripts 10000 --versions 3
+
+Startup benchmark: times the steps of a cold start, each in a fresh Python
+process: the checks of run.py, importing utils and the first token count, next
+to importing the packages the way run.py used to check them:
+
+    python benchmark.py startup --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+import storage
+import tokenizer_cache
+
+
+def percentile(samples, fraction):
+    """Return the given percentile (0..1) of a list of samples"""
+    ordered = sorted(samples)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def measure(operation, repeat):
+    """Run an operation ``repeat`` times and return its latencies in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        operation()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+def synthetic_text(rng, length):
+    """Build a script-like text of roughly ``length`` characters"""
+    words = ["НАРРАТОР:", "АННА:", "ИВАН:", "[ЗВУК: дождь]", "[МУЗЫКА: тихо]",
+             "тишина", "шаги", "дверь", "ночь", "голос", "город", "письмо", "вдруг", "медленно"]
+    lines = []
+    size = 0
+    while size < length:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(4, 14)))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+def edited_text(rng, text, edits):
+    """Return a copy of a text with ``edits`` of its lines rewritten, like a revised version"""
+    lines = text.split("\n")
+    for _ in range(edits):
+        lines[rng.randrange(len(lines))] = synthetic_text(rng, 60)
+    return "\n".join(lines)
+
+def synthetic_script(i):
+    return {
+        "id": f"{20240101000000 + i}",
+        "title": f"Сценарий {i}",
+        "brief": f"Краткое описание сценария {i}",
+        "created_at": "2024-01-01 00:00:00",
+        "updated_at": "2024-01-01 00:00:00"
+    }
+
+def synthetic_version(rng, number, content_length):
+    return {
+        "timestamp": f"2024-01-01 00:00:{number % 60:02d}",
+        "model": "gpt-4o-mini",
+        "temperature": 0.7,
+        "prompt": f"Запрос для версии {number}",
+        "content": synthetic_text(rng, content_length),
+        "input_tokens": 1000 + number,
+        "estimated_cost": 0.001,
+        "context": ["Brief Summary", "Current Request"],
+        "version_number": number
+    }
+
+def build_storage_corpus(backend, directory, scripts, versions, content_length, seed=0):
+    """Fill a backend with a synthetic corpus and return the list of script ids"""
+    rng = random.Random(seed)
+    # Building the corpus is not what is measured, so skip fsync while doing it
+    fsync = storage.VERSION_LOG_FSYNC
+    storage.VERSION_LOG_FSYNC = False
+    try:
+        target = storage.open_storage(backend, directory, os.path.join(directory, "author.db"))
+        script_list = [synthetic_script(i) for i in range(scripts)]
+        target.save_scripts({"scripts": script_list})
+        for script in script_list if versions else ():
+            target.write_versions(
+                script["id"],
+                [synthetic_version(rng, n, content_length) for n in range(1, versions + 1)]
+            )
+    finally:
+        storage.VERSION_LOG_FSYNC = fsync
+    return [script["id"] for script in script_list]
+
+def bench_storage(args):
+    """Compare open/save/append/list/read latencies of the storage backends"""
+    rng = random.Random(1)
+    results = {}
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory(prefix=f"bench_{backend}_") as directory:
+            print(f"Building {backend} corpus: {args.scripts:,} scripts x {args.versions} versions...",
+                  file=sys.stderr)
+            script_ids = build_storage_corpus(backend, directory, args.scripts, args.versions,
+                                              args.content_length)
+            target = storage.open_storage(backend, directory, os.path.join(directory, "author.db"))
+            next_number = {script_id: args.versions + 1 for script_id in script_ids}
+
+            def save():
+                scripts_data = target.load_scripts()
+                scripts_data["scripts"][0]["title"] = f"Сценарий {rng.random()}"
+                target.save_scripts(scripts_data)
+
+            def append():
+                script_id = rng.choice(script_ids)
+                target.append_version(script_id,
+                                      synthetic_version(rng, next_number[script_id], args.content_length))
+                next_number[script_id] += 1
+
+            operations = {
+                "open (load_scripts)": target.load_scripts,
+                "save (load + save_scripts)": save,
+                "append version": append,
+                "list versions": lambda: target.list_versions(rng.choice(script_ids)),
+                "read one version": lambda: target.read_version(rng.choice(script_ids), 1),
+                "load all versions": lambda: target.load_versions(rng.choice(script_ids)),
+            }
+            results[backend] = {name: measure(operation, args.repeat) for name, operation in operations.items()}
+
+    print(f"\n{args.scripts:,} scripts, {args.versions} versions each, "
+          f"~{args.content_length:,} chars per version, {args.repeat} runs (ms)")
+    print(f"{'operation':<28}" + "".join(f"{backend + ' p50':>14}{backend + ' p95':>14}" for backend in results))
+    for name in next(iter(results.values())):
+        row = f"{name:<28}"
+        for backend in results:
+            samples = results[backend][name]
+            row += f"{statistics.median(samples):>14.2f}{percentile(samples, 0.95):>14.2f}"
+        print(row)
+
+def pin_index_selectboxes(app):
+    """Work around AppTest losing the value of selectboxes that show indices through format_func
+
+    AppTest sends the formatted options but looks the raw value up among them,
+    which fails for the version browser; selecting the current index explicitly
+    makes the next run send it unchanged.
+    """
+    for selectbox in app.selectbox:
+        try:
+            selectbox.index
+        except ValueError:
+            selectbox.select_index(app.session_state[selectbox.id] if selectbox.id in app.session_state else 0)
+
+def bench_rerun(args):
+    """Time full reruns of app.py with one script of many versions open
+
+    The app runs in a child process started with AUTHOR_DATA_DIR set to a
+    temporary directory, so every path config derives from the data directory
+    (jobs, ledger, caches, output predictor) points there and not at data/.
+    """
+    if args.data_dir is None:
+        rng = random.Random(2)
+        with tempfile.TemporaryDirectory(prefix="bench_rerun_") as directory:
+            target = storage.JsonStorage(directory)
+            script = synthetic_script(0)
+            target.save_scripts({"scripts": [script]})
+            target.write_versions(
+                script["id"],
+                [synthetic_version(rng, n, args.content_length) for n in range(1, args.versions + 1)]
+            )
+            command = [sys.executable, os.path.abspath(__file__), "rerun", "--versions", str(args.versions),
+                       "--content-length", str(args.content_length), "--repeat", str(args.repeat),
+                       "--data-dir", directory]
+            result = subprocess.run(command, env=dict(os.environ, AUTHOR_DATA_DIR=directory))
+        sys.exit(result.returncode)
+
+    import config
+    from streamlit.testing.v1 import AppTest
+    if os.path.abspath(config.DATA_DIR) != os.path.abspath(args.data_dir):
+        sys.exit(f"AUTHOR_DATA_DIR must be {args.data_dir}, the app would use {config.DATA_DIR}")
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    app = AppTest.from_file(app_path, default_timeout=120)
+    app.secrets["openai"] = {"api_key": "benchmark"}
+    app.run()
+    app.sidebar.button(key=f"btn_{synthetic_script(0)['id']}").click().run()
+
+    def rerun():
+        pin_index_selectboxes(app)
+        app.run()
+    samples = measure(rerun, args.repeat)
+
+    print(f"\n{args.versions} versions of ~{args.content_length:,} chars, {args.repeat} reruns (ms)")
+    print(f"p50 {statistics.median(samples):.1f}   p95 {percentile(samples, 0.95):.1f}   max {max(samples):.1f}")
+
+
+# Rough size of a token of the synthetic texts, used to build contents of a given token count
+CHARS_PER_TOKEN = 4
+
+# Corpus sizes of the suite: scripts in scripts.json, versions of one script and tokens per content
+SUITE_PRESETS = {
+    "full": {"scripts": [10, 1000, 10000], "versions": [1, 50, 500], "tokens": [1000, 10000, 50000]},
+    "quick": {"scripts": [10, 1000], "versions": [1, 50], "tokens": [1000, 10000]},
+}
+
+# Content size of every version in the version load/save cases
+SUITE_VERSION_TOKENS = 1000
+
+def peak_memory(operation):
+    """Run an operation once and return the peak memory it allocated, in bytes"""
+    tracemalloc.start()
+    try:
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def suite_cases(preset, backends, model):
+    """Yield (name, operation) for every case of the suite
+
+    The corpus of a case exists only until the next case is requested.
+    """
+    rng = random.Random(3)
+    for backend in backends:
+        for scripts in preset["scripts"]:
+            with tempfile.TemporaryDirectory(prefix=f"bench_{backend}_") as directory:
+                build_storage_corpus(backend, directory, scripts, 0, 0)
+                target = storage.open_storage(backend, directory, os.path.join(directory, "author.db"))
+                yield f"load_scripts [{backend}, {scripts:,} scripts]", target.load_scripts
+
+        for versions in preset["versions"]:
+            with tempfile.TemporaryDirectory(prefix=f"bench_{backend}_") as directory:
+                build_storage_corpus(backend, directory, 1, versions, SUITE_VERSION_TOKENS * CHARS_PER_TOKEN)
+                target = storage.open_storage(backend, directory, os.path.join(directory, "author.db"))
+                script_id = synthetic_script(0)["id"]
+                yield (f"load_script_versions [{backend}, {versions:,} versions]",
+                       lambda: target.load_versions(script_id))
+                corpus = target.load_versions(script_id)
+                yield (f"save_script_versions [{backend}, {versions:,} versions]",
+                       lambda: target.write_versions(script_id, corpus))
+
+    # utils needs tiktoken and the app's other dependencies, so it is only imported for these cases
+    import utils
+
+    for tokens in preset["tokens"]:
+        text = synthetic_text(rng, tokens * CHARS_PER_TOKEN)
+
+        def count_cold():
+            utils._token_count_cache.clear()
+            utils.count_tokens(text, model)
+
+        yield f"count_tokens cold [~{tokens:,} tokens]", count_cold
+        utils.count_tokens(text, model)
+        yield f"count_tokens cached [~{tokens:,} tokens]", lambda: utils.count_tokens(text, model)
+
+        # Three selected versions, each a revision of the one before
+        versions = []
+        content = text
+        for number in range(1, 4):
+            versions.append(dict(synthetic_version(rng, number, 0), content=content))
+            content = edited_text(rng, content, 5)
+
+        yield (f"get_context_parts [3 x ~{tokens:,} tokens]",
+               lambda: utils.get_context_parts("Краткое описание", versions, "Запрос"))
+
+        def diff_parts():
+            utils.version_diff.cache_clear()
+            utils.get_context_parts("Краткое описание", versions, "Запрос", "diff")
+
+        yield f"get_context_parts diff [3 x ~{tokens:,} tokens]", diff_parts
+        yield (f"create_message_from_context [3 x ~{tokens:,} tokens]",
+               lambda: utils.create_message_from_context(utils.SYSTEM_PROMPT, "Краткое описание",
+                                                         versions, "Запрос"))
+
+def bench_suite(args):
+    """Run the suite, print its results and optionally save or compare them with a baseline"""
+    results = {}
+    print(f"{'case':<52}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'peak KB':>12}   (ms)")
+    for name, operation in suite_cases(SUITE_PRESETS[args.preset], args.backends, args.model):
+        for _ in range(args.warmup):
+            operation()
+        samples = measure(operation, args.repeat)
+        result = {
+            "p50": statistics.median(samples),
+            "p95": percentile(samples, 0.95),
+            "p99": percentile(samples, 0.99),
+            "max": max(samples),
+            "peak_kb": peak_memory(operation) / 1024
+        }
+        results[name] = result
+        print(f"{name:<52}{result['p50']:>10.2f}{result['p95']:>10.2f}{result['p99']:>10.2f}"
+              f"{result['max']:>10.2f}{result['peak_kb']:>12,.0f}")
+
+    if args.save_baseline:
+        baseline = {
+            "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "preset": args.preset,
+            "backends": args.backends,
+            "model": args.model,
+            "tiktoken": tokenizer_cache.installed_tiktoken_version(),
+            "repeat": args.repeat,
+            "results": results
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=4)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} ({baseline['created_at']}, Python {baseline['python']}), "
+              f"p50 and peak memory, changes beyond {args.threshold:.0%} are flagged")
+        # Timings are only comparable on the same host and with the same settings
+        for key, current in (("platform", platform.platform()), ("python", platform.python_version()),
+                             ("tiktoken", tokenizer_cache.installed_tiktoken_version()),
+                             ("model", args.model), ("repeat", args.repeat)):
+            if key in baseline and baseline[key] != current:
+                print(f"Warning: the baseline was measured with {key} {baseline[key]}, this run with {current}")
+        print(f"{'case':<52}{'base p50':>10}{'p50':>10}{'change':>9}{'base KB':>12}{'KB':>12}")
+        regressions = 0
+        for name, result in results.items():
+            base = baseline["results"].get(name)
+            if base is None:
+                print(f"{name:<52}{'—':>10}{result['p50']:>10.2f}")
+                continue
+            change = result["p50"] / base["p50"] - 1 if base["p50"] else 0.0
+            memory_change = result["peak_kb"] / base["peak_kb"] - 1 if base["peak_kb"] else 0.0
+            flag = ""
+            if change > args.threshold or memory_change > args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif change < -args.threshold:
+                flag = "  faster"
+            print(f"{name:<52}{base['p50']:>10.2f}{result['p50']:>10.2f}{change:>+9.0%}"
+                  f"{base['peak_kb']:>12,.0f}{result['peak_kb']:>12,.0f}{flag}")
+        if regressions:
+            print(f"\n{regressions} case(s) regressed")
+            sys.exit(1)
+
+
+def bench_archive(args):
+    """Time export and import of a whole corpus with archive.py and measure their peak memory"""
+    import archive
+
+    print(f"{'case':<40}{'seconds':>10}{'scripts/s':>12}{'versions/s':>12}{'gz MB/s':>10}{'peak KB':>12}")
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory(prefix=f"bench_{backend}_") as directory:
+            print(f"Building {backend} corpus: {args.scripts:,} scripts x {args.versions} versions...",
+                  file=sys.stderr)
+            source_dir = os.path.join(directory, "source")
+            build_storage_corpus(backend, source_dir, args.scripts, args.versions, args.content_length)
+            source = storage.open_storage(backend, source_dir, os.path.join(source_dir, "author.db"))
+            path = os.path.join(directory, "archive.jsonl.gz")
+            targets = iter(range(4))
+
+            def import_into_new_directory():
+                target_dir = os.path.join(directory, f"target{next(targets)}")
+                target = storage.open_storage(backend, target_dir, os.path.join(target_dir, "author.db"))
+                archive.import_archive(target, path)
+
+            cases = (("export", lambda: archive.export_archive(source, path)),
+                     ("import", import_into_new_directory))
+            for name, operation in cases:
+                started = time.perf_counter()
+                operation()
+                seconds = time.perf_counter() - started
+                peak_kb = peak_memory(operation) / 1024
+                megabytes = os.path.getsize(path) / 1024 / 1024
+                print(f"{f'{name} [{backend}, {args.scripts:,} scripts]':<40}{seconds:>10.2f}"
+                      f"{args.scripts / seconds:>12,.0f}{args.scripts * args.versions / seconds:>12,.0f}"
+                      f"{megabytes / seconds:>10.1f}{peak_kb:>12,.0f}")
+            print(f"archive: {os.path.getsize(path) / 1024 / 1024:.1f} MB compressed", file=sys.stderr)
+
+# Steps of a cold start: name -> code run in a fresh interpreter
+STARTUP_CASES = {
+    "python (empty)": "pass",
+    "run.check_requirements (package metadata)": "import run; run.check_requirements()",
+    "tokenizer_cache.missing_models": "import tokenizer_cache; tokenizer_cache.missing_models()",
+    "import streamlit, tiktoken, pandas (old check)": "import streamlit, tiktoken, pandas",
+    "import utils": "import utils",
+    "import utils + first count_tokens": "import utils; utils.count_tokens('Первый подсчет токенов', 'gpt-4o')",
+}
+
+def bench_startup(args):
+    """Time the steps of a cold start, each in a fresh Python process"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'case':<52}{'p50':>10}{'max':>10}   (ms, whole process)")
+    for name, code in STARTUP_CASES.items():
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = subprocess.run([sys.executable, "-c", code], cwd=directory, capture_output=True, text=True)
+            samples.append((time.perf_counter() - started) * 1000)
+            if result.returncode != 0:
+                print(f"{name:<52}failed: {result.stderr.strip().splitlines()[-1]}")
+                break
+        else:
+            print(f"{name:<52}{statistics.median(samples):>10.0f}{max(samples):>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    storage_parser = subparsers.add_parser("storage", help="compare the storage backends")
+    storage_parser.add_argument("--scripts", type=int, default=10000)
+    storage_parser.add_argument("--versions", type=int, default=3)
+    storage_parser.add_argument("--content-length", type=int, default=2000)
+    storage_parser.add_argument("--repeat", type=int, default=20)
+    storage_parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    storage_parser.set_defaults(func=bench_storage)
+
+    rerun_parser = subparsers.add_parser("rerun", help="time reruns of app.py with many versions")
+    rerun_parser.add_argument("--versions", type=int, default=80)
+    rerun_parser.add_argument("--content-length", type=int, default=20000)
+    rerun_parser.add_argument("--repeat", type=int, default=10)
+    # Set by bench_rerun for the child process that runs the app on the prepared directory
+    rerun_parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    rerun_parser.set_defaults(func=bench_rerun)
+
+    suite_parser = subparsers.add_parser("suite", help="time the per-rerun hot paths on synthetic corpora")
+    suite_parser.add_argument("--preset", choices=sorted(SUITE_PRESETS), default="full")
+    suite_parser.add_argument("--backends", nargs="+", default=["json"])
+    suite_parser.add_argument("--model", default="gpt-4o", help="model whose encoding counts the tokens")
+    suite_parser.add_argument("--repeat", type=int, default=20)
+    suite_parser.add_argument("--warmup", type=int, default=2)
+    suite_parser.add_argument("--save-baseline", metavar="FILE", help="save the results as a baseline")
+    suite_parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    suite_parser.add_argument("--threshold", type=float, default=0.1,
+                              help="relative change of p50 or peak memory reported as a regression")
+    suite_parser.set_defaults(func=bench_suite)
+
+    archive_parser = subparsers.add_parser("archive", help="time bulk export and import of a corpus")
+    archive_parser.add_argument("--scripts", type=int, default=10000)
+    archive_parser.add_argument("--versions", type=int, default=3)
+    archive_parser.add_argument("--content-length", type=int, default=2000)
+    archive_parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    archive_parser.set_defaults(func=bench_archive)
+
+    startup_parser = subparsers.add_parser("startup", help="time the steps of a cold start in fresh processes")
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Content-addressed on-disk cache of chat completions.
+
+A completion is stored under the SHA-256 of its model, messages and temperature,
+so an identical request returns the stored answer instantly instead of calling
+the API again. The cache is size-bounded: when it grows past its limit the least
+recently used entries are evicted. Hit and miss counters are kept per process.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+from config import COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES
+from locking import atomic_write
+
+
+def completion_key(model, messages, temperature):
+    """Return the cache key of a chat completion request"""
+    request = {"model": model, "messages": messages, "temperature": temperature}
+    encoded = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Size-bounded LRU cache of completions, one JSON file per entry"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        """Return (mtime, size, path) of every cache entry"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        """Return the cached completion for a key, or None, and count the hit or miss"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # The modification time doubles as the last-used time for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def count_bypass(self):
+        """Count a request that skipped the cache lookup on purpose"""
+        with self._lock:
+            self.bypassed += 1
+
+    def put(self, key, entry):
+        """Store a completion and evict the least recently used entries if over the size limit"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(dict(entry, cached_at=time.time()), ensure_ascii=False).encode("utf-8")
+        # A refreshed entry replaces the old file, whose size no longer counts
+        try:
+            replaced_bytes = os.stat(path).st_size
+        except OSError:
+            replaced_bytes = 0
+        atomic_write(path, data)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += len(data) - replaced_bytes
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete the oldest entries until the cache is back under 90% of its limit"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+    def stats(self):
+        """Return the hit, miss and bypass counters of this process"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed}
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+    """Return the process-wide completion cache"""
+    global _completion_cache
+    if _completion_cache is None:
+        with _completion_cache_lock:
+            if _completion_cache is None:
+                _completion_cache = CompletionCache(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES)
+    return _completion_cache
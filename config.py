@@ -1,4 +1,5 @@
 # App configuration settings
+import os
 
 # App description
 APP_TITLE = "Audio Story Script Generator"
@@ -20,25 +21,44 @@ The input you receive will be structured as follows:
 Your response should be a complete script that addresses the current request while staying true to the brief summary.
 """
 
+# OpenAI-compatible API endpoint (set OPENAI_BASE_URL to point at a local stand-in for testing)
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# HTTP client settings for API calls
+HTTP_CONNECT_TIMEOUT = 10  # seconds to establish a connection
+HTTP_READ_TIMEOUT = 120    # seconds to wait between bytes of a response
+HTTP_POOL_SIZE = 20        # keep-alive connections shared by all sessions
+HTTP_MAX_RETRIES = 4       # retries on connection errors, 429 and 5xx
+HTTP_BACKOFF_BASE = 1.0    # seconds, doubled on every retry
+HTTP_BACKOFF_MAX = 30.0    # upper bound of a single backoff delay
+HTTP_RETRY_AFTER_MAX = 60.0  # longest Retry-After to wait for; a longer one fails the request
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
 # OpenAI models configuration
 MODELS = {
     "gpt-4o": {
         "quality": 100,
         "context_window": 128000,
         "input_cost": 5.0,  # per 1M tokens
+        "cached_input_cost": 2.5,  # per 1M prompt tokens served from the API prompt cache
         "output_cost": 15.0,  # per 1M tokens
+        "max_output_tokens": 16384,
     },
     "gpt-4o-2024-08-06": {
         "quality": 100,
         "context_window": 128000,
         "input_cost": 2.5,  # per 1M tokens
+        "cached_input_cost": 1.25,  # per 1M prompt tokens served from the API prompt cache
         "output_cost": 10.0,  # per 1M tokens
+        "max_output_tokens": 16384,
     },
     "gpt-4o-mini": {
         "quality": 85,
         "context_window": 128000,
         "input_cost": 0.15,  # per 1M tokens
+        "cached_input_cost": 0.075,  # per 1M prompt tokens served from the API prompt cache
         "output_cost": 0.6,  # per 1M tokens
+        "max_output_tokens": 16384,
     }
 }
 
@@ -57,6 +77,71 @@ RATE_LIMITS = {
     }
 }
 
+# Client-side enforcement of RATE_LIMITS
+# Set to a file path (e.g. "data/rate_limits.json") to share the limits between server processes
+RATE_LIMIT_STATE_FILE = None
+# Longest time in seconds a request may wait in the queue before it is rejected
+RATE_LIMIT_MAX_WAIT = 600
+
+# Number of token counts memoized in memory (keyed by content hash)
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# Directory of the tiktoken encoding files (TIKTOKEN_CACHE_DIR overrides it). Fill it once with
+# "python tokenizer_cache.py prewarm" on a host with network access and ship it with the app,
+# so token counting never downloads anything
+TIKTOKEN_CACHE_DIR = os.environ.get("TIKTOKEN_CACHE_DIR",
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache"))
+
+# Directory where scripts and their versions are stored (AUTHOR_DATA_DIR overrides it)
+DATA_DIR = os.environ.get("AUTHOR_DATA_DIR", "data")
+
+# Storage backend for scripts and versions: "json" (flat files in DATA_DIR) or "sqlite"
+# Run "python storage.py import-sqlite" once to copy existing data into the database
+STORAGE_BACKEND = "json"
+SQLITE_DB_PATH = os.path.join(DATA_DIR, "author.db")
+
+# Number of version contents kept in memory, shared by all sessions.
+# Sessions themselves only hold version metadata and load content on demand.
+VERSION_CONTENT_CACHE_SIZE = 64
+
+# Flush every appended version to disk with fsync before reporting it as saved
+VERSION_LOG_FSYNC = True
+
+# Version logs of the json backend store a compressed full snapshot every
+# VERSION_KEYFRAME_INTERVAL versions and compressed line deltas against that snapshot in between.
+# Set VERSION_COMPRESSION = False to write plain records; both formats are always readable.
+VERSION_COMPRESSION = True
+VERSION_KEYFRAME_INTERVAL = 10
+VERSION_SNAPSHOT_CACHE_SIZE = 32  # decoded snapshots kept in memory to rebuild versions from deltas
+
+# Bulk export and import of scripts and versions (archive.py): gzip level of written archives
+# (1 fastest, 9 smallest) and scripts merged into the stored list per write during import
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_IMPORT_BATCH_SIZE = 500
+
+# Append-only ledger of the actual usage and cost of every saved generation, and its running
+# totals per day, model and script. With LEDGER_ENFORCE_TPD a generation is refused once the
+# tokens recorded today for its model would exceed the model's TPD in RATE_LIMITS.
+LEDGER_FILE = os.path.join(DATA_DIR, "ledger.jsonl")
+LEDGER_TOTALS_FILE = os.path.join(DATA_DIR, "ledger_totals.json")
+LEDGER_ENFORCE_TPD = False
+
+# Output length predicted from the stored versions (output_predictor.py). A model needs
+# OUTPUT_PREDICTOR_MIN_SAMPLES versions before its own fit is used (until then the fit over all
+# models, then the brief-based estimate below). The interval spans OUTPUT_PREDICTION_Z standard
+# deviations (1.645: 90%), and with MAX_TOKENS_ENABLED requests are capped at MAX_TOKENS_MARGIN
+# times its upper end, so a runaway answer cannot run on for minutes
+OUTPUT_PREDICTOR_FILE = os.path.join(DATA_DIR, "output_predictor.json")
+OUTPUT_PREDICTOR_MIN_SAMPLES = 20
+OUTPUT_PREDICTION_Z = 1.645
+MAX_TOKENS_ENABLED = True
+MAX_TOKENS_MARGIN = 1.5
+
+# On-disk cache of completions keyed by model, messages and temperature (opt-in)
+COMPLETION_CACHE_ENABLED = False
+COMPLETION_CACHE_DIR = os.path.join(DATA_DIR, "completion_cache")
+COMPLETION_CACHE_MAX_BYTES = 200 * 1024 * 1024  # least recently used entries are evicted beyond this
+
 # Output estimation factor (how many tokens to expect in output compared to brief length)
 OUTPUT_ESTIMATION_FACTOR = 5
 
@@ -64,4 +149,51 @@ OUTPUT_ESTIMATION_FACTOR = 5
 MIN_OUTPUT_TOKENS = 1000
 
 # Default temperature for generation
-DEFAULT_TEMPERATURE = 0.7 
\ No newline at end of file
+DEFAULT_TEMPERATURE = 0.7 
+
+# Unchanged lines kept around each change when previous versions are sent as diffs
+DIFF_CONTEXT_LINES = 1
+
+# Order of the messages of a request. "cache" sends the parts that change least first (system
+# prompt, previous versions, brief, then the request) with normalized whitespace, so consecutive
+# requests share a long identical prefix that the API serves from its prompt cache at a discount.
+# "classic" sends the brief before the previous versions and the texts exactly as typed
+PROMPT_LAYOUT = "cache"
+
+# Automatic context packing: previous versions sent at most, and the smallest part of a version
+# worth sending when it has to be cut at a scene boundary to fit the budget
+PACK_MAX_VERSIONS = 3
+PACK_MIN_TRUNCATED_TOKENS = 500
+
+# Number of versions per page in the context selection table
+VERSION_TABLE_PAGE_SIZE = 10
+
+# Number of scripts per page in the sidebar list
+SCRIPT_LIST_PAGE_SIZE = 20
+
+# Multi-variant generation: requests sent at the same time and the temperatures offered
+MAX_PARALLEL_VARIANTS = 4
+VARIANT_TEMPERATURES = [0.0, 0.3, 0.5, 0.7, 1.0]
+
+# Jobs run at the same time by the batch command line tool (batch.py)
+BATCH_MAX_WORKERS = 4
+
+# Background generation jobs: workers shared by all sessions, where job records are kept,
+# how often the job panel refreshes (seconds) and how many recent jobs of a script it shows
+JOB_MAX_WORKERS = 4
+JOB_DIR = os.path.join(DATA_DIR, "jobs")
+JOB_POLL_INTERVAL = 1.0
+JOB_PANEL_SIZE = 10
+# Every process refreshes the heartbeat of its active jobs every JOB_HEARTBEAT_INTERVAL seconds;
+# another process takes over a job whose owner is gone or silent for JOB_LEASE_SECONDS.
+# Finished job records are deleted after JOB_RETENTION_DAYS
+JOB_HEARTBEAT_INTERVAL = 15
+JOB_LEASE_SECONDS = 120
+JOB_RETENTION_DAYS = 7
+
+# Timing metrics of API requests, generation phases, storage and page reruns.
+# Set METRICS_LOG_FILE (e.g. os.path.join(DATA_DIR, "metrics.jsonl")) to append every measurement
+# as a JSON line, and METRICS_PORT (or AUTHOR_METRICS_PORT) to serve them for Prometheus on /metrics
+METRICS_LOG_FILE = None
+METRICS_PORT = int(os.environ.get("AUTHOR_METRICS_PORT", 0)) or None
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
@@ -0,0 +1,326 @@
+"""
+Background generation jobs shared by all sessions of the process.
+
+A job generates one new version of a script on a process-wide worker pool, so
+the Streamlit session that submitted it is not blocked and the result is saved
+to the script's versions even if the session goes away. Every job has a record
+in config.JOB_DIR with its status:
+
+    queued -> running -> done | failed | cancelled
+
+Queued and running jobs can be cancelled. Several processes may share the
+job directory: every record names the process that owns it, which refreshes a
+heartbeat in it while the job is active. When the owner is gone (its pid no
+longer exists on this host, or its heartbeat is older than
+config.JOB_LEASE_SECONDS), another process claims the job under a file lock:
+a queued job is run again and a running one is marked as failed. A process
+only writes the records it owns. Finished records are deleted after
+config.JOB_RETENTION_DAYS.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import JOB_DIR, JOB_MAX_WORKERS, JOB_HEARTBEAT_INTERVAL, JOB_LEASE_SECONDS, JOB_RETENTION_DAYS
+from locking import atomic_write, file_lock
+from utils import generate_version, GenerationCancelled
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+class JobManager:
+    """Worker pool running generation jobs, with their records kept on disk"""
+
+    def __init__(self, directory, max_workers):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = os.path.join(directory, "jobs.lock")
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid(), "instance": uuid.uuid4().hex}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        # Guards the records in memory; never held while waiting for another lock
+        self._lock = threading.Lock()
+        # Serializes the writes of this process, so a record on disk is never older than an earlier write
+        self._write_lock = threading.Lock()
+        self._jobs = {}
+        self._futures = {}
+        self._cancel_events = {}
+        # job id -> content received so far, kept in memory only while the job runs
+        self._partial = {}
+
+        self._scan()
+        threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _read(self, job_id):
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _owns(self, job):
+        return (job.get("owner") or {}).get("instance") == self.owner["instance"]
+
+    def _is_orphaned(self, job):
+        """Whether the process owning an active job is gone"""
+        owner = job.get("owner")
+        if not owner:
+            # Written before jobs had owners
+            return True
+        if owner.get("host") == self.owner["host"] and os.name == "posix" and not _pid_alive(owner["pid"]):
+            return True
+        return time.time() - job.get("heartbeat", 0) > JOB_LEASE_SECONDS
+
+    def _save(self, job):
+        """Write a record of this process; returns False if another process has claimed the job"""
+        with file_lock(self.lock_file):
+            stored = self._read(job["id"])
+            if stored is not None and not self._owns(stored):
+                return False
+            atomic_write(self._path(job["id"]), json.dumps(job, ensure_ascii=False, indent=4).encode("utf-8"))
+        return True
+
+    def _update(self, job_id, **fields):
+        with self._write_lock:
+            with self._lock:
+                job = self._jobs[job_id]
+                job.update(fields)
+                job = dict(job)
+            if not self._save(job):
+                # Taken over after this process missed its heartbeats: stop the job here
+                event = self._cancel_events.get(job_id)
+                if event is not None:
+                    event.set()
+
+    def _claim(self, job_id):
+        """Take over an active job whose owner is gone: run it again if queued, fail it if running"""
+        with file_lock(self.lock_file):
+            job = self._read(job_id)
+            if job is None or job["status"] not in ACTIVE_STATUSES or not self._is_orphaned(job):
+                return job
+            job["owner"] = self.owner
+            job["heartbeat"] = time.time()
+            if job["status"] == "running":
+                job.update(status="failed", error="Interrupted by an application restart", finished_at=_now())
+            atomic_write(self._path(job_id), json.dumps(job, ensure_ascii=False, indent=4).encode("utf-8"))
+        with self._lock:
+            self._jobs[job_id] = job
+        if job["status"] == "queued":
+            self._start(job_id)
+        return job
+
+    def _scan(self):
+        """Load the records of other processes, claim orphaned jobs and delete old finished records"""
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=JOB_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        seen = set()
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            job = self._read(name[:-len(".json")])
+            if job is None:
+                continue
+            job_id = job["id"]
+            seen.add(job_id)
+            if job["status"] not in ACTIVE_STATUSES:
+                if (job.get("finished_at") or job["created_at"]) < cutoff:
+                    try:
+                        os.remove(self._path(job_id))
+                    except FileNotFoundError:
+                        pass
+                    seen.discard(job_id)
+                    continue
+            elif self._owns(job):
+                # The record in memory is the current one
+                continue
+            elif self._is_orphaned(job):
+                job = self._claim(job_id) or job
+            with self._lock:
+                if not (job_id in self._jobs and self._owns(self._jobs[job_id])
+                        and self._jobs[job_id]["status"] in ACTIVE_STATUSES):
+                    self._jobs[job_id] = job
+        with self._lock:
+            # Records deleted by another process; active jobs of this one may be newer than the listing
+            for job_id in [job_id for job_id, job in self._jobs.items() if job_id not in seen
+                           and not (self._owns(job) and job["status"] in ACTIVE_STATUSES)]:
+                del self._jobs[job_id]
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                with self._lock:
+                    active = [job_id for job_id, job in self._jobs.items()
+                              if self._owns(job) and job["status"] in ACTIVE_STATUSES]
+                for job_id in active:
+                    self._update(job_id, heartbeat=time.time())
+                self._scan()
+            except Exception:
+                # A failed round is retried with the next heartbeat
+                pass
+
+    def _start(self, job_id):
+        self._cancel_events[job_id] = threading.Event()
+        self._futures[job_id] = self._executor.submit(self._run, job_id)
+
+    def submit(self, script, prompt, model, temperature, version_numbers=(), system_prompt=None,
+               context_mode="full", use_cache=None, refresh_cache=False, version_token_limits=None):
+        """Queue the generation of a new version of a script and return the job id
+
+        The brief of ``script`` is captured at submission, so later edits in
+        the session do not change the job. ``version_token_limits`` are the
+        previous versions cut to fit by utils.pack_context.
+        """
+        job_id = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "script_id": script["id"],
+            "script_title": script.get("title", ""),
+            "brief": script["brief"],
+            "prompt": prompt,
+            "model": model,
+            "temperature": temperature,
+            "version_numbers": sorted(version_numbers),
+            "system_prompt": system_prompt,
+            "context_mode": context_mode,
+            "use_cache": use_cache,
+            "refresh_cache": refresh_cache,
+            # JSON object keys are strings, so the version numbers are stored as pairs
+            "version_token_limits": sorted((version_token_limits or {}).items()),
+            "owner": self.owner,
+            "heartbeat": time.time(),
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "version_number": None,
+            "input_tokens": None,
+            "estimated_cost": None,
+            "cost": None,
+            "error": None
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        self._save(dict(job))
+        self._start(job_id)
+        return job_id
+
+    def _run(self, job_id):
+        cancel_event = self._cancel_events[job_id]
+        if cancel_event.is_set():
+            return
+        self._update(job_id, status="running", started_at=_now())
+        job = self.get(job_id)
+        self._partial[job_id] = []
+
+        kwargs = {}
+        if job["system_prompt"] is not None:
+            kwargs["system_prompt"] = job["system_prompt"]
+        try:
+            result = generate_version(
+                {"id": job["script_id"], "brief": job["brief"]},
+                job["prompt"],
+                job["model"],
+                job["temperature"],
+                job["version_numbers"],
+                context_mode=job["context_mode"],
+                use_cache=job["use_cache"],
+                refresh_cache=job["refresh_cache"],
+                version_token_limits=dict(job.get("version_token_limits") or ()),
+                on_delta=self._partial[job_id].append,
+                should_stop=cancel_event.is_set,
+                **kwargs
+            )
+        except Exception as e:
+            self._update(job_id, status="failed", error=str(e), finished_at=_now())
+            return
+        finally:
+            self._partial.pop(job_id, None)
+
+        version = result["version"]
+        if isinstance(result["error"], GenerationCancelled):
+            status = "cancelled"
+        elif result["error"] is not None:
+            # A partial answer is still saved as a version
+            status = "failed"
+        else:
+            status = "done"
+        self._update(
+            job_id,
+            status=status,
+            finished_at=_now(),
+            version_number=version["version_number"] if version else None,
+            input_tokens=result["input_tokens"],
+            estimated_cost=result["estimated_cost"],
+            # The cost of the saved version, as in the ledger: nothing for a completion cache hit
+            cost=version["cost"] if version else None,
+            cache_hit=result["stats"].get("cache_hit", False),
+            timings=result["timings"],
+            error=None if result["error"] is None or status == "cancelled" else str(result["error"])
+        )
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job of this process; a running job stops after its next chunk"""
+        job = self.get(job_id)
+        if job is None or job["status"] not in ACTIVE_STATUSES or job_id not in self._cancel_events:
+            return
+        self._cancel_events[job_id].set()
+        if self._futures[job_id].cancel() or job["status"] == "queued":
+            # The job never started; if it is just starting, _run sees the event and returns
+            self._update(job_id, status="cancelled", finished_at=_now())
+
+    def can_cancel(self, job_id):
+        """Whether a job is active and run by this process, so cancel() can stop it"""
+        job = self.get(job_id)
+        return job is not None and job["status"] in ACTIVE_STATUSES and job_id in self._cancel_events
+
+    def get(self, job_id):
+        """Return a copy of a job record, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def partial_content(self, job_id):
+        """Return the content a running job has received so far"""
+        return "".join(self._partial.get(job_id, ()))
+
+    def list_jobs(self, script_id=None, limit=None):
+        """Return copies of the job records, newest first, optionally of one script only"""
+        with self._lock:
+            jobs = [dict(job) for job in self._jobs.values()
+                    if script_id is None or job["script_id"] == script_id]
+        jobs.sort(key=lambda job: job["id"], reverse=True)
+        return jobs[:limit] if limit is not None else jobs
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Return the process-wide job manager"""
+    global _job_manager
+    if _job_manager is None:
+        with _job_manager_lock:
+            if _job_manager is None:
+                _job_manager = JobManager(JOB_DIR, JOB_MAX_WORKERS)
+    return _job_manager
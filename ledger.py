@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Append-only ledger of API usage and cost, with running totals.
+
+Every saved generation appends one entry (time, script, version, model, prompt,
+completion and cached tokens, cost) to config.LEDGER_FILE. Totals per day, per
+model, per script and per day and model are updated with every append and kept
+in config.LEDGER_TOTALS_FILE, so spend summaries and daily budget checks read
+one small file instead of scanning the ledger or the version logs. The totals
+record how much of the ledger they cover, so entries whose totals update was
+lost in a crash are added the next time the totals are read.
+
+    python ledger.py summary
+    python ledger.py rebuild
+"""
+import os
+import sys
+import copy
+import json
+import argparse
+import datetime
+import threading
+
+from config import LEDGER_FILE, LEDGER_TOTALS_FILE, RATE_LIMITS
+from locking import file_lock, atomic_write
+
+# Token and cost fields summed in every total
+TOTAL_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "cost")
+
+
+class BudgetExceeded(Exception):
+    """Raised when a request would exceed the daily token limit of its model"""
+
+
+def _empty_total():
+    return {field: 0 for field in TOTAL_FIELDS}
+
+def _empty_totals():
+    return {"offset": 0, "total": _empty_total(), "days": {}, "models": {}, "scripts": {}, "day_models": {}}
+
+def _add(total, entry):
+    total["requests"] += 1
+    for field in TOTAL_FIELDS[1:]:
+        total[field] += entry.get(field) or 0
+
+def _add_entry(totals, entry):
+    day = entry["time"][:10]
+    _add(totals["total"], entry)
+    _add(totals["days"].setdefault(day, _empty_total()), entry)
+    _add(totals["models"].setdefault(entry["model"], _empty_total()), entry)
+    _add(totals["scripts"].setdefault(entry["script_id"], _empty_total()), entry)
+    _add(totals["day_models"].setdefault(day, {}).setdefault(entry["model"], _empty_total()), entry)
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+class CostLedger:
+    """Ledger file of usage entries and the file of its running totals"""
+
+    def __init__(self, ledger_file, totals_file):
+        self.ledger_file = ledger_file
+        self.totals_file = totals_file
+        self.lock_file = f"{ledger_file}.lock"
+        # (mtime_ns, size) of the totals file and the totals read from it
+        self._cached = (None, None)
+        self._cache_lock = threading.Lock()
+
+    def _read_totals_file(self):
+        try:
+            stat = os.stat(self.totals_file)
+        except FileNotFoundError:
+            return _empty_totals()
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._cache_lock:
+            if self._cached[0] == key:
+                return self._cached[1]
+        try:
+            with open(self.totals_file, "r", encoding="utf-8") as f:
+                totals = json.load(f)
+        except ValueError:
+            # Unreadable totals are rebuilt from the ledger
+            totals = _empty_totals()
+        with self._cache_lock:
+            self._cached = (key, totals)
+        return totals
+
+    def _write_totals(self, totals):
+        atomic_write(self.totals_file, json.dumps(totals, ensure_ascii=False).encode("utf-8"))
+
+    def _ledger_size(self):
+        try:
+            return os.path.getsize(self.ledger_file)
+        except FileNotFoundError:
+            return 0
+
+    def _catch_up(self, totals):
+        """Add the ledger entries past the offset of the totals; call with the lock held"""
+        if totals["offset"] > self._ledger_size():
+            totals = _empty_totals()
+        if not os.path.exists(self.ledger_file):
+            return totals
+        with open(self.ledger_file, "rb") as f:
+            f.seek(totals["offset"])
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A torn last line is left for whoever appends next
+                    break
+                try:
+                    _add_entry(totals, json.loads(line.decode("utf-8")))
+                except (ValueError, KeyError):
+                    pass
+                totals["offset"] += len(line)
+        return totals
+
+    def totals(self):
+        """Return the running totals, bringing them up to date with the ledger if needed"""
+        totals = self._read_totals_file()
+        if totals["offset"] == self._ledger_size():
+            return totals
+        with file_lock(self.lock_file):
+            totals = self._catch_up(copy.deepcopy(self._read_totals_file()))
+            self._write_totals(totals)
+        return totals
+
+    def record(self, entry):
+        """Append an entry and update the totals; ``time`` defaults to now"""
+        entry = dict(entry)
+        entry.setdefault("time", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        directory = os.path.dirname(self.ledger_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with file_lock(self.lock_file):
+            # A copy, since the cached totals are shared with readers
+            totals = self._catch_up(copy.deepcopy(self._read_totals_file()))
+            with open(self.ledger_file, "ab") as f:
+                if f.tell() > totals["offset"]:
+                    # Drop a torn line left by a crash, so the new entry starts on its own line
+                    f.truncate(totals["offset"])
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            _add_entry(totals, entry)
+            totals["offset"] += len(line)
+            self._write_totals(totals)
+        return entry
+
+    def rebuild(self):
+        """Recompute the totals from the whole ledger"""
+        with file_lock(self.lock_file):
+            totals = self._catch_up(_empty_totals())
+            self._write_totals(totals)
+        return totals
+
+    def day_total(self, day=None, model=None):
+        """Return the totals of a day (default: today), of one model or of all models"""
+        totals = self.totals()
+        day = day or _today()
+        if model is None:
+            return totals["days"].get(day, _empty_total())
+        return totals["day_models"].get(day, {}).get(model, _empty_total())
+
+    def script_total(self, script_id):
+        return self.totals()["scripts"].get(script_id, _empty_total())
+
+    def check_daily_tokens(self, model, tokens):
+        """Raise BudgetExceeded if ``tokens`` more would take today's tokens of a model past its TPD"""
+        limit = RATE_LIMITS.get(model, {}).get("TPD")
+        if limit is None:
+            return
+        total = self.day_total(model=model)
+        used = total["prompt_tokens"] + total["completion_tokens"]
+        if used + tokens > limit:
+            raise BudgetExceeded(f"Daily token limit of {model} would be exceeded: {used:,} of {limit:,} tokens used today, "
+                                 f"this request needs about {tokens:,}")
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger():
+    """Return the process-wide cost ledger"""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = CostLedger(LEDGER_FILE, LEDGER_TOTALS_FILE)
+    return _ledger
+
+
+def format_total(total):
+    return (f"{total['requests']:>6} requests  {total['prompt_tokens']:>12,} in  "
+            f"{total['cached_tokens']:>10,} cached  {total['completion_tokens']:>12,} out  ${total['cost']:>10.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="print spend per day, model and script")
+    summary_parser.add_argument("--days", type=int, default=14, help="most recent days shown")
+    summary_parser.add_argument("--scripts", type=int, default=10, help="most expensive scripts shown")
+    subparsers.add_parser("rebuild", help="recompute the totals from the whole ledger")
+    args = parser.parse_args()
+
+    ledger = get_ledger()
+    if args.command == "rebuild":
+        totals = ledger.rebuild()
+        print(f"Totals rebuilt from {totals['total']['requests']} entries", file=sys.stderr)
+        return
+
+    totals = ledger.totals()
+    print(f"Total       {format_total(totals['total'])}")
+    print("\nBy day")
+    for day in sorted(totals["days"])[-args.days:]:
+        print(f"{day}  {format_total(totals['days'][day])}")
+    print("\nBy model")
+    for model, total in sorted(totals["models"].items()):
+        print(f"{model:<20}  {format_total(total)}")
+    print(f"\nTop {args.scripts} scripts")
+    scripts = sorted(totals["scripts"].items(), key=lambda item: item[1]["cost"], reverse=True)
+    for script_id, total in scripts[:args.scripts]:
+        print(f"{script_id:<20}  {format_total(total)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Load test of the generate flow against the local mock OpenAI API (mock_server.py).
+
+Starts the mock server in this process, points the app at it through
+OPENAI_BASE_URL and OPENAI_API_KEY, keeps all data in a temporary directory
+and drives many simulated sessions at once. Every session creates a script and
+generates a number of versions one after another. At the end it reports
+generations per minute, latency percentiles, error rates and what the mock
+server saw, including injected 429/5xx responses and the retries they caused.
+
+Two modes are available:
+
+``apptest`` (default)
+    Every session is a Streamlit AppTest of app.py that fills in the brief and
+    the prompt and clicks "Создать сценарий", exactly like a user. A generation
+    lasts until its background job has finished and the page shows it.
+
+``direct``
+    Every session calls utils.generate_version from its own thread, which
+    exercises the HTTP client, retries, rate limiter and storage without Streamlit.
+
+    python load_test.py --sessions 20 --generations 3 --error-rate-429 0.05
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_server import start_mock_server, add_mock_arguments, options_from_args
+
+BRIEF = "Детектив в дождливом городе: журналистка находит письмо, которое не должна была прочитать."
+
+
+def _widget(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"No widget labelled {label!r} on the page")
+
+def share_apptest_runtime():
+    """Let several AppTests run at the same time in this process
+
+    AppTest installs a mock Streamlit runtime as a global for the duration of
+    a run and removes it afterwards, so concurrent runs pull it away from each
+    other. All runs get one shared mock runtime instead. Every run also
+    compiles app.py again, and compiling in several threads at once fails
+    intermittently on some Python versions, so compiling is serialized.
+    """
+    import threading
+    from unittest.mock import MagicMock
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+    def get_bytecode_locked(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+    ScriptCache.get_bytecode = get_bytecode_locked
+
+def run_app_session(index, args):
+    """Drive one session of app.py through AppTest and return (latency, error) per generation"""
+    from streamlit.testing.v1 import AppTest
+    from jobs import get_job_manager
+    from benchmark import pin_index_selectboxes
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    app = AppTest.from_file(app_path, default_timeout=args.timeout)
+    app.run()
+    _widget(app.sidebar.button, "Создать новый сценарий").click().run()
+    _widget(app.text_area, "Краткое описание").input(f"{BRIEF} (сессия {index})").run()
+
+    outcomes = []
+    for number in range(1, args.generations + 1):
+        pin_index_selectboxes(app)
+        _widget(app.text_area, "Опишите, что вы хотите в этой версии сценария").input(
+            f"Версия {number}: сделайте сцену напряженнее").run()
+        pin_index_selectboxes(app)
+        started = time.perf_counter()
+        try:
+            # The page keeps polling the background job until it finishes
+            _widget(app.button, "Создать сценарий").click().run()
+        except Exception as e:
+            outcomes.append((time.perf_counter() - started, str(e)))
+            continue
+        latency = time.perf_counter() - started
+        if app.exception:
+            outcomes.append((latency, app.exception[0].message))
+            continue
+        job = get_job_manager().list_jobs(app.session_state.current_script["id"], 1)[0]
+        outcomes.append((latency, None if job["status"] == "done" else job["error"] or job["status"]))
+    return outcomes
+
+def run_direct_session(index, args):
+    """Generate versions of one script without Streamlit and return (latency, error) per generation"""
+    from utils import generate_version
+
+    script = {"id": f"load-test-{index}", "title": f"Нагрузочный тест {index}", "brief": BRIEF}
+    outcomes = []
+    for number in range(1, args.generations + 1):
+        started = time.perf_counter()
+        try:
+            result = generate_version(script, f"Версия {number}: сделайте сцену напряженнее", args.model)
+            error = None if result["error"] is None else str(result["error"])
+        except Exception as e:
+            error = str(e)
+        outcomes.append((time.perf_counter() - started, error))
+    return outcomes
+
+def run_load_test(args):
+    options = options_from_args(args)
+    server = start_mock_server(options)
+    data_dir = tempfile.TemporaryDirectory(prefix="load_test_")
+
+    # config reads these when it is first imported, so set them before importing the app modules
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["OPENAI_API_KEY"] = "load-test"
+    os.environ["AUTHOR_DATA_DIR"] = data_dir.name
+    from rate_limiter import get_rate_limiter
+    from benchmark import percentile
+    if args.no_client_limits:
+        get_rate_limiter().limits = {}
+
+    if args.mode == "apptest":
+        share_apptest_runtime()
+    run_session = run_app_session if args.mode == "apptest" else run_direct_session
+
+    def session(index):
+        try:
+            return run_session(index, args)
+        except Exception as e:
+            # A session that breaks down counts as one failed generation
+            return [(0.0, f"{type(e).__name__}: {e}")]
+
+    print(f"{args.sessions} {args.mode} sessions x {args.generations} generations against "
+          f"{os.environ['OPENAI_BASE_URL']}...", file=sys.stderr)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions, thread_name_prefix="session") as executor:
+        results = list(executor.map(session, range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    data_dir.cleanup()
+
+    outcomes = [outcome for session_outcomes in results for outcome in session_outcomes]
+    latencies = [latency for latency, error in outcomes if error is None]
+    errors = [error for _, error in outcomes if error is not None]
+    stats = options.stats
+
+    print(f"\nGenerations: {len(outcomes)} in {elapsed:.1f} s, "
+          f"{len(latencies) / elapsed * 60:.1f} successful generations/min")
+    if latencies:
+        print(f"Latency (s): p50 {statistics.median(latencies):.2f}   p95 {percentile(latencies, 0.95):.2f}   "
+              f"p99 {percentile(latencies, 0.99):.2f}   max {max(latencies):.2f}")
+    print(f"Failed generations: {len(errors)} ({len(errors) / max(len(outcomes), 1):.1%})")
+    for error in sorted(set(errors))[:5]:
+        print(f"  {errors.count(error)} x {error[:200]}")
+    print(f"Mock server: {stats['requests']} requests, {stats['completed']} answered, "
+          f"{stats['429']} x 429, {stats['5xx']} x 5xx injected, {stats['length']} cut at max_tokens, "
+          f"{max(stats['requests'] - len(outcomes), 0)} retries, "
+          f"{stats['cached_tokens'] / max(stats['prompt_tokens'], 1):.0%} of prompt tokens from the prompt cache")
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["apptest", "direct"], default="apptest")
+    parser.add_argument("--sessions", type=int, default=10, help="simulated sessions running at once")
+    parser.add_argument("--generations", type=int, default=3, help="versions generated by every session")
+    parser.add_argument("--model", default="gpt-4o-mini", help="model used by direct sessions")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a single page run may take")
+    parser.add_argument("--no-client-limits", action="store_true",
+                        help="disable the client-side rate limiter to load the server with everything at once")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(run_load_test(args))
+
+if __name__ == "__main__":
+    main()
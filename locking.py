@@ -0,0 +1,69 @@
+"""
+Inter-process file locking and atomic file replacement, shared by the modules
+that write to the data directory.
+"""
+import os
+import time
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the lock file ``path`` for the duration of the block
+
+    The lock is advisory: it only excludes other code that locks the same path.
+    It works both between processes and between threads of one process.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            # msvcrt gives up after ~10 seconds, so keep retrying until the lock is ours
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def atomic_write(path, data, sync=True):
+    """Replace the file ``path`` with ``data`` (bytes) so readers see either the old or the new file
+
+    The data goes to a temporary file next to ``path`` that is flushed to disk
+    (unless ``sync`` is false) and then renamed over it, so a crash never
+    leaves a truncated file behind. Concurrent writers each use their own
+    temporary file; the last rename wins.
+    """
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Lightweight timing metrics of generations, storage and page reruns.
+
+Durations are recorded into per-process histograms keyed by metric name and
+labels, for example the latency of API requests per model, the phases of a
+generation, storage operations and full reruns of the page. Every observation
+is also appended as a JSON line to config.METRICS_LOG_FILE when it is set, and
+the histograms are served in the Prometheus text format on config.METRICS_PORT
+when that is set.
+
+Histograms of a metrics log, e.g. one written by batch.py, can be printed in
+the Prometheus text format or as a summary table afterwards:
+
+    python metrics.py prometheus data/metrics.jsonl
+    python metrics.py summary data/metrics.jsonl
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from config import METRICS_LOG_FILE, METRICS_PORT, METRICS_BUCKETS
+
+# Prefix of every exported metric name
+METRIC_PREFIX = "author_"
+
+# Help texts of the exported metrics
+METRIC_HELP = {
+    "openai_request_seconds": "Duration of chat completion requests, from sending to the last chunk",
+    "openai_time_to_first_token_seconds": "Time from sending a chat completion request to its first content chunk",
+    "openai_json_parse_seconds": "Time spent parsing the JSON chunks of a chat completion response",
+    "rate_limit_wait_seconds": "Time requests waited for admission by the client-side rate limiter",
+    "generation_phase_seconds": "Duration of the local phases of generating a version",
+    "storage_seconds": "Duration of storage operations",
+    "rerun_seconds": "Duration of full runs of the Streamlit page",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in escaped) + "}"
+
+
+class Histogram:
+    """Cumulative counts of observations per bucket, with their count and sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Return the upper bound of the bucket holding the given quantile, or None beyond the last bucket"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return None
+
+
+class MetricsRegistry:
+    """Histograms of timings, optionally logged as JSON lines"""
+
+    def __init__(self, buckets=METRICS_BUCKETS, log_file=None):
+        self.buckets = tuple(sorted(buckets))
+        self.log_file = log_file
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._log = None
+
+    def observe(self, name, value, **labels):
+        """Record one observation of a metric"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+            if self.log_file:
+                if self._log is None:
+                    self._log = open(self.log_file, "a", encoding="utf-8")
+                self._log.write(json.dumps({"time": round(time.time(), 3), "name": name, "labels": labels,
+                                            "value": round(value, 6)}, ensure_ascii=False) + "\n")
+                self._log.flush()
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """Record the duration of the block in seconds, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """Return (name, labels, histogram copy) of every metric, sorted by name and labels"""
+        with self._lock:
+            items = []
+            for (name, label_key), histogram in sorted(self._histograms.items()):
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.count = histogram.count
+                copy.sum = histogram.sum
+                items.append((name, dict(label_key), copy))
+        return items
+
+    def prometheus_text(self):
+        """Return all histograms in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for name, labels, histogram in self.snapshot():
+            metric = METRIC_PREFIX + name
+            if name not in described:
+                described.add(name)
+                if name in METRIC_HELP:
+                    lines.append(f"# HELP {metric} {METRIC_HELP[name]}")
+                lines.append(f"# TYPE {metric} histogram")
+            label_key = _label_key(labels)
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{metric}_bucket{_format_labels(label_key, [('le', f'{bound:g}')])} {count}")
+            lines.append(f"{metric}_bucket{_format_labels(label_key, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{metric}_sum{_format_labels(label_key)} {histogram.sum:.6f}")
+            lines.append(f"{metric}_count{_format_labels(label_key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class PhaseTimer:
+    """Times the phases of one operation, keeping their durations and recording them as metrics"""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        # phase -> seconds, in the order the phases ran
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    def add(self, phase, seconds):
+        """Record the duration of a phase; a phase that runs several times is summed"""
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+        get_metrics().observe(self.name, seconds, phase=phase, **self.labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(registry, port, host="0.0.0.0"):
+    """Serve the histograms of a registry on http://host:port/metrics in a background thread"""
+    handler = type("BoundMetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    """Return the process-wide metrics registry, starting the metrics server on first use if configured"""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                registry = MetricsRegistry(METRICS_BUCKETS, METRICS_LOG_FILE)
+                if METRICS_PORT:
+                    try:
+                        start_metrics_server(registry, METRICS_PORT)
+                    except OSError as e:
+                        # Another process of the deployment already serves this port
+                        print(f"Metrics server not started on port {METRICS_PORT}: {e}", file=sys.stderr)
+                _metrics = registry
+    return _metrics
+
+def timed(name, **labels):
+    """Record the duration of a block in the process-wide registry"""
+    return get_metrics().timed(name, **labels)
+
+
+def load_log(log_file, buckets=METRICS_BUCKETS):
+    """Rebuild the histograms of a metrics log"""
+    registry = MetricsRegistry(buckets)
+    with open(log_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line torn by a crash
+                continue
+            registry.observe(record["name"], record["value"], **record.get("labels", {}))
+    return registry
+
+def format_summary(registry):
+    """Return a table of count, mean and approximate p50/p95 of every metric"""
+    def seconds(value):
+        return f"{value:.4f}" if value is not None else "inf"
+
+    rows = [("metric", "count", "mean", "p50<=", "p95<=")]
+    for name, labels, histogram in registry.snapshot():
+        label_text = ",".join(f"{key}={value}" for key, value in labels.items())
+        rows.append((f"{name}{{{label_text}}}" if label_text else name, str(histogram.count),
+                     seconds(histogram.sum / histogram.count), seconds(histogram.quantile(0.5)),
+                     seconds(histogram.quantile(0.95))))
+    width = max(len(row[0]) for row in rows)
+    return "\n".join(f"{row[0]:<{width}}" + "".join(f"{cell:>10}" for cell in row[1:]) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("prometheus", "print the histograms in the Prometheus text format"),
+                               ("summary", "print count, mean and approximate percentiles per metric")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("log_file", nargs="?", default=METRICS_LOG_FILE, help="metrics log (JSON lines)")
+    args = parser.parse_args()
+    if not args.log_file:
+        parser.error("no metrics log given and config.METRICS_LOG_FILE is not set")
+
+    registry = load_log(args.log_file)
+    if args.command == "prometheus":
+        sys.stdout.write(registry.prometheus_text())
+    else:
+        print(format_summary(registry))
+
+if __name__ == "__main__":
+    main()
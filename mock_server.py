@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the OpenAI chat completions API, for load tests without API costs.
+
+Serves ``POST /v1/chat/completions`` with generated text, both as a plain JSON
+response and as a server-sent event stream (including the usage chunk when
+``stream_options.include_usage`` is set). Latency, token throughput, answer
+length and the share of 429 and 5xx errors are configurable. Like the real API,
+a request whose leading 1024 or more tokens match a recent request reports the
+matching part, in steps of 128 tokens, as ``prompt_tokens_details.cached_tokens``.
+``GET /stats`` returns the request counters.
+
+    python mock_server.py --port 8000 --latency 0.5 --tokens-per-second 80 --error-rate-429 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock streamlit run app.py
+"""
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Prompt caching of the API: shortest cached prefix, granularity and number of recent prompts remembered
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+CACHE_RECENT_PROMPTS = 256
+
+WORDS = ["НАРРАТОР:", "АННА:", "ИВАН:", "[ЗВУК: дождь]", "[МУЗЫКА: тихо]",
+         "тишина", "шаги", "дверь", "ночь", "голос", "город", "письмо", "вдруг", "медленно"]
+
+
+class MockOptions:
+    """Behaviour of the mock server"""
+
+    def __init__(self, latency=0.3, latency_jitter=0.1, tokens_per_second=100.0, output_tokens=300,
+                 error_rate_429=0.0, error_rate_5xx=0.0, retry_after=1.0, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "completed": 0, "streamed": 0, "429": 0, "5xx": 0, "length": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0}
+        self.recent_prompts = deque(maxlen=CACHE_RECENT_PROMPTS)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def cached_tokens(self, prompt, prompt_tokens):
+        """Return the tokens of the prompt served from the simulated prompt cache and remember the prompt"""
+        with self.lock:
+            common = max((len(os.path.commonprefix([prompt, recent])) for recent in self.recent_prompts), default=0)
+            self.recent_prompts.append(prompt)
+            # Roughly four characters per token, like the prompt token count
+            tokens = min(common // 4, prompt_tokens)
+            cached = tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS if tokens >= CACHE_MIN_TOKENS else 0
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached
+            return cached
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.options.lock:
+                self._send_json(200, dict(self.options.stats))
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        options = self.options
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        options.count("requests")
+        draw = options.draw()
+        if draw < options.error_rate_429:
+            options.count("429")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                            {"Retry-After": f"{options.retry_after:g}"})
+            return
+        if draw < options.error_rate_429 + options.error_rate_5xx:
+            options.count("5xx")
+            self._send_json(503, {"error": {"message": "Service unavailable (mock)", "type": "server_error"}})
+            return
+
+        # Roughly four characters per token, like English text
+        prompt_tokens = sum(len(m.get("content", "")) for m in request.get("messages", [])) // 4 + 1
+        prompt = "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in request.get("messages", []))
+        cached_tokens = options.cached_tokens(prompt, prompt_tokens)
+        rng = random.Random(draw)
+        tokens = [rng.choice(WORDS) + ("\n" if rng.random() < 0.1 else " ") for _ in range(options.output_tokens)]
+        # An answer longer than max_tokens is cut off, like the real API does
+        max_tokens = request.get("max_completion_tokens") or request.get("max_tokens")
+        finish_reason = "stop"
+        if max_tokens and len(tokens) > max_tokens:
+            tokens = tokens[:max_tokens]
+            finish_reason = "length"
+            options.count("length")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens),
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        model = request.get("model", "mock")
+
+        time.sleep(max(options.latency + rng.uniform(-options.latency_jitter, options.latency_jitter), 0.0))
+        if request.get("stream"):
+            self._stream(model, tokens, usage, (request.get("stream_options") or {}).get("include_usage"),
+                         finish_reason)
+            options.count("streamed")
+        else:
+            time.sleep(len(tokens) / options.tokens_per_second)
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": finish_reason}],
+                "usage": usage
+            })
+        options.count("completed")
+
+    def _stream(self, model, tokens, usage, include_usage, finish_reason="stop"):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }, ensure_ascii=False)
+
+        interval = 1.0 / self.options.tokens_per_second
+        send_event(chunk({"role": "assistant"}))
+        for token in tokens:
+            time.sleep(interval)
+            send_event(chunk({"content": token}))
+        send_event(chunk({}, finish_reason))
+        if include_usage:
+            send_event(json.dumps({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                                   "model": model, "choices": [], "usage": usage}))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_mock_server(options, host="127.0.0.1", port=0):
+    """Start the mock server in a background thread and return it; port 0 picks a free port"""
+    handler = type("BoundMockHandler", (MockHandler,), {"options": options})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+
+def add_mock_arguments(parser):
+    """Add the options of the mock server to an argument parser"""
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--latency-jitter", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--output-tokens", type=int, default=300, help="tokens in every answer")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of 429 responses, seconds")
+    parser.add_argument("--seed", type=int)
+
+def options_from_args(args):
+    return MockOptions(args.latency, args.latency_jitter, args.tokens_per_second, args.output_tokens,
+                       args.error_rate_429, args.error_rate_5xx, args.retry_after, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(options_from_args(args), args.host, args.port)
+    print(f"Mock OpenAI API on http://{args.host}:{server.server_address[1]}/v1 (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
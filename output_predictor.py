@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Prediction of the length of generated versions, learned from the stored versions.
+
+For every model the log of the output tokens of a version is fitted by least
+squares on the log of its input tokens and the number of previous versions sent
+as context. Only the running sums of the fit are kept, in
+config.OUTPUT_PREDICTOR_FILE, so every saved version updates the fit in
+constant time and the stored versions are only scanned when the file does not
+exist yet. A prediction comes with an interval (config.OUTPUT_PREDICTION_Z
+standard deviations of the residuals, e.g. 90%), from which the max_tokens cap
+of a request is derived, and with the typical latency of the model.
+
+    python output_predictor.py show
+    python output_predictor.py rebuild
+"""
+import os
+import sys
+import json
+import math
+import argparse
+import threading
+
+from config import (
+    MODELS,
+    DATA_DIR,
+    STORAGE_BACKEND,
+    OUTPUT_PREDICTOR_FILE,
+    OUTPUT_PREDICTOR_MIN_SAMPLES,
+    OUTPUT_PREDICTION_Z,
+    MAX_TOKENS_MARGIN
+)
+from locking import file_lock, atomic_write
+
+# Key of the fit over the versions of all models, used for models with too few versions of their own
+ALL_MODELS = "*"
+
+# Added to the diagonal of the normal equations, so a fit on few or identical samples stays solvable
+RIDGE = 1e-6
+
+
+def features(input_tokens, previous_versions):
+    return [1.0, math.log(max(input_tokens, 1)), float(previous_versions)]
+
+FEATURE_COUNT = len(features(1, 0))
+
+
+def _empty_fit():
+    return {
+        "n": 0,
+        "xtx": [[0.0] * FEATURE_COUNT for _ in range(FEATURE_COUNT)],
+        "xty": [0.0] * FEATURE_COUNT,
+        "yty": 0.0,
+        # Streaming speed: seconds to the first token and tokens per second after it
+        "ttft_sum": 0.0,
+        "ttft_n": 0,
+        "stream_seconds": 0.0,
+        "stream_tokens": 0
+    }
+
+def _solve(matrix, vector):
+    """Return the inverse of a small symmetric matrix and the solution of ``matrix @ x = vector``"""
+    size = len(matrix)
+    augmented = [[value + (RIDGE if i == j else 0.0) for j, value in enumerate(row)]
+                 + [1.0 if i == j else 0.0 for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(augmented[row][col]))
+        augmented[col], augmented[pivot] = augmented[pivot], augmented[col]
+        pivot_value = augmented[col][col]
+        augmented[col] = [value / pivot_value for value in augmented[col]]
+        for row in range(size):
+            if row != col and augmented[row][col]:
+                factor = augmented[row][col]
+                augmented[row] = [a - factor * b for a, b in zip(augmented[row], augmented[col])]
+    inverse = [row[size:] for row in augmented]
+    solution = [sum(a * b for a, b in zip(row, vector)) for row in inverse]
+    return inverse, solution
+
+def is_training_sample(version):
+    """Whether a version shows how long an answer the model chose to write
+
+    Answers cut short by an error, by the max_tokens cap or served from the
+    completion cache are left out.
+    """
+    return (bool(version.get("completion_tokens")) and bool(version.get("input_tokens"))
+            and not version.get("partial") and not version.get("cache_hit")
+            and version.get("finish_reason") != "length")
+
+
+class OutputPredictor:
+    """Running least-squares fits of output length per model, kept in a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = f"{path}.lock"
+        # (mtime_ns, size) of the file and the fits read from it
+        self._cached = (None, None)
+        self._cache_lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._cache_lock:
+            if self._cached[0] == key:
+                return self._cached[1]
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                fits = json.load(f)
+        except ValueError:
+            fits = {}
+        with self._cache_lock:
+            self._cached = (key, fits)
+        return fits
+
+    def _write(self, fits):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        atomic_write(self.path, json.dumps(fits).encode("utf-8"))
+
+    @staticmethod
+    def _add(fits, version):
+        # The context of a version lists its parts: the brief, the previous versions and the request
+        x = features(version["input_tokens"], max(len(version.get("context") or ()) - 2, 0))
+        y = math.log(version["completion_tokens"])
+        for key in (version.get("model"), ALL_MODELS):
+            fit = fits.setdefault(key, _empty_fit())
+            fit["n"] += 1
+            for i in range(FEATURE_COUNT):
+                fit["xty"][i] += x[i] * y
+                for j in range(FEATURE_COUNT):
+                    fit["xtx"][i][j] += x[i] * x[j]
+            fit["yty"] += y * y
+            ttft, duration = version.get("time_to_first_token"), version.get("generation_time")
+            if ttft is not None and duration is not None and duration > ttft:
+                fit["ttft_sum"] += ttft
+                fit["ttft_n"] += 1
+                fit["stream_seconds"] += duration - ttft
+                fit["stream_tokens"] += version["completion_tokens"]
+
+    def observe(self, version):
+        """Add a saved version to the fits of its model, if it is a training sample"""
+        if not is_training_sample(version):
+            return
+        with file_lock(self.lock_file):
+            # A copy, since the cached fits are shared with readers
+            fits = json.loads(json.dumps(self._read()))
+            self._add(fits, version)
+            self._write(fits)
+
+    def rebuild(self, versions):
+        """Refit from scratch on an iterable of version records; returns the number of samples"""
+        fits = {}
+        samples = 0
+        for version in versions:
+            if is_training_sample(version):
+                self._add(fits, version)
+                samples += 1
+        with file_lock(self.lock_file):
+            self._write(fits)
+        return samples
+
+    def _fit(self, model):
+        fits = self._read()
+        for key in (model, ALL_MODELS):
+            fit = fits.get(key)
+            if fit and fit["n"] >= OUTPUT_PREDICTOR_MIN_SAMPLES:
+                return key, fit
+        return None, None
+
+    def predict(self, model, input_tokens, previous_versions=0):
+        """Predict the output tokens of a request, or return None while there are too few versions
+
+        Returns a dict with the expected ``tokens``, the ``low`` and ``high``
+        ends of the prediction interval, the ``max_tokens`` cap, the number of
+        ``samples`` and whether the fit is of this model or ``pooled`` over all
+        models, and the expected ``seconds_low`` and ``seconds_high`` of the
+        request, or None for them if no timings are known.
+        """
+        key, fit = self._fit(model)
+        if fit is None:
+            return None
+        inverse, beta = _solve(fit["xtx"], fit["xty"])
+        x = features(input_tokens, previous_versions)
+        mean = sum(b * v for b, v in zip(beta, x))
+        # Residual variance from the running sums: y'y - b'X'y
+        degrees = max(fit["n"] - FEATURE_COUNT, 1)
+        variance = max(fit["yty"] - sum(b * v for b, v in zip(beta, fit["xty"])), 0.0) / degrees
+        leverage = sum(x[i] * inverse[i][j] * x[j] for i in range(FEATURE_COUNT) for j in range(FEATURE_COUNT))
+        spread = OUTPUT_PREDICTION_Z * math.sqrt(variance * (1 + max(leverage, 0.0)))
+
+        # The fit is of log tokens: exp(mean + variance/2) is the expected value, the interval is multiplicative
+        tokens = math.exp(mean + variance / 2)
+        low, high = math.exp(mean - spread), math.exp(mean + spread)
+        max_output = MODELS.get(model, {}).get("max_output_tokens")
+        max_tokens = math.ceil(high * MAX_TOKENS_MARGIN)
+        if max_output:
+            max_tokens = min(max_tokens, max_output)
+
+        seconds_low = seconds_high = None
+        if fit["ttft_n"] and fit["stream_seconds"] > 0:
+            ttft = fit["ttft_sum"] / fit["ttft_n"]
+            tokens_per_second = fit["stream_tokens"] / fit["stream_seconds"]
+            seconds_low, seconds_high = ttft + low / tokens_per_second, ttft + high / tokens_per_second
+        return {
+            "tokens": round(tokens),
+            "low": round(low),
+            "high": round(high),
+            "max_tokens": max_tokens,
+            "samples": fit["n"],
+            "pooled": key != model,
+            "seconds_low": seconds_low,
+            "seconds_high": seconds_high
+        }
+
+    def summary(self):
+        """Return (model, samples, typical tokens) of every fit"""
+        rows = []
+        for key, fit in sorted(self._read().items()):
+            typical = math.exp(fit["xty"][0] / fit["n"]) if fit["n"] else 0
+            rows.append((key, fit["n"], round(typical)))
+        return rows
+
+
+def stored_versions(storage):
+    """Yield the metadata of every stored version of a storage backend"""
+    for script_id in storage.script_ids_with_versions():
+        yield from storage.list_versions(script_id)
+
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+def get_output_predictor():
+    """Return the process-wide output predictor"""
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                _predictor = OutputPredictor(OUTPUT_PREDICTOR_FILE)
+    return _predictor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("show", help="print the number of samples and typical output per model")
+    subparsers.add_parser("rebuild", help="refit on all stored versions")
+    args = parser.parse_args()
+
+    predictor = get_output_predictor()
+    if args.command == "rebuild":
+        import storage
+        samples = predictor.rebuild(stored_versions(storage.open_storage(STORAGE_BACKEND, DATA_DIR)))
+        print(f"Fitted on {samples} versions", file=sys.stderr)
+        return
+    for key, samples, typical in predictor.summary():
+        print(f"{'all models' if key == ALL_MODELS else key:<20}  {samples:>7} versions  ~{typical:,} tokens typical")
+
+if __name__ == "__main__":
+    main()
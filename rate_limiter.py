@@ -0,0 +1,230 @@
+"""
+Client-side rate limiting of API calls according to config.RATE_LIMITS.
+
+Every limit (TPM, RPM, TPD, RPD) of a model is a token bucket that refills
+continuously over its period. A request is admitted once every bucket of its
+model can pay for it; callers of the same model queue up in FIFO order. After
+the call the token buckets are reconciled with the usage reported by the API.
+
+The limiter is shared by all sessions of the process. If RATE_LIMIT_STATE_FILE
+is set the bucket levels are also shared with other processes through that file.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from config import RATE_LIMITS, RATE_LIMIT_STATE_FILE, RATE_LIMIT_MAX_WAIT
+from locking import file_lock, atomic_write
+
+# Period over which each kind of limit refills, in seconds
+LIMIT_PERIODS = {
+    "TPM": 60,
+    "RPM": 60,
+    "TPD": 24 * 60 * 60,
+    "RPD": 24 * 60 * 60,
+}
+
+# Limits counted in tokens; the others are counted in requests
+TOKEN_LIMITS = ("TPM", "TPD")
+
+# How often a waiting caller re-checks the buckets and reports its wait estimate
+POLL_INTERVAL = 0.5
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request cannot be admitted within the rate limits"""
+
+
+class RateLimiter:
+    """Token-bucket rate limiter keyed by model"""
+
+    def __init__(self, limits, state_file=None, max_wait=None):
+        self.limits = limits
+        self.state_file = state_file
+        self.max_wait = max_wait
+        # model -> {limit name: {"level": float, "updated": timestamp}}
+        self._buckets = {}
+        # model -> deque of [ticket, tokens] waiting for admission
+        self._queues = {}
+        self._condition = threading.Condition()
+
+    def _cost(self, name, tokens):
+        return tokens if name in TOKEN_LIMITS else 1
+
+    def _refill(self, model, now):
+        """Bring the bucket levels of a model up to date"""
+        buckets = self._buckets.setdefault(model, {})
+        for name, capacity in self.limits.get(model, {}).items():
+            if name not in LIMIT_PERIODS:
+                continue
+            bucket = buckets.setdefault(name, {"level": float(capacity), "updated": now})
+            rate = capacity / LIMIT_PERIODS[name]
+            elapsed = max(now - bucket["updated"], 0.0)
+            bucket["level"] = min(float(capacity), bucket["level"] + elapsed * rate)
+            bucket["updated"] = now
+        return buckets
+
+    def _wait_time(self, model, tokens, requests, now):
+        """Seconds until the buckets of a model can pay for the given tokens and requests"""
+        wait = 0.0
+        for name, bucket in self._refill(model, now).items():
+            capacity = self.limits[model][name]
+            needed = tokens if name in TOKEN_LIMITS else requests
+            deficit = needed - bucket["level"]
+            if deficit > 0:
+                wait = max(wait, deficit / (capacity / LIMIT_PERIODS[name]))
+        return wait
+
+    def _load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self._buckets = json.load(f)
+        except (OSError, ValueError):
+            # A damaged state file only costs us the shared levels, start from full buckets
+            self._buckets = {}
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        # Written on every admission and cheap to lose, so not synced to disk
+        atomic_write(self.state_file, json.dumps(self._buckets).encode("utf-8"), sync=False)
+
+    def _shared_state(self):
+        """Context manager that syncs bucket levels with other processes, if enabled"""
+        if not self.state_file:
+            return _NullContext()
+        return _SharedState(self)
+
+    def check(self, model, tokens):
+        """Raise RateLimitExceeded if a request of this size can never be admitted"""
+        for name, capacity in self.limits.get(model, {}).items():
+            if name in LIMIT_PERIODS and self._cost(name, tokens) > capacity:
+                raise RateLimitExceeded(
+                    f"Request of {tokens:,} tokens exceeds the {name} limit of {capacity:,} for {model}"
+                )
+
+    def estimate_wait(self, model, tokens):
+        """Estimate the seconds a new request of ``tokens`` tokens would wait for admission"""
+        if model not in self.limits:
+            return 0.0
+        with self._condition, self._shared_state():
+            queue = self._queues.get(model, ())
+            queued_tokens = sum(entry[1] for entry in queue)
+            return self._wait_time(model, queued_tokens + tokens, len(queue) + 1, time.time())
+
+    def snapshot(self, model):
+        """Return the current level and capacity of every bucket of a model"""
+        if model not in self.limits:
+            return {}
+        with self._condition, self._shared_state():
+            buckets = self._refill(model, time.time())
+            return {
+                name: {"available": max(int(bucket["level"]), 0), "capacity": self.limits[model][name]}
+                for name, bucket in buckets.items()
+            }
+
+    def acquire(self, model, tokens, on_wait=None):
+        """Block until a request of ``tokens`` tokens may be sent and reserve it
+
+        ``on_wait`` is called with the estimated wait in seconds and the position
+        in the queue while the caller is waiting. Returns a reservation that must
+        be passed to reconcile() once the actual usage is known.
+        """
+        reservation = {"model": model, "tokens": tokens}
+        if model not in self.limits:
+            return reservation
+
+        self.check(model, tokens)
+        ticket = object()
+        started = time.time()
+
+        with self._condition:
+            queue = self._queues.setdefault(model, deque())
+            queue.append([ticket, tokens])
+            try:
+                while True:
+                    now = time.time()
+                    with self._shared_state():
+                        # Queued callers ahead of us are paid first
+                        position = [entry[0] for entry in queue].index(ticket)
+                        ahead_tokens = sum(entry[1] for entry in list(queue)[:position])
+                        wait = self._wait_time(model, ahead_tokens + tokens, position + 1, now)
+
+                        if position == 0 and wait <= 0:
+                            for name, bucket in self._buckets[model].items():
+                                bucket["level"] -= self._cost(name, tokens)
+                            return reservation
+
+                    if self.max_wait is not None and now - started + wait > self.max_wait:
+                        raise RateLimitExceeded(
+                            f"Rate limit wait for {model} would exceed {self.max_wait} seconds"
+                        )
+                    if on_wait is not None:
+                        on_wait(wait, position)
+                    self._condition.wait(min(max(wait, 0.05), POLL_INTERVAL))
+            finally:
+                queue.remove(next(entry for entry in queue if entry[0] is ticket))
+                self._condition.notify_all()
+
+    def reconcile(self, reservation, actual_tokens):
+        """Correct the token buckets with the tokens a request actually used
+
+        Pass 0 for a request that failed without being processed; the request
+        itself still counts against the request limits.
+        """
+        model = reservation["model"]
+        if model not in self.limits:
+            return
+        difference = reservation["tokens"] - actual_tokens
+        with self._condition, self._shared_state():
+            buckets = self._refill(model, time.time())
+            for name, bucket in buckets.items():
+                if name in TOKEN_LIMITS:
+                    # Overuse leaves the bucket in debt, underuse is refunded up to capacity
+                    bucket["level"] = min(float(self.limits[model][name]), bucket["level"] + difference)
+            self._condition.notify_all()
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _SharedState:
+    """Load bucket levels from the state file under a lock, and save them on exit"""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.lock = file_lock(f"{limiter.state_file}.lock")
+
+    def __enter__(self):
+        self.lock.__enter__()
+        self.limiter._load_state()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.limiter._save_state()
+        finally:
+            self.lock.__exit__(*exc_info)
+        return False
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter built from config.RATE_LIMITS"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_STATE_FILE, RATE_LIMIT_MAX_WAIT)
+    return _rate_limiter
@@ -3,21 +3,40 @@
 Script to run the Audio Story Script Generator application.
 """
 import os
+import re
 import subprocess
 import sys
+import importlib.metadata
 import toml
 
+from config import TIKTOKEN_CACHE_DIR
+
+def required_packages(requirements_file="requirements.txt"):
+    """Return the package names listed in requirements.txt."""
+    packages = []
+    with open(requirements_file, "r", encoding="utf-8") as f:
+        for line in f:
+            name = re.split(r"[\s<>=!~;\[#]", line.strip(), maxsplit=1)[0]
+            if name:
+                packages.append(name)
+    return packages
+
 def check_requirements():
-    """Check if required packages are installed."""
-    try:
-        import streamlit
-        import openai
-        import tiktoken
-        import pandas
-        return True
-    except ImportError as e:
-        print(f"Missing required package: {e}")
+    """Check if required packages are installed.
+
+    Only the installed package metadata is read; importing the packages would
+    take seconds on every start.
+    """
+    missing = []
+    for package in required_packages():
+        try:
+            importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            missing.append(package)
+    if missing:
+        print(f"Missing required packages: {', '.join(missing)}")
         return False
+    return True
 
 def install_requirements():
     """Install required packages from requirements.txt."""
@@ -77,16 +96,33 @@ def check_streamlit_secrets():
             with open(secrets_file, "w", encoding="utf-8") as f:
                 toml.dump(secrets, f)
 
+def check_tokenizer_cache():
+    """Check that the tiktoken encodings are in the local cache, downloading them if they are not."""
+    import tokenizer_cache
+    missing = tokenizer_cache.missing_models()
+    if not missing:
+        return
+    print(f"Caching tiktoken encodings in {TIKTOKEN_CACHE_DIR}...")
+    try:
+        tokenizer_cache.prewarm()
+    except tokenizer_cache.EncodingUnavailable as e:
+        print(f"Warning: {e}")
+
 def run_app():
     """Run the Streamlit app."""
     print("Starting Audio Story Script Generator...")
-    subprocess.run(["streamlit", "run", "app.py"])
+    env = dict(os.environ)
+    env.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+    subprocess.run(["streamlit", "run", "app.py"], env=env)
 
 if __name__ == "__main__":
     # Check if requirements are installed
     if not check_requirements():
         install_requirements()
     
+    # Token counting needs the tiktoken encodings; hosts without network access use the shipped cache
+    check_tokenizer_cache()
+    
     # Check if Streamlit secrets file exists and contains API key
     check_streamlit_secrets()
     
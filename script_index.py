@@ -0,0 +1,116 @@
+"""
+In-process index of all scripts, shared by the sessions of the app.
+
+The list of scripts is loaded once per process instead of once per session and
+reloaded only when it changed: after a write through the index, or when the
+stored list was rewritten by another process (checked with a cheap stat of the
+storage). Sorted and filtered views are computed once per change and cached,
+so the sidebar only renders one page of them whatever the size of the catalogue.
+"""
+import threading
+from collections import OrderedDict
+
+from utils import get_storage, load_scripts, upsert_script, delete_script
+
+# Orders of the script list: name -> (sort key, newest or last first)
+SORT_ORDERS = {
+    "updated": (lambda script: script.get("updated_at") or "", True),
+    "created": (lambda script: script.get("created_at") or "", True),
+    "title": (lambda script: (script.get("title") or "").casefold(), False),
+}
+
+# Filtered and sorted views kept per version of the list
+VIEW_CACHE_SIZE = 32
+
+
+class ScriptIndex:
+    """All scripts by id, with cached sorted and filtered views"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Incremented by writes through the index; together with the storage version it identifies the loaded list
+        self._changes = 0
+        self._loaded_key = None
+        self._scripts = []
+        self._by_id = {}
+        self._search_text = []
+        # (query, sort) -> tuple of positions in self._scripts
+        self._views = OrderedDict()
+
+    def _current_key(self):
+        return (self._changes, get_storage().scripts_version())
+
+    def _refresh(self):
+        """Reload the list if it changed; call with the lock held"""
+        key = self._current_key()
+        if key == self._loaded_key:
+            return
+        scripts = load_scripts()["scripts"]
+        self._scripts = scripts
+        self._by_id = {script["id"]: script for script in scripts}
+        self._search_text = [f"{script.get('title', '')}\n{script.get('brief', '')}".casefold()
+                             for script in scripts]
+        self._views.clear()
+        self._loaded_key = key
+
+    def _view(self, query, sort):
+        """Return the positions of the scripts matching a query in the given order; call with the lock held"""
+        query = query.strip().casefold()
+        cache_key = (query, sort)
+        positions = self._views.get(cache_key)
+        if positions is not None:
+            self._views.move_to_end(cache_key)
+            return positions
+        if query:
+            # Narrowing a cached view of the same order is cheaper than scanning everything
+            base = self._views.get((query[:-1], sort)) if len(query) > 1 else None
+            candidates = base if base is not None else self._view("", sort)
+            positions = tuple(i for i in candidates if query in self._search_text[i])
+        else:
+            sort_key, reverse = SORT_ORDERS[sort]
+            positions = tuple(sorted(range(len(self._scripts)), key=lambda i: sort_key(self._scripts[i]),
+                                     reverse=reverse))
+        self._views[cache_key] = positions
+        while len(self._views) > VIEW_CACHE_SIZE:
+            self._views.popitem(last=False)
+        return positions
+
+    def page(self, query="", sort="updated", page=1, page_size=20):
+        """Return (scripts on the page, number of matching scripts) of the scripts whose title or brief contain ``query``
+
+        The scripts are shared with other sessions; copy one before changing it.
+        """
+        with self._lock:
+            self._refresh()
+            positions = self._view(query, sort)
+            first = (page - 1) * page_size
+            return [self._scripts[i] for i in positions[first:first + page_size]], len(positions)
+
+    def get(self, script_id):
+        """Return the stored script with the given id, or None"""
+        with self._lock:
+            self._refresh()
+            return self._by_id.get(script_id)
+
+    def ids(self):
+        """Return the ids of all scripts"""
+        with self._lock:
+            self._refresh()
+            return list(self._by_id)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._scripts)
+
+    def upsert(self, script):
+        """Save a script and have the next read pick up the change"""
+        upsert_script(dict(script))
+        with self._lock:
+            self._changes += 1
+
+    def delete(self, script_id):
+        """Remove a script and have the next read pick up the change"""
+        delete_script(script_id)
+        with self._lock:
+            self._changes += 1
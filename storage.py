@@ -0,0 +1,903 @@
+"""
+On-disk storage of scripts and their versions.
+
+Two interchangeable backends are available, selected by config.STORAGE_BACKEND:
+
+``json``
+    Scripts are kept in ``scripts.json``. Versions of a script live in an
+    append-only log, ``versions_<script_id>.jsonl``, with one JSON record per
+    line. A small index, ``versions_<script_id>.idx``, holds one line per
+    version with the byte offset and length of its record plus all of its
+    metadata except the content. Adding a version is a single append to each
+    file, the version table is listed from the index alone, and any single
+    version is read by seeking straight to its record. Scripts saved in the
+    older ``versions_<script_id>.json`` format are migrated to the log the first
+    time they are accessed.
+
+    With config.VERSION_COMPRESSION the log keeps a zlib-compressed snapshot of
+    the content every VERSION_KEYFRAME_INTERVAL versions and, for the versions
+    in between, a compressed line delta against the latest snapshot. Any version
+    is rebuilt from at most two records, and recently used snapshots are cached.
+
+``sqlite``
+    Scripts and versions are rows of a single SQLite database in WAL mode,
+    indexed by script id and timestamp.
+
+Several sessions and processes may share the same storage. Files of the JSON
+backend are only rewritten under a file lock and replaced atomically, so a
+reader sees either the old or the new file. Sessions change single scripts
+with upsert_script(s) and delete_script, which merge into the stored list instead
+of overwriting it with the session's own copy.
+
+Run ``python storage.py import-sqlite`` to copy an existing ``data/`` directory
+into the SQLite database, ``python storage.py report`` to see how much space the
+compressed log format saves on it and ``python storage.py compact`` to rewrite
+its logs in that format.
+"""
+import os
+import json
+import glob
+import zlib
+import base64
+import difflib
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+
+from config import (
+    DATA_DIR,
+    STORAGE_BACKEND,
+    SQLITE_DB_PATH,
+    VERSION_LOG_FSYNC,
+    VERSION_COMPRESSION,
+    VERSION_KEYFRAME_INTERVAL,
+    VERSION_SNAPSHOT_CACHE_SIZE
+)
+from locking import file_lock, atomic_write
+
+
+def _encode_record(record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _sync(f):
+    f.flush()
+    if VERSION_LOG_FSYNC:
+        os.fsync(f.fileno())
+
+def version_metadata(version):
+    """Return the metadata of a version: every field except the content, plus its length"""
+    metadata = {key: value for key, value in version.items()
+                if key != "content" and not key.startswith("_")}
+    # Compressed log records carry the length of the content they encode
+    if "content" in version or "content_length" not in metadata:
+        metadata["content_length"] = len(version.get("content", ""))
+    return metadata
+
+def _index_entry(record, offset, length):
+    entry = version_metadata(record)
+    if "_base" in record:
+        entry["_base"] = record["_base"]
+    entry["_offset"] = offset
+    entry["_length"] = length
+    return entry
+
+def _compress(text):
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii")
+
+def _decompress(data):
+    return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+
+def _make_delta(base, content):
+    """Return the line delta turning ``base`` into ``content``
+
+    The delta is a list of ``[start, end]`` ranges of base lines to copy and
+    strings of new text to insert, in order.
+    """
+    base_lines = base.splitlines(keepends=True)
+    lines = content.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines).get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append("".join(lines[j1:j2]))
+    return delta
+
+def _apply_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    return "".join("".join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in delta)
+
+def _encode_version(version, snapshot=None):
+    """Return the log record of a version
+
+    ``snapshot`` is the ``(offset, content)`` of the latest snapshot record of the
+    log. The version is stored as a delta against it when that is smaller than
+    storing a snapshot of its own; pass None to always store a snapshot.
+    """
+    if not VERSION_COMPRESSION:
+        return version
+    content = version.get("content", "")
+    record = {key: value for key, value in version.items() if key != "content"}
+    record["content_length"] = len(content)
+
+    compressed = _compress(content)
+    if snapshot is not None:
+        delta = _compress(json.dumps(_make_delta(snapshot[1], content), ensure_ascii=False, separators=(",", ":")))
+        if len(delta) < len(compressed):
+            record["_base"] = snapshot[0]
+            record["_delta"] = delta
+            return record
+    if len(compressed) < len(content.encode("utf-8")):
+        record["_content_z"] = compressed
+    else:
+        record["content"] = content
+    return record
+
+def _decode_version(record, base_content=None):
+    """Return the version stored in a log record; delta records need the content of their snapshot"""
+    if "_delta" in record:
+        content = _apply_delta(base_content, json.loads(_decompress(record["_delta"])))
+    elif "_content_z" in record:
+        content = _decompress(record["_content_z"])
+    else:
+        return record
+    version = {key: value for key, value in record.items()
+               if key != "content_length" and not key.startswith("_")}
+    version["content"] = content
+    return version
+
+def _encode_log(versions):
+    """Yield the encoded log record and index entry of each version of a new log"""
+    offset = 0
+    snapshot = None
+    since_snapshot = 0
+    for version in versions:
+        record = _encode_version(version, snapshot if since_snapshot < VERSION_KEYFRAME_INTERVAL else None)
+        data = _encode_record(record)
+        yield data, _index_entry(record, offset, len(data))
+        if "_base" in record:
+            since_snapshot += 1
+        else:
+            snapshot = (offset, version.get("content", ""))
+            since_snapshot = 1
+        offset += len(data)
+
+def _iter_log(log_file):
+    """Decode the versions of a log one by one, in one pass"""
+    snapshots = {}
+    for offset, _, record in _scan_log(log_file):
+        version = _decode_version(record, snapshots.get(record.get("_base")))
+        if "_base" not in record:
+            snapshots[offset] = version.get("content", "")
+        yield version
+
+def _read_log(log_file):
+    """Decode every version of a log in one pass"""
+    return list(_iter_log(log_file))
+
+def _public_metadata(entry):
+    return {key: value for key, value in entry.items() if not key.startswith("_")}
+
+def _scan_log(log_file, start=0):
+    """Yield (offset, length, record) for every complete record of a log from ``start``
+
+    A torn last line left by a crash during an append is ignored.
+    """
+    with open(log_file, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            length = len(line)
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                break
+            yield offset, length, record
+            offset += length
+
+def _write_index(index_file, entries):
+    atomic_write(index_file, b"".join(_encode_record(entry) for entry in entries), sync=VERSION_LOG_FSYNC)
+
+def _truncate_torn_tail(f):
+    """Drop a partial record at the end of an open log so the next append starts on a new line"""
+    size = f.seek(0, os.SEEK_END)
+    if size == 0:
+        return 0
+    f.seek(size - 1)
+    if f.read(1) == b"\n":
+        return size
+    # Walk back to the end of the last complete record
+    position = size
+    while position > 0:
+        step = min(4096, position)
+        f.seek(position - step)
+        chunk = f.read(step)
+        newline = chunk.rfind(b"\n")
+        if newline != -1:
+            position = position - step + newline + 1
+            break
+        position -= step
+    f.truncate(position)
+    return position
+
+
+class JsonStorage:
+    """Flat-file backend: scripts.json plus an append-only version log per script"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        # (log file, inode, offset, version number) -> content of recently used snapshot records
+        self._snapshots = OrderedDict()
+        self._snapshots_lock = threading.Lock()
+
+    def _scripts_path(self):
+        return os.path.join(self.data_dir, "scripts.json")
+
+    def _log_path(self, script_id):
+        return os.path.join(self.data_dir, f"versions_{script_id}.jsonl")
+
+    def _index_path(self, script_id):
+        return os.path.join(self.data_dir, f"versions_{script_id}.idx")
+
+    def _legacy_path(self, script_id):
+        return os.path.join(self.data_dir, f"versions_{script_id}.json")
+
+    def _lock_path(self, script_id):
+        return os.path.join(self.data_dir, f"versions_{script_id}.lock")
+
+    def _scripts_lock_path(self):
+        return os.path.join(self.data_dir, "scripts.json.lock")
+
+    def load_scripts(self):
+        """Load all scripts from the scripts.json file"""
+        scripts_file = self._scripts_path()
+        if os.path.exists(scripts_file):
+            with open(scripts_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {"scripts": []}
+
+    def scripts_version(self):
+        """Return a value that changes whenever the list of scripts is rewritten"""
+        try:
+            stat = os.stat(self._scripts_path())
+        except FileNotFoundError:
+            return None
+        # Every save replaces the file, so the inode changes even within the resolution of mtime
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write_scripts(self, scripts_data):
+        data = json.dumps(scripts_data, ensure_ascii=False, indent=4).encode("utf-8")
+        atomic_write(self._scripts_path(), data)
+
+    def save_scripts(self, scripts_data):
+        """Save all scripts to the scripts.json file, replacing the stored list"""
+        with file_lock(self._scripts_lock_path()):
+            self._write_scripts(scripts_data)
+
+    def upsert_scripts(self, scripts):
+        """Add scripts or replace the stored scripts with the same ids, keeping all other scripts"""
+        with file_lock(self._scripts_lock_path()):
+            scripts_data = self.load_scripts()
+            positions = {stored["id"]: i for i, stored in enumerate(scripts_data["scripts"])}
+            for script in scripts:
+                if script["id"] in positions:
+                    scripts_data["scripts"][positions[script["id"]]] = script
+                else:
+                    positions[script["id"]] = len(scripts_data["scripts"])
+                    scripts_data["scripts"].append(script)
+            self._write_scripts(scripts_data)
+
+    def upsert_script(self, script):
+        """Add a script or replace the stored script with the same id"""
+        self.upsert_scripts([script])
+
+    def delete_script(self, script_id):
+        """Remove a script from the stored list; its versions are kept"""
+        with file_lock(self._scripts_lock_path()):
+            scripts_data = self.load_scripts()
+            scripts_data["scripts"] = [script for script in scripts_data["scripts"] if script["id"] != script_id]
+            self._write_scripts(scripts_data)
+
+    def script_ids_with_versions(self):
+        """Return the ids of all scripts that have stored versions"""
+        ids = set()
+        for pattern in ("versions_*.jsonl", "versions_*.json"):
+            for path in glob.glob(os.path.join(self.data_dir, pattern)):
+                name = os.path.basename(path)
+                ids.add(name[len("versions_"):name.rindex(".")])
+        return sorted(ids)
+
+    def _migrate_legacy(self, script_id, locked=False):
+        """Convert a legacy versions_<id>.json file into the append-only log, once
+
+        The conversion runs under the script's lock, which ``locked`` tells the
+        caller already holds; another thread or process may be converting the
+        same file.
+        """
+        legacy_file = self._legacy_path(script_id)
+        if os.path.exists(self._log_path(script_id)) or not os.path.exists(legacy_file):
+            return
+        if not locked:
+            with file_lock(self._lock_path(script_id)):
+                self._migrate_legacy(script_id, locked=True)
+            return
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            versions = json.load(f)
+        for i, version in enumerate(versions):
+            version.setdefault("version_number", i + 1)
+        self._replace_log(script_id, versions)
+        # Keep the original file as a backup rather than deleting user data
+        os.replace(legacy_file, legacy_file + ".bak")
+
+    def _read_index(self, script_id, locked=False):
+        """Read the index of a script, rebuilding any entries missing after a crash
+
+        An index that lags behind its log is repaired under the script's lock,
+        since another thread or process may be appending at the same time.
+        ``locked`` tells that the caller already holds that lock.
+        """
+        self._migrate_legacy(script_id, locked)
+        log_file = self._log_path(script_id)
+        if not os.path.exists(log_file):
+            return []
+
+        entries = self._load_index_entries(script_id)
+        if self._index_end(entries) == os.path.getsize(log_file) and os.path.exists(self._index_path(script_id)):
+            return entries
+        if not locked:
+            with file_lock(self._lock_path(script_id)):
+                return self._read_index(script_id, locked=True)
+
+        index_file = self._index_path(script_id)
+        # The log is written before the index, so the index normally can only lag behind it.
+        # An index pointing past the end of the log is stale and rebuilt from scratch.
+        log_size = os.path.getsize(log_file)
+        indexed_end = self._index_end(entries)
+        if indexed_end > log_size:
+            entries = []
+            indexed_end = 0
+        if indexed_end < log_size:
+            missing = [_index_entry(record, offset, length)
+                       for offset, length, record in _scan_log(log_file, indexed_end)]
+            if missing or not os.path.exists(index_file):
+                entries.extend(missing)
+                _write_index(index_file, entries)
+        elif not os.path.exists(index_file):
+            _write_index(index_file, entries)
+        return entries
+
+    @staticmethod
+    def _index_end(entries):
+        return entries[-1]["_offset"] + entries[-1]["_length"] if entries else 0
+
+    def _load_index_entries(self, script_id):
+        """Return the complete entries of the index file of a script"""
+        entries = []
+        index_file = self._index_path(script_id)
+        if os.path.exists(index_file):
+            with open(index_file, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entries.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        break
+        return entries
+
+    @staticmethod
+    def _snapshot_key(log_file, entry):
+        # Another process may rewrite the log, putting other records at the same offsets.
+        # A rewrite replaces the file, so the inode and the snapshot's number tell the logs apart.
+        return log_file, os.stat(log_file).st_ino, entry["_offset"], entry.get("version_number")
+
+    def _cache_snapshot(self, key, content):
+        with self._snapshots_lock:
+            self._snapshots[key] = content
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > VERSION_SNAPSHOT_CACHE_SIZE:
+                self._snapshots.popitem(last=False)
+
+    def _forget_snapshots(self, log_file):
+        with self._snapshots_lock:
+            for key in [key for key in self._snapshots if key[0] == log_file]:
+                del self._snapshots[key]
+
+    def _snapshot_content(self, log_file, entry):
+        """Return the content of the snapshot record of a log with the index entry ``entry``"""
+        key = self._snapshot_key(log_file, entry)
+        with self._snapshots_lock:
+            content = self._snapshots.get(key)
+            if content is not None:
+                self._snapshots.move_to_end(key)
+                return content
+        with open(log_file, "rb") as f:
+            f.seek(entry["_offset"])
+            content = _decode_version(json.loads(f.readline().decode("utf-8"))).get("content", "")
+        self._cache_snapshot(key, content)
+        return content
+
+    def _latest_snapshot(self, log_file, entries):
+        """Return the (offset, content) a new version may be stored as a delta against, or None"""
+        for position in range(len(entries) - 1, -1, -1):
+            if "_base" not in entries[position]:
+                if len(entries) - position >= VERSION_KEYFRAME_INTERVAL:
+                    return None
+                return entries[position]["_offset"], self._snapshot_content(log_file, entries[position])
+        return None
+
+    def append_version(self, script_id, version, prepare=None):
+        """Append a single version to the log of a script and return its metadata
+
+        If another session or process has stored a version with the same number
+        in the meantime, the version gets the next free number instead; the
+        returned metadata holds the number it was stored under. ``prepare`` is
+        called with the version once its final number is known, before it is
+        written, to fill in fields that depend on the number.
+        """
+        with file_lock(self._lock_path(script_id)):
+            entries = self._read_index(script_id, locked=True)
+            if any(entry["version_number"] == version["version_number"] for entry in entries):
+                version = dict(version, version_number=max(entry["version_number"] for entry in entries) + 1)
+            if prepare is not None:
+                prepare(version)
+            log_file = self._log_path(script_id)
+            snapshot = self._latest_snapshot(log_file, entries) if VERSION_COMPRESSION else None
+            encoded = _encode_version(version, snapshot)
+            record = _encode_record(encoded)
+
+            with open(log_file, "a+b") as f:
+                offset = _truncate_torn_tail(f)
+                f.seek(0, os.SEEK_END)
+                f.write(record)
+                _sync(f)
+            entry = _index_entry(encoded, offset, len(record))
+            if "_base" not in encoded:
+                self._cache_snapshot(self._snapshot_key(log_file, entry), version.get("content", ""))
+            with open(self._index_path(script_id), "ab") as f:
+                f.write(_encode_record(entry))
+                _sync(f)
+        return _public_metadata(entry)
+
+    def versions_version(self, script_id):
+        """Return a value that changes whenever stored versions of a script are rewritten
+
+        Appends leave it unchanged, since they do not change the versions
+        stored before. Every rewrite replaces the log and index files.
+        """
+        version = []
+        for path in (self._log_path(script_id), self._index_path(script_id)):
+            try:
+                version.append(os.stat(path).st_ino)
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def write_versions(self, script_id, versions):
+        """Replace all versions of a script, rewriting its log and index"""
+        with file_lock(self._lock_path(script_id)):
+            self._replace_log(script_id, versions)
+
+    def update_versions(self, script_id, update):
+        """Call ``update`` on every version of a script and store the versions it reports as changed
+
+        ``update`` changes a version in place and returns whether it did. The
+        log is rewritten under the script's lock, so versions appended
+        concurrently are not lost. Returns the number of changed versions.
+        """
+        with file_lock(self._lock_path(script_id)):
+            self._read_index(script_id, locked=True)
+            log_file = self._log_path(script_id)
+            if not os.path.exists(log_file):
+                return 0
+            versions = _read_log(log_file)
+            changed = sum(1 for version in versions if update(version))
+            if changed:
+                self._replace_log(script_id, versions)
+        return changed
+
+    def _replace_log(self, script_id, versions):
+        log_file = self._log_path(script_id)
+        entries = []
+        # Only written with the lock of the script held, so a fixed temporary name is safe
+        tmp_file = log_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            for record, entry in _encode_log(versions):
+                f.write(record)
+                entries.append(entry)
+            _sync(f)
+        os.replace(tmp_file, log_file)
+        # Offsets of the old log now point at different records
+        self._forget_snapshots(log_file)
+        _write_index(self._index_path(script_id), entries)
+
+    def list_versions(self, script_id):
+        """List the metadata of all versions of a script without reading their content"""
+        return [_public_metadata(entry) for entry in self._read_index(script_id)]
+
+    def read_version(self, script_id, version_number):
+        """Read a single version of a script by seeking directly to its record"""
+        log_file = self._log_path(script_id)
+        entries = self._read_index(script_id)
+        for entry in entries:
+            if entry.get("version_number") == version_number:
+                with open(log_file, "rb") as f:
+                    f.seek(entry["_offset"])
+                    record = json.loads(f.read(entry["_length"]).decode("utf-8"))
+                base_content = None
+                if "_base" in entry:
+                    base_entry = next(base for base in entries if base["_offset"] == entry["_base"])
+                    base_content = self._snapshot_content(log_file, base_entry)
+                return _decode_version(record, base_content)
+        return None
+
+    def load_versions(self, script_id):
+        """Load all versions of a script, with content, in one pass over the log"""
+        self._read_index(script_id)
+        log_file = self._log_path(script_id)
+        if not os.path.exists(log_file):
+            return []
+        return _read_log(log_file)
+
+    def iter_versions(self, script_id):
+        """Yield the versions of a script with their content one at a time, without holding them all"""
+        self._read_index(script_id)
+        log_file = self._log_path(script_id)
+        if os.path.exists(log_file):
+            yield from _iter_log(log_file)
+
+    def space_report(self):
+        """Compare the size of the stored versions with their plain and compressed encodings
+
+        Returns the number of scripts and versions and the bytes they take on disk
+        now, as plain log records and as compressed log records. Nothing is written.
+        """
+        report = {"scripts": 0, "versions": 0, "on_disk": 0, "plain": 0, "compressed": 0}
+        for script_id in self.script_ids_with_versions():
+            log_file = self._log_path(script_id)
+            if os.path.exists(log_file):
+                versions = _read_log(log_file)
+                files = [log_file, self._index_path(script_id)]
+            else:
+                with open(self._legacy_path(script_id), "r", encoding="utf-8") as f:
+                    versions = json.load(f)
+                files = [self._legacy_path(script_id)]
+            report["scripts"] += 1
+            report["versions"] += len(versions)
+            report["on_disk"] += sum(os.path.getsize(path) for path in files if os.path.exists(path))
+            for version in versions:
+                report["plain"] += len(_encode_record(version)) + len(_encode_record(_index_entry(version, 0, 0)))
+            for record, entry in _encode_log(versions):
+                report["compressed"] += len(record) + len(_encode_record(entry))
+        return report
+
+    def compact(self):
+        """Rewrite every version log of the data directory in the current format"""
+        script_ids = self.script_ids_with_versions()
+        for script_id in script_ids:
+            with file_lock(self._lock_path(script_id)):
+                self._migrate_legacy(script_id, locked=True)
+                self._replace_log(script_id, _read_log(self._log_path(script_id)))
+        return len(script_ids)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scripts (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scripts_created_at ON scripts (created_at);
+CREATE TABLE IF NOT EXISTS versions (
+    script_id TEXT NOT NULL,
+    version_number INTEGER NOT NULL,
+    timestamp TEXT,
+    metadata TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (script_id, version_number)
+);
+CREATE INDEX IF NOT EXISTS versions_script_timestamp ON versions (script_id, timestamp);
+-- Incremented whenever stored versions of a script are replaced or updated, not on appends
+CREATE TABLE IF NOT EXISTS version_generations (
+    script_id TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+"""
+
+
+class SqliteStorage:
+    """SQLite backend: scripts and versions as rows of one WAL-mode database"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # sqlite3 connections may not be shared between threads, so keep one per thread
+        self._local = threading.local()
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=" + ("FULL" if VERSION_LOG_FSYNC else "NORMAL"))
+            self._local.connection = connection
+        return connection
+
+    def load_scripts(self):
+        """Load all scripts in the order they were first saved"""
+        # Let SQLite join the rows into one JSON array, which parses much faster than row by row
+        (data,) = self._connection().execute(
+            "SELECT '[' || coalesce(group_concat(data, ','), '') || ']' FROM (SELECT data FROM scripts ORDER BY rowid)"
+        ).fetchone()
+        return {"scripts": json.loads(data)}
+
+    def save_scripts(self, scripts_data):
+        """Save all scripts, replacing the stored list
+
+        Only rows that actually changed are written.
+        """
+        with self._connection() as connection:
+            stored = dict(connection.execute("SELECT id, data FROM scripts"))
+            rows = []
+            for script in scripts_data["scripts"]:
+                data = json.dumps(script, ensure_ascii=False)
+                if stored.pop(script["id"], None) != data:
+                    rows.append((script["id"], script.get("title"), script.get("created_at"),
+                                 script.get("updated_at"), data))
+            # Whatever is left in the stored rows was removed from the list
+            connection.executemany("DELETE FROM scripts WHERE id = ?", [(script_id,) for script_id in stored])
+            # Upserts keep the rowid, and so the order, of existing scripts
+            connection.executemany(
+                "INSERT INTO scripts (id, title, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET title = excluded.title, created_at = excluded.created_at, "
+                "updated_at = excluded.updated_at, data = excluded.data",
+                rows
+            )
+
+    def scripts_version(self):
+        """Return a value that changes whenever the database is written to
+
+        Commits in WAL mode go to the -wal file, so both files are looked at.
+        """
+        version = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def upsert_scripts(self, scripts):
+        """Add scripts or replace the stored scripts with the same ids"""
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO scripts (id, title, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET title = excluded.title, created_at = excluded.created_at, "
+                "updated_at = excluded.updated_at, data = excluded.data",
+                [(script["id"], script.get("title"), script.get("created_at"), script.get("updated_at"),
+                  json.dumps(script, ensure_ascii=False)) for script in scripts]
+            )
+
+    def upsert_script(self, script):
+        """Add a script or replace the stored script with the same id"""
+        self.upsert_scripts([script])
+
+    def delete_script(self, script_id):
+        """Remove a script; its versions are kept"""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM scripts WHERE id = ?", (script_id,))
+
+    def script_ids_with_versions(self):
+        """Return the ids of all scripts that have stored versions"""
+        rows = self._connection().execute("SELECT DISTINCT script_id FROM versions ORDER BY script_id")
+        return [script_id for (script_id,) in rows]
+
+    def _version_row(self, script_id, version):
+        return (
+            script_id,
+            version["version_number"],
+            version.get("timestamp"),
+            json.dumps(version_metadata(version), ensure_ascii=False),
+            version.get("content", "")
+        )
+
+    def _version_from_row(self, row):
+        version = json.loads(row[0])
+        version.pop("content_length", None)
+        version["content"] = row[1]
+        return version
+
+    def append_version(self, script_id, version, prepare=None):
+        """Add a single version of a script and return its metadata
+
+        A version number that is already taken, e.g. by a concurrent session,
+        is replaced with the next free one, and ``prepare`` is called with the
+        version once its number is final, as in the JSON backend.
+        """
+        connection = self._connection()
+        with connection:
+            # Take the write lock before looking at the numbers, so two writers cannot pick the same one
+            connection.execute("BEGIN IMMEDIATE")
+            (taken,) = connection.execute(
+                "SELECT count(*) FROM versions WHERE script_id = ? AND version_number = ?",
+                (script_id, version["version_number"])
+            ).fetchone()
+            if taken:
+                (last,) = connection.execute(
+                    "SELECT max(version_number) FROM versions WHERE script_id = ?", (script_id,)
+                ).fetchone()
+                version = dict(version, version_number=last + 1)
+            if prepare is not None:
+                prepare(version)
+            connection.execute(
+                "INSERT INTO versions (script_id, version_number, timestamp, metadata, content) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self._version_row(script_id, version)
+            )
+        return version_metadata(version)
+
+    @staticmethod
+    def _bump_generation(connection, script_id):
+        connection.execute(
+            "INSERT INTO version_generations (script_id, generation) VALUES (?, 1) "
+            "ON CONFLICT (script_id) DO UPDATE SET generation = generation + 1",
+            (script_id,)
+        )
+
+    def versions_version(self, script_id):
+        """Return a value that changes whenever stored versions of a script are replaced or updated"""
+        row = self._connection().execute(
+            "SELECT generation FROM version_generations WHERE script_id = ?", (script_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def write_versions(self, script_id, versions):
+        """Replace all versions of a script"""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM versions WHERE script_id = ?", (script_id,))
+            connection.executemany(
+                "INSERT INTO versions (script_id, version_number, timestamp, metadata, content) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [self._version_row(script_id, version) for version in versions]
+            )
+            self._bump_generation(connection, script_id)
+
+    def update_versions(self, script_id, update):
+        """Call ``update`` on every version of a script and store the versions it reports as changed"""
+        connection = self._connection()
+        changed = 0
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT metadata, content FROM versions WHERE script_id = ? ORDER BY version_number", (script_id,)
+            ).fetchall()
+            for row in rows:
+                version = self._version_from_row(row)
+                if update(version):
+                    connection.execute(
+                        "UPDATE versions SET metadata = ? WHERE script_id = ? AND version_number = ?",
+                        (json.dumps(version_metadata(version), ensure_ascii=False), script_id,
+                         version["version_number"])
+                    )
+                    changed += 1
+            if changed:
+                self._bump_generation(connection, script_id)
+        return changed
+
+    def list_versions(self, script_id):
+        """List the metadata of all versions of a script without reading their content"""
+        rows = self._connection().execute(
+            "SELECT metadata FROM versions WHERE script_id = ? ORDER BY version_number", (script_id,)
+        )
+        return [json.loads(metadata) for (metadata,) in rows]
+
+    def read_version(self, script_id, version_number):
+        """Read a single version of a script"""
+        row = self._connection().execute(
+            "SELECT metadata, content FROM versions WHERE script_id = ? AND version_number = ?",
+            (script_id, version_number)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._version_from_row(row)
+
+    def load_versions(self, script_id):
+        """Load all versions of a script with their content"""
+        rows = self._connection().execute(
+            "SELECT metadata, content FROM versions WHERE script_id = ? ORDER BY version_number", (script_id,)
+        )
+        return [self._version_from_row(row) for row in rows]
+
+    def iter_versions(self, script_id):
+        """Yield the versions of a script with their content one row at a time"""
+        rows = self._connection().execute(
+            "SELECT metadata, content FROM versions WHERE script_id = ? ORDER BY version_number", (script_id,)
+        )
+        for row in rows:
+            yield self._version_from_row(row)
+
+
+def open_storage(backend=STORAGE_BACKEND, data_dir=DATA_DIR, db_path=SQLITE_DB_PATH):
+    """Create a storage backend by name"""
+    if backend == "json":
+        return JsonStorage(data_dir)
+    if backend == "sqlite":
+        return SqliteStorage(db_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def import_json_to_sqlite(data_dir=DATA_DIR, db_path=SQLITE_DB_PATH):
+    """Copy all scripts and versions of a JSON data directory into a SQLite database"""
+    source = JsonStorage(data_dir)
+    target = SqliteStorage(db_path)
+
+    scripts_data = source.load_scripts()
+    target.save_scripts(scripts_data)
+
+    # Also pick up versions of scripts that are missing from scripts.json
+    version_count = 0
+    script_ids = source.script_ids_with_versions()
+    for script_id in script_ids:
+        versions = source.load_versions(script_id)
+        for i, version in enumerate(versions):
+            version.setdefault("version_number", i + 1)
+        target.write_versions(script_id, versions)
+        version_count += len(versions)
+    return len(scripts_data["scripts"]), len(script_ids), version_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of the script storage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import-sqlite", help="copy the JSON data directory into SQLite")
+    import_parser.add_argument("--data-dir", default=DATA_DIR)
+    import_parser.add_argument("--db", default=SQLITE_DB_PATH)
+
+    report_parser = subparsers.add_parser("report", help="show how much space compressed version logs save")
+    report_parser.add_argument("--data-dir", default=DATA_DIR)
+
+    compact_parser = subparsers.add_parser("compact", help="rewrite all version logs in the compressed format")
+    compact_parser.add_argument("--data-dir", default=DATA_DIR)
+
+    backfill_parser = subparsers.add_parser("backfill-token-counts",
+                                            help="store token counts with versions saved without them")
+    backfill_parser.add_argument("--backend", choices=["json", "sqlite"], default=STORAGE_BACKEND)
+    backfill_parser.add_argument("--data-dir", default=DATA_DIR)
+    backfill_parser.add_argument("--db", default=SQLITE_DB_PATH)
+
+    args = parser.parse_args()
+    if args.command == "report":
+        report = JsonStorage(args.data_dir).space_report()
+        saved = 1 - report["compressed"] / report["plain"] if report["plain"] else 0
+        print(f"{report['versions']} versions of {report['scripts']} scripts in {args.data_dir}")
+        print(f"{'on disk now':<22}{report['on_disk'] / 1024:>12,.1f} KB")
+        print(f"{'plain records':<22}{report['plain'] / 1024:>12,.1f} KB")
+        print(f"{'compressed records':<22}{report['compressed'] / 1024:>12,.1f} KB"
+              f"   ({saved:.0%} smaller, snapshot every {VERSION_KEYFRAME_INTERVAL} versions)")
+    elif args.command == "compact":
+        scripts = JsonStorage(args.data_dir).compact()
+        print(f"Rewrote the version logs of {scripts} scripts in {args.data_dir}")
+    elif args.command == "backfill-token-counts":
+        # Counting needs the tokenizer, which the rest of the storage does not
+        import utils
+        target = open_storage(args.backend, args.data_dir, args.db)
+        scripts, versions = utils.backfill_token_counts(target)
+        print(f"Stored token counts of {versions} versions of {scripts} scripts")
+    elif args.command == "import-sqlite":
+        scripts, scripts_with_versions, versions = import_json_to_sqlite(args.data_dir, args.db)
+        print(f"Imported {scripts} scripts and {versions} versions "
+              f"of {scripts_with_versions} scripts into {args.db}")
+        print('Set STORAGE_BACKEND = "sqlite" in config.py to use the database.')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Tests of reading damaged archives"""
+import os
+import gzip
+
+import pytest
+
+import archive
+import storage
+
+
+def make_archive(directory, scripts=20):
+    source = storage.JsonStorage(os.path.join(directory, "source"))
+    for i in range(scripts):
+        script_id = f"s{i:03d}"
+        source.upsert_script({"id": script_id, "title": f"Сценарий {i}", "brief": "", "created_at": "",
+                              "updated_at": "2024-01-01 00:00:00"})
+        content = f"Текст сценария {i}\n" * 20
+        source.write_versions(script_id, [{"version_number": 1, "timestamp": "", "model": "gpt-4o",
+                                           "content": content}])
+    path = os.path.join(directory, "all.jsonl.gz")
+    assert archive.export_archive(source, path) == (scripts, scripts)
+    return path
+
+# What follows the first half of an archive: the rest cut off, bytes that are not a gzip member
+# and a gzip member whose first deflate block has the reserved block type
+DAMAGE = {
+    "truncated": b"",
+    "not gzip": b"garbage after the first member",
+    "bad deflate block": b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff\xff\xff\xff\xff",
+}
+
+@pytest.mark.parametrize("damage", sorted(DAMAGE))
+def test_damaged_archive_keeps_complete_scripts(tmp_path, damage):
+    path = make_archive(str(tmp_path))
+    with gzip.open(path, "rb") as f:
+        lines = f.readlines()
+    with open(path, "wb") as f:
+        f.write(gzip.compress(b"".join(lines[:len(lines) // 2])))
+        f.write(DAMAGE[damage])
+
+    target = storage.JsonStorage(str(tmp_path / "target"))
+    with pytest.raises(archive.ArchiveError, match="truncated or corrupt"):
+        archive.import_archive(target, path)
+    imported = target.load_scripts()["scripts"]
+    assert 0 < len(imported) < 20
+    for script in imported:
+        assert len(target.load_versions(script["id"])) == 1
+
+def test_file_that_is_not_gzip_is_not_an_archive(tmp_path):
+    path = str(tmp_path / "plain.jsonl.gz")
+    with open(path, "wb") as f:
+        f.write(b'{"format": "author-archive"}\n')
+    with pytest.raises(archive.ArchiveError, match="not a script archive"):
+        archive.import_archive(storage.JsonStorage(str(tmp_path / "target")), path)
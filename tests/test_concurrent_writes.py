@@ -0,0 +1,119 @@
+"""Tests of concurrent appends to both storage backends"""
+import os
+import json
+import threading
+import multiprocessing
+
+import pytest
+
+import storage
+
+
+def make_version(number, content):
+    return {"version_number": number, "timestamp": "2024-01-01 00:00:00", "prompt": "prompt",
+            "model": "gpt-4o", "content": content}
+
+def open_backend(backend, directory):
+    return storage.open_storage(backend, str(directory), os.path.join(str(directory), "author.db"))
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_appends_get_distinct_numbers(tmp_path, backend):
+    target = open_backend(backend, tmp_path)
+    target.write_versions("s", [make_version(1, "Первая\n")])
+    threads = 8
+    barrier = threading.Barrier(threads)
+    numbers = []
+    errors = []
+
+    def append(i):
+        try:
+            barrier.wait()
+            # Every thread asks for the same number, as concurrent sessions do
+            metadata = target.append_version("s", make_version(2, f"Вариант {i}\n"))
+            numbers.append(metadata["version_number"])
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=append, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert not errors
+    assert sorted(numbers) == list(range(2, threads + 2))
+    reopened = open_backend(backend, tmp_path)
+    stored = reopened.load_versions("s")
+    assert [v["version_number"] for v in stored] == list(range(1, threads + 2))
+    assert sorted(v["content"] for v in stored[1:]) == sorted(f"Вариант {i}\n" for i in range(threads))
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_prepare_sees_the_final_number(tmp_path, backend):
+    target = open_backend(backend, tmp_path)
+    target.write_versions("s", [make_version(1, "Первая\n"), make_version(2, "Вторая\n")])
+
+    def prepare(version):
+        version["seen_number"] = version["version_number"]
+    metadata = target.append_version("s", make_version(2, "Новая\n"), prepare=prepare)
+
+    assert metadata["version_number"] == 3
+    assert open_backend(backend, tmp_path).read_version("s", 3)["seen_number"] == 3
+
+def _append_in_process(backend, directory, i):
+    metadata = open_backend(backend, directory).append_version("s", make_version(2, f"Процесс {i}\n"))
+    return metadata["version_number"]
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_appends_from_processes(tmp_path, backend):
+    open_backend(backend, tmp_path).write_versions("s", [make_version(1, "Первая\n")])
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(4) as pool:
+        numbers = pool.starmap(_append_in_process, [(backend, str(tmp_path), i) for i in range(8)])
+
+    assert sorted(numbers) == list(range(2, 10))
+    assert [v["version_number"] for v in open_backend(backend, tmp_path).load_versions("s")] == list(range(1, 10))
+
+def test_legacy_file_is_migrated_once_by_concurrent_readers(tmp_path):
+    versions = [make_version(n, f"Текст {n}\n") for n in range(1, 6)]
+    with open(tmp_path / "versions_s.json", "w", encoding="utf-8") as f:
+        json.dump(versions, f, ensure_ascii=False)
+    threads = 8
+    barrier = threading.Barrier(threads)
+    results = []
+    errors = []
+
+    def read():
+        try:
+            # Every thread has its own instance, as separate processes do
+            target = storage.JsonStorage(str(tmp_path))
+            barrier.wait()
+            results.append([(v["version_number"], v["content"]) for v in target.load_versions("s")])
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=read) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert not errors
+    assert results == [[(v["version_number"], v["content"]) for v in versions]] * threads
+    assert os.path.exists(tmp_path / "versions_s.json.bak")
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_versions_version_changes_when_versions_are_rewritten(tmp_path, backend):
+    target = open_backend(backend, tmp_path)
+    target.write_versions("s", [make_version(1, "Первая\n")])
+    written = target.versions_version("s")
+
+    target.append_version("s", make_version(2, "Вторая\n"))
+    assert target.versions_version("s") == written
+    # Another instance, as another process, rewrites the versions
+    other = open_backend(backend, tmp_path)
+    assert other.update_versions("s", lambda version: version.update(token_counts={}) is None) == 2
+    updated = target.versions_version("s")
+    assert updated != written
+    other.write_versions("s", [make_version(1, "Другая\n")])
+    assert target.versions_version("s") not in (written, updated)
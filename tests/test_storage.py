@@ -0,0 +1,125 @@
+"""Tests of the compressed version logs of the JSON storage"""
+import os
+import json
+
+import pytest
+
+import storage
+
+
+def make_version(number, content=None):
+    if content is None:
+        content = "".join(f"Сцена {line}: текст версии {number if line % 7 == 0 else 0}\n" for line in range(40))
+    return {"version_number": number, "timestamp": f"2024-01-01 00:00:{number % 60:02d}",
+            "prompt": f"prompt {number}", "model": "gpt-4o", "content": content}
+
+def log_records(target, script_id):
+    with open(target._log_path(script_id), "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def keyframes(monkeypatch):
+    monkeypatch.setattr(storage, "VERSION_COMPRESSION", True)
+    monkeypatch.setattr(storage, "VERSION_KEYFRAME_INTERVAL", 3)
+
+
+def test_deltas_round_trip_across_keyframes(tmp_path, keyframes):
+    target = storage.JsonStorage(str(tmp_path))
+    versions = [make_version(n) for n in range(1, 11)]
+    target.write_versions("s", versions[:5])
+    for version in versions[5:]:
+        target.append_version("s", dict(version))
+
+    records = log_records(target, "s")
+    assert sum("_delta" in record for record in records) > 0
+    # A delta always refers to a snapshot less than a keyframe interval before it
+    offsets = [entry["_offset"] for entry in target._read_index("s")]
+    for position, record in enumerate(records):
+        if "_base" in record:
+            base = offsets.index(record["_base"])
+            assert "_base" not in records[base] and position - base < 3
+
+    assert target.load_versions("s") == versions
+    assert list(target.iter_versions("s")) == versions
+    # A fresh instance has no snapshots cached and reads every record from disk
+    fresh = storage.JsonStorage(str(tmp_path))
+    for version in versions:
+        assert fresh.read_version("s", version["version_number"]) == version
+    assert [entry["content_length"] for entry in fresh.list_versions("s")] == [len(v["content"]) for v in versions]
+
+def test_plain_records_are_read_next_to_compressed_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "VERSION_COMPRESSION", False)
+    target = storage.JsonStorage(str(tmp_path))
+    plain = [make_version(n) for n in range(1, 4)]
+    target.write_versions("s", plain)
+    assert all("content" in record for record in log_records(target, "s"))
+
+    monkeypatch.setattr(storage, "VERSION_COMPRESSION", True)
+    appended = [make_version(n) for n in range(4, 7)]
+    for version in appended:
+        target.append_version("s", dict(version))
+
+    assert target.load_versions("s") == plain + appended
+    assert storage.JsonStorage(str(tmp_path)).read_version("s", 2) == plain[1]
+
+def test_legacy_json_file_is_migrated(tmp_path, keyframes):
+    versions = [make_version(n) for n in range(1, 5)]
+    with open(tmp_path / "versions_s.json", "w", encoding="utf-8") as f:
+        json.dump(versions, f, ensure_ascii=False)
+
+    target = storage.JsonStorage(str(tmp_path))
+    assert target.load_versions("s") == versions
+    assert os.path.exists(tmp_path / "versions_s.json.bak")
+    assert not os.path.exists(tmp_path / "versions_s.json")
+    assert target.read_version("s", 3) == versions[2]
+
+def test_compact_rewrites_plain_logs(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "VERSION_COMPRESSION", False)
+    target = storage.JsonStorage(str(tmp_path))
+    versions = {script_id: [make_version(n) for n in range(1, 8)] for script_id in ("a", "b")}
+    for script_id, script_versions in versions.items():
+        target.write_versions(script_id, script_versions)
+    plain_size = os.path.getsize(target._log_path("a"))
+
+    monkeypatch.setattr(storage, "VERSION_COMPRESSION", True)
+    monkeypatch.setattr(storage, "VERSION_KEYFRAME_INTERVAL", 3)
+    assert target.compact() == 2
+
+    assert os.path.getsize(target._log_path("a")) < plain_size
+    assert all("content" not in record for record in log_records(target, "a"))
+    fresh = storage.JsonStorage(str(tmp_path))
+    for script_id, script_versions in versions.items():
+        assert fresh.load_versions(script_id) == script_versions
+        assert fresh.read_version(script_id, 6) == script_versions[5]
+    # Appending after a compaction continues the delta chain of the rewritten log
+    fresh.append_version("a", make_version(8))
+    assert storage.JsonStorage(str(tmp_path)).read_version("a", 8) == make_version(8)
+
+def test_update_versions_keeps_content(tmp_path, keyframes):
+    target = storage.JsonStorage(str(tmp_path))
+    versions = [make_version(n) for n in range(1, 6)]
+    target.write_versions("s", versions)
+
+    def update(version):
+        if version["version_number"] % 2:
+            version["token_counts"] = {"test": version["version_number"]}
+            return True
+        return False
+    assert target.update_versions("s", update) == 3
+
+    loaded = storage.JsonStorage(str(tmp_path)).load_versions("s")
+    assert [v["content"] for v in loaded] == [v["content"] for v in versions]
+    assert [v.get("token_counts") for v in loaded] == [{"test": 1}, None, {"test": 3}, None, {"test": 5}]
+
+def test_cached_snapshots_do_not_outlive_a_rewrite_by_another_instance(tmp_path, keyframes):
+    reader = storage.JsonStorage(str(tmp_path))
+    writer = storage.JsonStorage(str(tmp_path))
+    reader.write_versions("s", [make_version(n) for n in range(1, 4)])
+    assert reader.read_version("s", 2) == make_version(2)
+
+    # Same numbers and offsets, other content: the reader's cached snapshot of version 1 is stale
+    rewritten = [make_version(n, make_version(n)["content"].replace("Сцена", "Кадр ")) for n in range(1, 4)]
+    writer.write_versions("s", rewritten)
+    assert reader.read_version("s", 2) == rewritten[1]
+    assert reader.read_version("s", 3) == rewritten[2]
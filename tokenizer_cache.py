@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Local cache of the tiktoken encoding files, so token counting works offline.
+
+tiktoken downloads the file of an encoding the first time it is used and keeps
+it in the directory named by the TIKTOKEN_CACHE_DIR environment variable. Here
+that directory is config.TIKTOKEN_CACHE_DIR, filled once on a host with network
+access and shipped with the app to hosts without it:
+
+    python tokenizer_cache.py prewarm
+    python tokenizer_cache.py check
+
+Prewarming also writes a manifest of the encoding of every model, so run.py can
+check the cache at startup with a few stat calls instead of importing tiktoken.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import importlib.metadata
+
+from config import MODELS, TIKTOKEN_CACHE_DIR
+from locking import atomic_write
+
+# Encoding of models tiktoken does not know, used by the GPT-4 family
+FALLBACK_ENCODING = "cl100k_base"
+
+# Where tiktoken downloads the encodings from; the cached file is named after the hash of the URL
+ENCODING_URLS = {
+    "cl100k_base": "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
+    "o200k_base": "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken",
+}
+
+MANIFEST_FILE = "manifest.json"
+
+
+class EncodingUnavailable(RuntimeError):
+    """Raised when an encoding is neither in the cache directory nor downloadable"""
+
+
+def configure():
+    """Point tiktoken at the cache directory of the app, unless TIKTOKEN_CACHE_DIR is already set"""
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+    return os.environ["TIKTOKEN_CACHE_DIR"]
+
+def cache_path(encoding_name):
+    """Return the path of the cached file of an encoding, or None if its URL is unknown"""
+    url = ENCODING_URLS.get(encoding_name)
+    if url is None:
+        return None
+    return os.path.join(configure(), hashlib.sha1(url.encode()).hexdigest())
+
+def installed_tiktoken_version():
+    try:
+        return importlib.metadata.version("tiktoken")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def load_encoding(model):
+    """Load the tiktoken encoding of a model from the cache directory, downloading it if it is missing"""
+    configure()
+    import tiktoken
+    import tiktoken.model
+    try:
+        name = tiktoken.model.encoding_name_for_model(model)
+    except KeyError:
+        name = FALLBACK_ENCODING
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        path = cache_path(name)
+        if path is not None and os.path.exists(path):
+            raise
+        raise EncodingUnavailable(
+            f"The tiktoken encoding {name} is not in {configure()} and could not be downloaded ({e}). "
+            f"Run \"python tokenizer_cache.py prewarm\" on a host with network access and copy the directory here."
+        ) from e
+
+def read_manifest():
+    try:
+        with open(os.path.join(configure(), MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def missing_models(models=MODELS):
+    """Return the models whose encoding is not known to be in the cache directory, without importing tiktoken"""
+    manifest = read_manifest()
+    # Another tiktoken version may map the models to other encodings
+    if manifest.get("tiktoken") != installed_tiktoken_version():
+        return list(models)
+    missing = []
+    for model in models:
+        name = manifest.get("models", {}).get(model)
+        path = cache_path(name) if name else None
+        if name is None or (path is not None and not os.path.exists(path)):
+            missing.append(model)
+    return missing
+
+def prewarm(models=MODELS):
+    """Load the encodings of all models into the cache directory and write the manifest; returns model -> encoding"""
+    encodings = {model: load_encoding(model).name for model in models}
+    manifest = {"tiktoken": installed_tiktoken_version(), "models": encodings}
+    atomic_write(os.path.join(configure(), MANIFEST_FILE), json.dumps(manifest, indent=4).encode("utf-8"))
+    return encodings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("prewarm", help="download the encodings of all models into the cache directory")
+    subparsers.add_parser("check", help="report the models whose encoding is missing from the cache directory")
+    args = parser.parse_args()
+
+    if args.command == "prewarm":
+        for model, name in prewarm().items():
+            print(f"{model:<20}  {name}")
+        print(f"Encodings cached in {configure()}", file=sys.stderr)
+        return
+    missing = missing_models()
+    if missing:
+        print(f"Not cached in {configure()}: {', '.join(missing)}", file=sys.stderr)
+        sys.exit(1)
+    print(f"All encodings cached in {configure()}")
+
+if __name__ == "__main__":
+    main()
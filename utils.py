@@ -1,32 +1,178 @@
 import os
+import re
 import json
-import tiktoken
-import streamlit as st
+import random
+import hashlib
+import functools
+import threading
+import email.utils
+import difflib
+import datetime
+import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import (
     MODELS,
     DEFAULT_SYSTEM_PROMPT as SYSTEM_PROMPT,
     OUTPUT_ESTIMATION_FACTOR,
     MIN_OUTPUT_TOKENS,
-    DEFAULT_TEMPERATURE
+    DEFAULT_TEMPERATURE,
+    OPENAI_BASE_URL,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_POOL_SIZE,
+    HTTP_MAX_RETRIES,
+    HTTP_BACKOFF_BASE,
+    HTTP_BACKOFF_MAX,
+    HTTP_RETRY_AFTER_MAX,
+    HTTP_RETRY_STATUS_CODES,
+    TOKEN_COUNT_CACHE_SIZE,
+    DATA_DIR,
+    STORAGE_BACKEND,
+    VERSION_CONTENT_CACHE_SIZE,
+    MAX_PARALLEL_VARIANTS,
+    MAX_TOKENS_ENABLED,
+    COMPLETION_CACHE_ENABLED,
+    DIFF_CONTEXT_LINES,
+    PROMPT_LAYOUT,
+    PACK_MAX_VERSIONS,
+    PACK_MIN_TRUNCATED_TOKENS,
+    LEDGER_ENFORCE_TPD
 )
+from rate_limiter import get_rate_limiter
+from completion_cache import get_completion_cache, completion_key
+from metrics import get_metrics, timed, PhaseTimer
+from ledger import get_ledger
+from output_predictor import get_output_predictor, stored_versions
+from tokenizer_cache import load_encoding
+import storage
 
 # Ensure data directory exists
-DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Tokens added by the chat format around every message (3 framing tokens plus the role)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens that prime the assistant reply
+REPLY_OVERHEAD_TOKENS = 3
+
+# Token counts memoized by (encoding name, content hash), shared by all sessions
+_token_count_cache = OrderedDict()
+_token_count_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o"):
+    """Resolve the tiktoken encoding for a model, once per model
+
+    tiktoken is imported on first use and reads its files from
+    config.TIKTOKEN_CACHE_DIR, see tokenizer_cache.
+    """
+    return load_encoding(model)
+
+def prewarm_encodings(models=None):
+    """Load the encodings of the models in a background thread, so the first token count does not wait for them"""
+    def load():
+        for model in models or MODELS:
+            try:
+                get_encoding(model)
+            except Exception:
+                # The first token count reports the error
+                pass
+    thread = threading.Thread(target=load, name="prewarm-encodings", daemon=True)
+    thread.start()
+    return thread
+
+def content_hash(text):
+    """Return a stable hash of a text, used as a cache key"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
 def count_tokens(text, model="gpt-4o"):
-    """Count the number of tokens in a text string for a given model"""
-    try:
-        # Try to get the encoding for the specified model
-        enc = tiktoken.encoding_for_model(model)
-    except KeyError:
-        # If the model is not directly supported, use the cl100k_base encoding
-        # which is used by newer models like GPT-4 and GPT-4o family
-        enc = tiktoken.get_encoding("cl100k_base")
+    """Count the number of tokens in a text string for a given model
+
+    Counts are memoized by content hash, so unchanged texts are never re-encoded.
+    """
+    enc = get_encoding(model)
+    key = (enc.name, content_hash(text))
+    
+    with _token_count_cache_lock:
+        if key in _token_count_cache:
+            _token_count_cache.move_to_end(key)
+            return _token_count_cache[key]
     
-    return len(enc.encode(text))
+    count = len(enc.encode(text, disallowed_special=()))
+    
+    with _token_count_cache_lock:
+        _token_count_cache[key] = count
+        while len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return count
+
+def count_part_tokens(part, model="gpt-4o"):
+    """Count the tokens of a context part
+
+    For previous versions the count is stored in the version record under
+    ``token_counts``, keyed by encoding and content hash, so it is computed
+    once and persisted with the version.
+    """
+    version = part.get("version")
+    if version is None:
+        return count_tokens(part["content"], model)
+    
+    key = f"{get_encoding(model).name}:{content_hash(part['content'])}"
+    token_counts = version.setdefault("token_counts", {})
+    if key not in token_counts:
+        token_counts[key] = count_tokens(part["content"], model)
+    return token_counts[key]
+
+def count_version_tokens(version, model=None):
+    """Count the tokens of a version as a context part into its ``token_counts``; returns whether they were missing
+
+    ``model`` defaults to the model that generated the version.
+    """
+    counted = len(version.get("token_counts") or {})
+    count_part_tokens({"content": format_version_part(version), "version": version},
+                      model or version.get("model", "gpt-4o"))
+    return len(version["token_counts"]) > counted
+
+def backfill_token_counts(target=None, models=None):
+    """Store the missing token counts of all stored versions, for the encodings of ``models`` (default: all)
+
+    Versions saved before token counts were stored with them are otherwise
+    counted again on every rerun. Returns (scripts, versions) updated.
+    """
+    target = target or get_storage()
+    models = list(models or MODELS)
+
+    def update(version):
+        # One count per encoding is enough, since the key is per encoding
+        added = [count_version_tokens(version, model) for model in
+                 {get_encoding(model).name: model for model in models}.values()]
+        return any(added)
+
+    scripts = versions = 0
+    for script_id in target.script_ids_with_versions():
+        changed = target.update_versions(script_id, update)
+        if changed:
+            scripts += 1
+            versions += changed
+    return scripts, versions
+
+def count_context_tokens(system_prompt, context_parts, model="gpt-4o", layout=PROMPT_LAYOUT):
+    """Count the input tokens of a request built from a system prompt and context parts
+
+    Returns the total, including the chat message framing, and the list of
+    per-part counts.
+    """
+    part_tokens = [count_part_tokens(part, model) for part in context_parts]
+    total = (
+        count_tokens(layout_text(system_prompt, layout), model)
+        + sum(part_tokens)
+        + MESSAGE_OVERHEAD_TOKENS * (len(context_parts) + 1)
+        + REPLY_OVERHEAD_TOKENS
+    )
+    return total, part_tokens
 
 def estimate_cost(input_tokens, estimated_output_tokens, model="gpt-4o"):
     """Estimate the cost of a request based on input and output tokens"""
@@ -35,124 +181,974 @@ def estimate_cost(input_tokens, estimated_output_tokens, model="gpt-4o"):
     return input_cost + output_cost
 
 def estimate_output_tokens(brief_length):
-    """Estimate the number of output tokens based on the brief length"""
+    """Estimate the number of output tokens based on the brief length
+
+    A rough rule used until enough versions are stored for predict_output.
+    """
     return max(brief_length * OUTPUT_ESTIMATION_FACTOR, MIN_OUTPUT_TOKENS)
 
-def generate_script(messages, model="gpt-4o", temperature=DEFAULT_TEMPERATURE):
-    """Generate a script using the OpenAI API directly via HTTP"""
-    try:
-        # Get API key from Streamlit secrets
+_predictor_bootstrap_lock = threading.Lock()
+_predictor_bootstrap = None
+
+def bootstrap_output_predictor():
+    """Fit the output predictor on the stored versions in a background thread, if it has no file yet
+
+    The first prediction of a data directory would otherwise wait for a scan
+    of every script's versions. Returns the thread, or None if there is
+    nothing to do. ``python output_predictor.py rebuild`` does the same
+    ahead of time.
+    """
+    global _predictor_bootstrap
+    predictor = get_output_predictor()
+    with _predictor_bootstrap_lock:
+        if predictor.exists() or (_predictor_bootstrap is not None and _predictor_bootstrap.is_alive()):
+            return None
+        _predictor_bootstrap = threading.Thread(target=lambda: predictor.rebuild(stored_versions(get_storage())),
+                                                name="bootstrap-output-predictor", daemon=True)
+        _predictor_bootstrap.start()
+        return _predictor_bootstrap
+
+def predict_output(model, input_tokens, previous_versions=0, brief_length=0):
+    """Predict the output tokens of a request from the stored versions, see output_predictor
+
+    Returns the dict of OutputPredictor.predict with ``fitted`` set. Until
+    there are enough stored versions, ``tokens`` is estimate_output_tokens,
+    the interval is half to twice that, ``max_tokens`` is None and
+    ``fitted`` is false, as while the predictor of a new data directory is
+    still being fitted in the background. ``max_tokens`` is also None with
+    config.MAX_TOKENS_ENABLED off, and never exceeds what is left of the
+    context window.
+    """
+    predictor = get_output_predictor()
+    if not predictor.exists():
+        bootstrap_output_predictor()
+    prediction = predictor.predict(model, input_tokens, previous_versions)
+    if prediction is None:
+        tokens = estimate_output_tokens(brief_length)
+        return {"tokens": tokens, "low": tokens // 2, "high": tokens * 2, "max_tokens": None, "samples": 0,
+                "pooled": False, "seconds_low": None, "seconds_high": None, "fitted": False}
+    prediction["fitted"] = True
+    if not MAX_TOKENS_ENABLED:
+        prediction["max_tokens"] = None
+    elif model in MODELS:
+        prediction["max_tokens"] = max(min(prediction["max_tokens"], MODELS[model]["context_window"] - input_tokens), 1)
+    return prediction
+
+def _api_headers():
+    """Build the HTTP headers for the OpenAI API using the key from Streamlit secrets
+
+    The OPENAI_API_KEY environment variable takes precedence, which lets the
+    command-line tools run without a secrets file.
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        # Streamlit is only imported when the key has to come from its secrets
+        import streamlit as st
         api_key = st.secrets["openai"]["api_key"]
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+# Process-wide HTTP session, shared by all Streamlit sessions so connections are reused
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Return the process-wide pooled keep-alive HTTP session"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                # Retries are handled in _post_chat_completion so that Retry-After is honored
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+def _retry_delay(attempt, response=None):
+    """Compute how long to wait before retry number ``attempt`` (counting from 0)
+
+    A wait requested by the server through ``retry-after-ms`` or ``Retry-After``
+    is honored up to HTTP_RETRY_AFTER_MAX; None is returned for a longer one,
+    so the request fails instead of blocking the session.
+    """
+    if response is not None:
+        delay = None
+        retry_after_ms = response.headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                delay = max(float(retry_after_ms) / 1000, 0.0)
+            except ValueError:
+                pass
         
-        # Directly use the requests library to make the API call
-        # This avoids any proxy issues that might be in the OpenAI client
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        data = {
-            "model": model,
-            "messages": messages,
-            "temperature": temperature
-        }
+        retry_after = response.headers.get("Retry-After")
+        if delay is None and retry_after:
+            try:
+                delay = max(float(retry_after), 0.0)
+            except ValueError:
+                # Retry-After may also be an HTTP date
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    delay = max(retry_at.timestamp() - time.time(), 0.0)
+                except (TypeError, ValueError):
+                    pass
+        if delay is not None:
+            return delay if delay <= HTTP_RETRY_AFTER_MAX else None
+    
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def _post_chat_completion(data, stream=False):
+    """POST a chat completion request, retrying connection errors, 429 and 5xx responses
+
+    A read timeout is not retried: the server may already be generating, and
+    billing, the completion of the first request.
+    """
+    url = f"{OPENAI_BASE_URL.rstrip('/')}/chat/completions"
+    session = get_http_session()
+    headers = _api_headers()
+    
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            response = session.post(
+                url,
+                headers=headers,
+                json=data,
+                stream=stream,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+            )
+        except requests.ConnectionError:
+            # Includes connect timeouts, when the request has not reached the server
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
         
-        # Make the API call
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=data
-        )
+        if response.status_code in HTTP_RETRY_STATUS_CODES and attempt < HTTP_MAX_RETRIES:
+            delay = _retry_delay(attempt, response)
+            if delay is None:
+                # The server asks to wait longer than we are willing to; the caller reports the error
+                return response
+            response.close()
+            time.sleep(delay)
+            continue
         
-        # Check for successful response
-        if response.status_code == 200:
-            return response.json()["choices"][0]["message"]["content"]
-        else:
-            # Handle API errors
+        return response
+
+def _reserved_tokens(messages, model, input_tokens, estimated_output_tokens):
+    """Return the input tokens of a request and the total to reserve in the rate limiter"""
+    if input_tokens is None:
+        input_tokens = sum(count_tokens(m["content"], model) for m in messages)
+    if estimated_output_tokens is None:
+        estimated_output_tokens = MIN_OUTPUT_TOKENS
+    return input_tokens, input_tokens + estimated_output_tokens
+
+def _iter_sse_data(response, stats=None):
+    """Yield the parsed JSON payloads of a server-sent events stream
+
+    The time spent parsing is added to ``stats["parse_time"]`` if given.
+    """
+    for line in response.iter_lines():
+        # Skip keep-alive blank lines and SSE comments
+        if not line or line.startswith(b":"):
+            continue
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[len(b"data:"):].strip()
+        if payload == b"[DONE]":
+            return
+        parse_started = time.perf_counter()
+        data = json.loads(payload.decode("utf-8"))
+        if stats is not None:
+            stats["parse_time"] += time.perf_counter() - parse_started
+        yield data
+
+def stream_script(messages, model="gpt-4o", temperature=DEFAULT_TEMPERATURE, stats=None,
+                  input_tokens=None, estimated_output_tokens=None, on_wait=None,
+                  use_cache=None, refresh_cache=False, max_tokens=None):
+    """Generate a script using the streaming OpenAI API, yielding content deltas as they arrive
+
+    If a ``stats`` dict is given it is filled with ``time_to_first_token``,
+    ``duration``, ``rate_limit_wait`` and ``parse_time`` (all in seconds),
+    ``finish_reason``, the ``usage`` reported by the API and ``cache_hit``. It
+    is updated even if the stream fails part way, so the caller can keep what
+    already arrived. The timings are also recorded as metrics per model.
+    The request waits for admission by the rate limiter, which reserves
+    ``input_tokens`` plus ``estimated_output_tokens``; ``on_wait`` is called
+    with the estimated wait in seconds and the queue position while waiting.
+    
+    With ``use_cache`` (default: config.COMPLETION_CACHE_ENABLED) an identical
+    earlier request is answered from the completion cache in a single chunk;
+    ``refresh_cache`` skips the lookup but still stores the new answer.
+    ``max_tokens`` caps the length of the answer; an answer cut by it ends
+    with ``finish_reason`` "length" and is not cached.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({
+        "time_to_first_token": None,
+        "duration": None,
+        "rate_limit_wait": None,
+        "parse_time": 0.0,
+        "finish_reason": None,
+        "usage": None,
+        "cache_hit": False
+    })
+    metrics = get_metrics()
+    
+    if use_cache is None:
+        use_cache = COMPLETION_CACHE_ENABLED
+    cache_key = completion_key(model, messages, temperature) if use_cache else None
+    if cache_key is not None:
+        cache = get_completion_cache()
+        started = time.perf_counter()
+        cached = None if refresh_cache else cache.get(cache_key)
+        if refresh_cache:
+            cache.count_bypass()
+        if cached is not None:
+            stats.update({
+                "time_to_first_token": time.perf_counter() - started,
+                "duration": time.perf_counter() - started,
+                "rate_limit_wait": 0.0,
+                "finish_reason": cached.get("finish_reason"),
+                "usage": cached.get("usage"),
+                "cache_hit": True
+            })
+            metrics.observe("openai_request_seconds", stats["duration"], model=model, outcome="cached")
+            yield cached["content"]
+            return
+    
+    data = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    
+    limiter = get_rate_limiter()
+    input_tokens, reserved_tokens = _reserved_tokens(messages, model, input_tokens, estimated_output_tokens)
+    wait_started = time.perf_counter()
+    reservation = limiter.acquire(model, reserved_tokens, on_wait=on_wait)
+    stats["rate_limit_wait"] = time.perf_counter() - wait_started
+    metrics.observe("rate_limit_wait_seconds", stats["rate_limit_wait"], model=model)
+    # Every content chunk carries about one token, which is used if the stream breaks before the usage arrives
+    streamed_chunks = 0
+    # The full answer is only assembled when it will be cached
+    cached_chunks = [] if cache_key is not None else None
+    
+    started = time.perf_counter()
+    try:
+        response = _post_chat_completion(data, stream=True)
+    except Exception:
+        limiter.reconcile(reservation, 0)
+        raise
+    try:
+        if response.status_code != 200:
             error_info = response.json() if response.content else {"error": f"Status code: {response.status_code}"}
-            st.error(f"API Error: {error_info}")
             raise Exception(f"OpenAI API error: {error_info}")
+        
+        for chunk in _iter_sse_data(response, stats):
+            if chunk.get("usage"):
+                stats["usage"] = chunk["usage"]
+            
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
             
+            if choices[0].get("finish_reason"):
+                stats["finish_reason"] = choices[0]["finish_reason"]
+            
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                if stats["time_to_first_token"] is None:
+                    stats["time_to_first_token"] = time.perf_counter() - started
+                streamed_chunks += 1
+                if cached_chunks is not None:
+                    cached_chunks.append(delta)
+                yield delta
+        
+        # Only complete answers are cached, not ones cut short by max_tokens
+        if (cached_chunks is not None and stats["finish_reason"] is not None
+                and not (max_tokens and stats["finish_reason"] == "length")):
+            get_completion_cache().put(cache_key, {
+                "content": "".join(cached_chunks),
+                "finish_reason": stats["finish_reason"],
+                "usage": stats["usage"]
+            })
+    finally:
+        response.close()
+        stats["duration"] = time.perf_counter() - started
+        outcome = "complete" if stats["finish_reason"] is not None else "incomplete"
+        metrics.observe("openai_request_seconds", stats["duration"], model=model, outcome=outcome)
+        if stats["time_to_first_token"] is not None:
+            metrics.observe("openai_time_to_first_token_seconds", stats["time_to_first_token"], model=model)
+        metrics.observe("openai_json_parse_seconds", stats["parse_time"], model=model)
+        
+        if stats["usage"]:
+            used_tokens = stats["usage"].get("total_tokens", reservation["tokens"])
+        elif response.status_code == 200:
+            used_tokens = input_tokens + streamed_chunks
+        else:
+            used_tokens = 0
+        limiter.reconcile(reservation, used_tokens)
+
+# Process-wide storage backend, selected by config.STORAGE_BACKEND
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """Return the process-wide storage backend"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = storage.open_storage(STORAGE_BACKEND, DATA_DIR)
+    return _storage
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is stopped on request"""
+
+def run_completion(messages, model="gpt-4o", temperature=DEFAULT_TEMPERATURE,
+                   input_tokens=None, estimated_output_tokens=None, on_wait=None,
+                   use_cache=None, refresh_cache=False, on_delta=None, should_stop=None, max_tokens=None):
+    """Run a streamed completion to the end without rendering it
+
+    Returns a dict with the ``content`` received, the generation ``stats`` (see
+    stream_script) and the ``error`` that interrupted the generation, if any;
+    content received before an error is kept. ``on_delta`` is called with every
+    content delta. If ``should_stop`` returns true the stream is closed and the
+    error is GenerationCancelled.
+    """
+    stats = {}
+    chunks = []
+    error = None
+    stream = stream_script(messages, model, temperature, stats,
+                           input_tokens=input_tokens,
+                           estimated_output_tokens=estimated_output_tokens,
+                           on_wait=on_wait,
+                           use_cache=use_cache,
+                           refresh_cache=refresh_cache,
+                           max_tokens=max_tokens)
+    try:
+        if should_stop is not None and should_stop():
+            raise GenerationCancelled("Generation cancelled")
+        for delta in stream:
+            chunks.append(delta)
+            if on_delta is not None:
+                on_delta(delta)
+            if should_stop is not None and should_stop():
+                raise GenerationCancelled("Generation cancelled")
     except Exception as e:
-        st.error(f"Error details: {str(e)}")
-        import traceback
-        st.error(f"Traceback: {traceback.format_exc()}")
-        raise Exception(f"Error generating script: {str(e)}")
+        error = e
+    finally:
+        # Closing the stream releases the connection and reconciles the rate limiter
+        stream.close()
+    return {"content": "".join(chunks), "stats": stats, "error": error}
+
+def generate_variants(messages, variants, max_workers=MAX_PARALLEL_VARIANTS,
+                      use_cache=None, refresh_cache=False):
+    """Generate several variants of the same request concurrently
+
+    ``variants`` is a list of dicts with ``model``, ``temperature`` and
+    optionally ``input_tokens``, ``estimated_output_tokens`` and ``max_tokens``. Every request
+    goes through the rate limiter. Yields ``(variant, result)`` pairs in the
+    order the variants complete, with results as returned by run_completion.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="variant")
+    try:
+        futures = {
+            executor.submit(
+                run_completion,
+                messages,
+                variant["model"],
+                variant["temperature"],
+                variant.get("input_tokens"),
+                variant.get("estimated_output_tokens"),
+                None,
+                use_cache,
+                refresh_cache,
+                max_tokens=variant.get("max_tokens")
+            ): variant
+            for variant in variants
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # If the caller stops early (e.g. a Streamlit rerun), don't start the remaining variants
+        executor.shutdown(wait=False, cancel_futures=True)
 
 def load_scripts():
-    """Load all scripts from the scripts.json file"""
-    scripts_file = os.path.join(DATA_DIR, "scripts.json")
-    if os.path.exists(scripts_file):
-        with open(scripts_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"scripts": []}
+    """Load all scripts"""
+    with timed("storage_seconds", operation="load_scripts"):
+        return get_storage().load_scripts()
 
 def save_scripts(scripts_data):
-    """Save all scripts to the scripts.json file"""
-    scripts_file = os.path.join(DATA_DIR, "scripts.json")
-    with open(scripts_file, "w", encoding="utf-8") as f:
-        json.dump(scripts_data, f, ensure_ascii=False, indent=4)
+    """Save all scripts"""
+    with timed("storage_seconds", operation="save_scripts"):
+        get_storage().save_scripts(scripts_data)
+
+def upsert_script(script):
+    """Add a script or replace the stored script with the same id, leaving the other scripts alone"""
+    with timed("storage_seconds", operation="upsert_script"):
+        get_storage().upsert_script(script)
+
+def upsert_scripts(scripts):
+    """Add or replace several scripts in one write"""
+    with timed("storage_seconds", operation="upsert_scripts"):
+        get_storage().upsert_scripts(scripts)
+
+def delete_script(script_id):
+    """Remove a script from the list of scripts"""
+    with timed("storage_seconds", operation="delete_script"):
+        get_storage().delete_script(script_id)
 
 def load_script_versions(script_id):
     """Load all versions of a specific script"""
-    filename = os.path.join(DATA_DIR, f"versions_{script_id}.json")
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    with timed("storage_seconds", operation="load_versions"):
+        return get_storage().load_versions(script_id)
 
 def save_script_versions(script_id, versions):
-    """Save all versions of a specific script"""
-    filename = os.path.join(DATA_DIR, f"versions_{script_id}.json")
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(versions, f, ensure_ascii=False, indent=4)
+    """Save all versions of a specific script, replacing the stored ones"""
+    with timed("storage_seconds", operation="write_versions"):
+        get_storage().write_versions(script_id, versions)
 
-def create_message_from_context(system_prompt, brief, selected_versions, user_prompt):
-    """Create a message list for the OpenAI API from context components"""
-    messages = [{"role": "system", "content": system_prompt}]
+def append_script_version(script_id, version, prepare=None):
+    """Add a single new version to a script without rewriting the existing ones"""
+    with timed("storage_seconds", operation="append_version"):
+        return get_storage().append_version(script_id, version, prepare)
+
+def list_script_versions(script_id):
+    """List the metadata of all versions of a script without loading their content"""
+    with timed("storage_seconds", operation="list_versions"):
+        return get_storage().list_versions(script_id)
+
+def load_script_version(script_id, version_number):
+    """Load a single version of a script with its content"""
+    with timed("storage_seconds", operation="read_version"):
+        return get_storage().read_version(script_id, version_number)
+
+# Contents of recently used versions, shared by all sessions and bounded in size.
+# Keyed with the storage's versions_version, so versions rewritten by another
+# process (archive import --replace, the token count backfill) are read again.
+_version_content_cache = OrderedDict()
+_version_content_cache_lock = threading.Lock()
+
+def _cache_version_content(key, content):
+    with _version_content_cache_lock:
+        _version_content_cache[key] = content
+        _version_content_cache.move_to_end(key)
+        while len(_version_content_cache) > VERSION_CONTENT_CACHE_SIZE:
+            _version_content_cache.popitem(last=False)
+
+def _version_content_key(script_id, version_number):
+    return script_id, version_number, get_storage().versions_version(script_id)
+
+def get_version_content(script_id, version_number):
+    """Return the content of a version, loading it on demand through a bounded LRU cache"""
+    key = _version_content_key(script_id, version_number)
+    with _version_content_cache_lock:
+        if key in _version_content_cache:
+            _version_content_cache.move_to_end(key)
+            return _version_content_cache[key]
     
-    # Add brief with clear formatting
-    brief_text = f"===== BRIEF SUMMARY =====\nBrief summary of the story: {brief}"
-    messages.append({"role": "user", "content": brief_text})
+    version = load_script_version(script_id, version_number)
+    content = version.get("content", "") if version else ""
+    _cache_version_content(key, content)
+    return content
+
+def with_version_content(script_id, metadata):
+    """Return a copy of a version metadata record with its content filled in
+
+    The copy shares the ``token_counts`` dict of the metadata record, so token
+    counts computed for it are kept with the lightweight record.
+    """
+    metadata.setdefault("token_counts", {})
+    version = dict(metadata)
+    version["content"] = get_version_content(script_id, metadata["version_number"])
+    return version
+
+def save_new_version(script_id, version):
+    """Save a new version, record its usage in the cost ledger and the output predictor and return its lightweight metadata record
+
+    The content goes to the version content cache, so the new version can be
+    shown right away without reading it back. The tokens of the version as a
+    context part are counted once its number is final, since the part starts
+    with the number, and stored with it.
+    """
+    metadata = append_script_version(script_id, version, prepare=count_version_tokens)
+    # The storage hands out the next free number if a concurrent generation took this one
+    version["version_number"] = metadata["version_number"]
+    version["token_counts"] = metadata.get("token_counts", {})
+    _cache_version_content(_version_content_key(script_id, version["version_number"]), version.get("content", ""))
+    if "cost" in version and not version.get("cache_hit"):
+        get_ledger().record({
+            "script_id": script_id,
+            "version_number": version["version_number"],
+            "model": version["model"],
+            "prompt_tokens": version["prompt_tokens"],
+            "completion_tokens": version["completion_tokens"],
+            "cached_tokens": version["cached_tokens"],
+            "cost": version["cost"],
+            "estimated": version.get("usage_estimated", False)
+        })
+    get_output_predictor().observe(version)
+    return metadata
+
+def _api_timings(stats):
+    """Return the timings of the API request of stream_script stats, by phase"""
+    timings = {"rate_limit_wait": stats.get("rate_limit_wait")}
+    if stats.get("time_to_first_token") is not None:
+        timings["api_first_token"] = stats["time_to_first_token"]
+        if stats.get("duration") is not None:
+            timings["api_streaming"] = stats["duration"] - stats["time_to_first_token"]
+    timings["json_parsing"] = stats.get("parse_time")
+    return {phase: seconds for phase, seconds in timings.items() if seconds is not None}
+
+def build_version(version_number, prompt, content, model, temperature, input_tokens,
+                  estimated_cost, context, stats=None, error=None, timings=None):
+    """Build the record of a newly generated version
+
+    ``stats`` are the generation stats of stream_script; a version cut short by
+    ``error`` is marked as partial. ``timings`` are the durations of the local
+    phases before the request; they are stored with the timings of the request
+    itself. The tokens of the version are counted when it is saved, see
+    save_new_version.
     
-    # Add selected previous versions with their actual version numbers and clear formatting
-    for version in selected_versions:
-        # Get version number from the version object
-        version_number = version.get('version_number', 0)
-        version_text = (
-            f"===== PREVIOUS VERSION {version_number} =====\n"
-            f"Prompt: {version.get('prompt', 'No prompt')}\n\n"
-            f"Content: {version.get('content', 'No content')}"
+    The actual usage and cost come from the usage reported by the API. A stream
+    that broke before the usage arrived is billed anyway, so its usage is
+    estimated from the input tokens and the content, and marked as estimated.
+    An answer from the completion cache cost nothing.
+    """
+    stats = stats or {}
+    version = {
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model,
+        "temperature": temperature,
+        "prompt": prompt,
+        "content": content,
+        "input_tokens": input_tokens,
+        "estimated_cost": estimated_cost,
+        "context": context,
+        "time_to_first_token": stats.get("time_to_first_token"),
+        "generation_time": stats.get("duration"),
+        "finish_reason": stats.get("finish_reason"),
+        "version_number": version_number
+    }
+    usage = stats.get("usage")
+    if stats.get("cache_hit"):
+        version["cache_hit"] = True
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    elif not usage:
+        usage = {"prompt_tokens": input_tokens, "completion_tokens": count_tokens(content, model)}
+        version["usage_estimated"] = True
+    version["prompt_tokens"], version["completion_tokens"], version["cached_tokens"] = usage_tokens(usage)
+    version["cost"] = usage_cost(usage, model)
+    if error is not None:
+        version["partial"] = True
+        version["error"] = str(error)
+    
+    build_started = time.perf_counter()
+    version["timings"] = {
+        **(timings or {}),
+        **_api_timings(stats),
+        "build_version": time.perf_counter() - build_started
+    }
+    get_metrics().observe("generation_phase_seconds", version["timings"]["build_version"],
+                          phase="build_version", model=model)
+    return version
+
+# One lock per script, so versions generated concurrently for a script get distinct numbers
+_script_locks = {}
+_script_locks_lock = threading.Lock()
+
+def script_lock(script_id):
+    """Return the process-wide lock that serializes adding versions to a script"""
+    with _script_locks_lock:
+        return _script_locks.setdefault(script_id, threading.Lock())
+
+def save_next_version(script_id, version):
+    """Number a new version after the stored versions of its script and save it, see save_new_version
+
+    Only this takes the script lock, so generations of a script never wait
+    for each other's API requests. A version stored by another process in the
+    meantime is handled by the storage, which renumbers the new version.
+    """
+    with script_lock(script_id):
+        version["version_number"] = max((v["version_number"] for v in list_script_versions(script_id)),
+                                        default=0) + 1
+        return save_new_version(script_id, version)
+
+# Script ids handed out by this process, so sessions creating scripts in the same second get distinct ids
+_issued_script_ids = set()
+_issued_script_ids_lock = threading.Lock()
+
+def new_script_id(existing_ids=()):
+    """Return a timestamp id for a new script, unique among ``existing_ids`` and the ids issued before"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    with _issued_script_ids_lock:
+        script_id = timestamp
+        suffix = 1
+        while script_id in _issued_script_ids or script_id in existing_ids:
+            script_id = f"{timestamp}-{suffix}"
+            suffix += 1
+        _issued_script_ids.add(script_id)
+    return script_id
+
+def usage_tokens(usage):
+    """Return the prompt, completion and cached prompt tokens of the usage reported by the API"""
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), cached_tokens
+
+def usage_cost(usage, model):
+    """Return the cost of a request from the token usage reported by the API
+
+    Prompt tokens served from the API prompt cache are charged at the cached input price.
+    """
+    prompt_tokens, completion_tokens, cached_tokens = usage_tokens(usage)
+    prices = MODELS[model]
+    cached_cost = (cached_tokens / 1000000) * prices.get("cached_input_cost", prices["input_cost"])
+    return estimate_cost(prompt_tokens - cached_tokens, completion_tokens, model) + cached_cost
+
+def generate_version(script, user_prompt, model="gpt-4o", temperature=DEFAULT_TEMPERATURE,
+                     version_numbers=(), system_prompt=SYSTEM_PROMPT, context_mode="full",
+                     use_cache=None, refresh_cache=False, on_wait=None, on_delta=None, should_stop=None,
+                     version_token_limits=None):
+    """Generate a new version of a script and save it, without any UI
+
+    ``version_numbers`` are the previous versions sent as context; those in
+    ``version_token_limits`` (version number -> tokens, see pack_context) are
+    cut with truncate_version. Generations of a script run concurrently:
+    only numbering and saving the new version take the script lock, see
+    save_next_version. Returns a dict with the saved ``version`` metadata
+    (None if nothing was saved), the ``error`` if any, the generation
+    ``stats``, ``input_tokens``, ``estimated_cost`` and the ``timings`` of the
+    local phases. A cancelled generation (see
+    run_completion) is not saved. Raises ValueError if the context does not
+    fit the model, and ledger.BudgetExceeded if config.LEDGER_ENFORCE_TPD is
+    set and today's tokens of the model are used up.
+    """
+    timer = PhaseTimer("generation_phase_seconds", model=model)
+    with timer.phase("prompt_assembly"):
+        versions = list_script_versions(script["id"])
+        versions_by_number = {v["version_number"]: v for v in versions}
+        selected_versions = [with_version_content(script["id"], versions_by_number[n])
+                             for n in sorted(version_numbers) if n in versions_by_number]
+        for i, version in enumerate(selected_versions):
+            if version["version_number"] in (version_token_limits or {}):
+                selected_versions[i] = truncate_version(
+                    version, version_token_limits[version["version_number"]], model) or version
+
+        context_parts = get_context_parts(script["brief"], selected_versions, user_prompt, context_mode)
+        messages = create_message_from_context(system_prompt, script["brief"], selected_versions,
+                                               user_prompt, context_mode)
+    with timer.phase("token_counting"):
+        input_tokens, _ = count_context_tokens(system_prompt, context_parts, model)
+    if input_tokens > MODELS[model]["context_window"]:
+        raise ValueError(f"Context of {input_tokens:,} tokens exceeds the context window of {model}")
+    prediction = predict_output(model, input_tokens, len(selected_versions), len(script["brief"]))
+    estimated_output_tokens = prediction["tokens"]
+    estimated_cost = estimate_cost(input_tokens, estimated_output_tokens, model)
+    if LEDGER_ENFORCE_TPD:
+        get_ledger().check_daily_tokens(model, input_tokens + estimated_output_tokens)
+
+    result = run_completion(messages, model, temperature,
+                            input_tokens=input_tokens,
+                            estimated_output_tokens=estimated_output_tokens,
+                            on_wait=on_wait,
+                            use_cache=use_cache,
+                            refresh_cache=refresh_cache,
+                            on_delta=on_delta,
+                            should_stop=should_stop,
+                            max_tokens=prediction["max_tokens"])
+    metadata = None
+    if result["content"] and not isinstance(result["error"], GenerationCancelled):
+        # Keep a partial answer as a version, like the app does
+        version = build_version(
+            max(versions_by_number, default=0) + 1,
+            user_prompt,
+            result["content"],
+            model,
+            temperature,
+            input_tokens,
+            estimated_cost,
+            [p["type"] for p in context_parts],
+            result["stats"],
+            result["error"],
+            timer.timings
         )
-        messages.append({"role": "user", "content": version_text})
+        # The save itself is only recorded as a metric, since the record is already written
+        with timer.phase("storage_save"):
+            metadata = save_next_version(script["id"], version)
+
+    return {
+        "version": metadata,
+        "error": result["error"],
+        "stats": result["stats"],
+        "input_tokens": input_tokens,
+        "estimated_cost": estimated_cost,
+        "timings": timer.timings
+    }
+
+def format_version_part(version):
+    """Format a previous version as a context part, with its actual version number"""
+    # Get version number from the version object
+    version_number = version.get('version_number', 0)
+    return (
+        f"===== PREVIOUS VERSION {version_number} =====\n"
+        f"Prompt: {version.get('prompt', 'No prompt')}\n\n"
+        f"Content: {version.get('content', 'No content')}"
+    )
+
+@functools.lru_cache(maxsize=64)
+def version_diff(old_content, new_content, old_number, new_number):
+    """Return a compact unified diff between the contents of two versions"""
+    diff = difflib.unified_diff(
+        old_content.splitlines(),
+        new_content.splitlines(),
+        fromfile=f"version {old_number}",
+        tofile=f"version {new_number}",
+        n=DIFF_CONTEXT_LINES,
+        lineterm=""
+    )
+    return "\n".join(diff)
+
+def format_version_diff_part(version, base_version):
+    """Format a previous version as the changes against an earlier selected version
+
+    Returns None when the diff would not be shorter than the full version.
+    """
+    version_number = version.get('version_number', 0)
+    base_number = base_version.get('version_number', 0)
+    diff = version_diff(base_version.get('content', ''), version.get('content', ''), base_number, version_number)
+    if len(diff) >= len(version.get('content', '')):
+        return None
+    return (
+        f"===== PREVIOUS VERSION {version_number} (CHANGES AGAINST VERSION {base_number}) =====\n"
+        f"Prompt: {version.get('prompt', 'No prompt')}\n\n"
+        f"Content: unified diff against version {base_number}; lines starting with \"-\" were removed, "
+        f"lines starting with \"+\" were added, all other text is unchanged.\n"
+        f"{diff}"
+    )
+
+def canonical_text(text):
+    """Normalize text typed by a user so the same prompt always has the same bytes
+
+    Line endings become ``\\n``, Unicode is NFC-normalized, trailing whitespace
+    of every line and leading and trailing blank lines are dropped.
+    """
+    text = unicodedata.normalize("NFC", text.replace("\r\n", "\n").replace("\r", "\n"))
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip("\n")
+
+def layout_text(text, layout=PROMPT_LAYOUT):
+    """Return user-typed text as it is sent with the given message layout"""
+    return canonical_text(text) if layout == "cache" else text
+
+def create_message_from_context(system_prompt, brief, selected_versions, user_prompt, context_mode="full",
+                                layout=PROMPT_LAYOUT):
+    """Create a message list for the OpenAI API from context components"""
+    messages = [{"role": "system", "content": layout_text(system_prompt, layout)}]
     
-    # Add current prompt with clear formatting
-    formatted_user_prompt = f"===== CURRENT REQUEST =====\n{user_prompt}"
-    messages.append({"role": "user", "content": formatted_user_prompt})
+    # Every context part (brief, previous versions, current request) is a separate user message
+    for part in get_context_parts(brief, selected_versions, user_prompt, context_mode, layout):
+        messages.append({"role": "user", "content": part["content"]})
     
     return messages
 
-def get_context_parts(brief, selected_versions, user_prompt):
-    """Get a list of context parts for display"""
+def get_context_parts(brief, selected_versions, user_prompt, context_mode="full", layout=PROMPT_LAYOUT):
+    """Get a list of context parts for display, in the order they are sent
+
+    With ``context_mode="diff"`` the oldest selected version is sent in full and
+    every later one as a unified diff against the selected version before it.
+    Parts built from full previous versions keep a reference to their version
+    record under ``version``, which lets count_part_tokens reuse stored token counts.
+
+    With ``layout="cache"`` the stored versions, which never change, come before
+    the editable brief, and the brief and the request are normalized with
+    canonical_text; see config.PROMPT_LAYOUT.
+    """
     context_parts = []
     
     # Add brief with clear formatting
-    brief_text = f"===== BRIEF SUMMARY =====\nBrief summary of the story: {brief}"
-    context_parts.append({"type": "Brief Summary", "content": brief_text})
+    brief_text = f"===== BRIEF SUMMARY =====\nBrief summary of the story: {layout_text(brief, layout)}"
+    brief_part = {"type": "Brief Summary", "content": brief_text}
+    if layout != "cache":
+        context_parts.append(brief_part)
     
     # Add selected previous versions with their actual version numbers and clear formatting
-    for version in selected_versions:
-        # Get version number from the version object
+    previous = None
+    for version in sorted(selected_versions, key=lambda v: v.get('version_number', 0)):
         version_number = version.get('version_number', 0)
-        version_text = (
-            f"===== PREVIOUS VERSION {version_number} =====\n"
-            f"Prompt: {version.get('prompt', 'No prompt')}\n\n"
-            f"Content: {version.get('content', 'No content')}"
-        )
-        context_parts.append({"type": f"Previous Version {version_number}", "content": version_text})
+        diff_text = None
+        if context_mode == "diff" and previous is not None:
+            diff_text = format_version_diff_part(version, previous)
+        
+        if diff_text is not None:
+            context_parts.append({"type": f"Previous Version {version_number} (diff)", "content": diff_text})
+        else:
+            context_parts.append({
+                "type": f"Previous Version {version_number}",
+                "content": format_version_part(version),
+                "version": version
+            })
+        previous = version
+    
+    if layout == "cache":
+        context_parts.append(brief_part)
     
     # Add current prompt with clear formatting
-    formatted_user_prompt = f"===== CURRENT REQUEST =====\n{user_prompt}"
+    formatted_user_prompt = f"===== CURRENT REQUEST =====\n{layout_text(user_prompt, layout)}"
     context_parts.append({"type": "Current Request", "content": formatted_user_prompt})
     
-    return context_parts 
\ No newline at end of file
+    return context_parts
+
+# Lines that start a scene of a script: "СЦЕНА 2", "### Scene 3", "**Эпизод 1**", "[СЦЕНА: ...]", "INT. ..."
+SCENE_HEADING = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]*|\*{1,2}[ \t]*|\[[ \t]*)?(?:(?:сцена|scene|эпизод|episode|глава|chapter|акт|act)\b|(?:int|ext)\.)",
+    re.IGNORECASE | re.MULTILINE
+)
+
+def split_scenes(content):
+    """Split the content of a version into scenes, at scene headings or else at blank lines
+
+    Joining the returned pieces gives back the content; the first piece is
+    whatever comes before the first heading, e.g. the title.
+    """
+    starts = [match.start() for match in SCENE_HEADING.finditer(content)]
+    if len(starts) < 2:
+        starts = [match.end() for match in re.finditer(r"\n[ \t]*\n", content)]
+    bounds = [0] + [start for start in starts if start > 0] + [len(content)]
+    return [content[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def stored_part_tokens(version, model="gpt-4o"):
+    """Return the tokens of a version sent in full, from its stored counts only, or None if none is stored"""
+    prefix = f"{get_encoding(model).name}:"
+    counts = [count for key, count in (version.get("token_counts") or {}).items() if key.startswith(prefix)]
+    return max(counts) if counts else None
+
+def truncate_version(version, max_tokens, model="gpt-4o"):
+    """Return a copy of a version with content cut to the leading whole scenes that fit in ``max_tokens``
+
+    ``max_tokens`` counts the whole context part (see format_version_part). The
+    copy notes how many scenes were left out, and carries ``truncated`` as
+    (scenes kept, scenes in total). Returns None if not even the first scene fits.
+    """
+    scenes = split_scenes(version.get("content", ""))
+    marker = "\n\n[Truncated: the remaining {omitted} of {total} scenes are left out to fit the context]"
+    header_tokens = count_tokens(format_version_part(dict(version, content=marker)), model)
+    available = max_tokens - header_tokens
+    kept = 0
+    for scene in scenes:
+        available -= count_tokens(scene, model)
+        if available < 0:
+            break
+        kept += 1
+    # Tokens of adjacent scenes can merge, so check the real count and give up scenes until it fits
+    while kept > 0:
+        content = "".join(scenes[:kept])
+        if kept < len(scenes):
+            content += marker.format(omitted=len(scenes) - kept, total=len(scenes))
+        # A fresh token_counts dict, so the count of the cut part is not stored with the full version
+        truncated = dict(version, content=content, token_counts={}, truncated=(kept, len(scenes)))
+        if count_part_tokens({"content": format_version_part(truncated), "version": truncated}, model) <= max_tokens:
+            return truncated
+        kept -= 1
+    return None
+
+def _words(text):
+    return set(re.findall(r"\w{3,}", (text or "").casefold()))
+
+def pack_context(versions, budget, base_tokens, user_prompt, model="gpt-4o", load_content=None,
+                 max_versions=PACK_MAX_VERSIONS):
+    """Choose the previous versions to send so the request fits in ``budget`` input tokens
+
+    ``versions`` are version metadata records and ``base_tokens`` the input
+    tokens of the request without any previous version. Versions are ranked by
+    recency plus the overlap of their prompt with ``user_prompt``, and added in
+    that order while they fit, up to ``max_versions``. The first one that does
+    not fit is cut at a scene boundary (see truncate_version) if at least
+    PACK_MIN_TRUNCATED_TOKENS of it fit, the rest are dropped. Only metadata is
+    read, except for versions without a stored token count and the one that is
+    cut, whose content is loaded with ``load_content(metadata)``.
+
+    Returns a dict with the chosen ``versions`` (with content, in version
+    order), ``token_limits`` (version number -> tokens of a cut version, to
+    rebuild it with truncate_version), ``included`` and ``dropped`` as lists of
+    (version number, tokens), ``truncated`` as (version number, tokens kept,
+    tokens in full, scenes kept, scenes in total) and the ``tokens`` used.
+    """
+    newest = max((v["version_number"] for v in versions), default=0)
+    prompt_words = _words(user_prompt)
+
+    def score(version):
+        recency = 1 / (1 + newest - version["version_number"])
+        version_words = _words(version.get("prompt"))
+        relevance = len(prompt_words & version_words) / len(prompt_words | version_words) if prompt_words else 0
+        return recency + relevance
+
+    loaded = {}
+    def content_of(version):
+        if version["version_number"] not in loaded:
+            loaded[version["version_number"]] = load_content(version)
+        return loaded[version["version_number"]]
+
+    def full_tokens(version):
+        tokens = stored_part_tokens(version, model)
+        if tokens is None:
+            full = content_of(version)
+            tokens = count_part_tokens({"content": format_version_part(full), "version": full}, model)
+        return tokens
+
+    used = base_tokens
+    chosen, token_limits, included, truncated, dropped = [], {}, [], [], []
+    for version in sorted(versions, key=score, reverse=True):
+        number = version["version_number"]
+        tokens = full_tokens(version)
+        remaining = budget - used - MESSAGE_OVERHEAD_TOKENS
+        if len(chosen) >= max_versions:
+            dropped.append((number, tokens))
+        elif tokens <= remaining:
+            chosen.append(content_of(version))
+            included.append((number, tokens))
+            used += tokens + MESSAGE_OVERHEAD_TOKENS
+        elif not truncated and remaining >= PACK_MIN_TRUNCATED_TOKENS:
+            cut = truncate_version(content_of(version), remaining, model)
+            if cut is None:
+                dropped.append((number, tokens))
+                continue
+            kept_tokens = count_part_tokens({"content": format_version_part(cut), "version": cut}, model)
+            chosen.append(cut)
+            token_limits[number] = remaining
+            truncated.append((number, kept_tokens, tokens) + cut["truncated"])
+            used += kept_tokens + MESSAGE_OVERHEAD_TOKENS
+        else:
+            dropped.append((number, tokens))
+
+    return {
+        "versions": sorted(chosen, key=lambda v: v["version_number"]),
+        "token_limits": token_limits,
+        "included": sorted(included),
+        "truncated": truncated,
+        "dropped": sorted(dropped),
+        "tokens": used
+    }
+
+def packing_budget(model, estimated_output_tokens, cost_limit=None):
+    """Return the input tokens a request may use: the context window minus the reserved output,
+    and if ``cost_limit`` is given, no more than that many dollars including the estimated output"""
+    budget = MODELS[model]["context_window"] - estimated_output_tokens
+    if cost_limit is not None:
+        output_cost = estimate_cost(0, estimated_output_tokens, model)
+        budget = min(budget, int((cost_limit - output_cost) / MODELS[model]["input_cost"] * 1000000))
+    return max(budget, 0)
+
+def format_seconds(seconds):
+    """Format a duration in seconds for display, or a dash if it is unknown"""
+    if seconds is None:
+        return "—"
+    return f"{seconds:.1f} с"